@@ -0,0 +1,53 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class BalanceCache:
+    def __init__(self, max_size: int = 500, ttl: float = 300):
+        """
+        A small thread safe card_id -> balance (in cents) cache with TTL and LRU eviction.
+        """
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, card_id: str):
+        """
+        Returns the cached balance in cents, or None if the card isn't cached or the entry has expired.
+        """
+
+        with self._lock:
+            entry = self._entries.get(card_id)
+            if entry is None:
+                return None
+
+            balance, stored_at = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[card_id]
+                return None
+
+            self._entries.move_to_end(card_id)
+            return balance
+
+    def put(self, card_id: str, balance: int):
+        with self._lock:
+            self._entries[card_id] = (balance, time.monotonic())
+            self._entries.move_to_end(card_id)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, card_id: str):
+        with self._lock:
+            self._entries.pop(card_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
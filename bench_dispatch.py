@@ -0,0 +1,99 @@
+import argparse
+import json
+import logging
+import time
+from queue import Queue
+
+import config
+import json_codec
+from flight_recorder import read_dump
+
+# Times decoding and dispatching portal packets with each JSON backend that's installed, over the websocket traffic
+# recorded in flight recorder dumps or a file with one packet per line. Without any it uses a typical mix of packets.
+#
+#   python3 bench_dispatch.py flight_recorder/*.bin --iterations 20000
+
+SAMPLE_TRAFFIC = [
+    {"command": "pong", "seq": 1, "sent_at": 1234.5},
+    {"command": "ping"},
+    {"command": "balance", "success": True, "balance": 1250, "request_id": "balance-1", "device_id": None},
+    {"command": "debit", "success": True, "balance": 1000, "request_id": "debit-1", "idempotency_key": "debit-1"},
+    {"command": "update_device_locked_out", "locked_out": False},
+    {"command": "unlock"},
+    {"command": "interlock_session_update"},
+    {"command": "products", "version": 3, "full": False, "products": [
+        {"item_number": number, "price": 250, "enabled": True} for number in range(10)
+    ]},
+]
+
+
+class NullWebSocket:
+    def send(self, message: str):
+        pass
+
+
+def load_traffic(paths: list) -> list:
+    messages = []
+    for path in paths:
+        if path.endswith(".bin"):
+            messages.extend(payload for _, event, payload in read_dump(path) if event == "ws_in")
+        else:
+            with open(path) as file:
+                messages.extend(line.strip() for line in file if line.strip())
+
+    # dumps truncate long packets to the slot size, only keep the ones that are still whole
+    traffic = []
+    for message in messages:
+        try:
+            json.loads(message)
+            traffic.append(message)
+        except ValueError:
+            pass
+    return traffic
+
+
+def time_per_message(callback, traffic: list, iterations: int) -> float:
+    start = time.perf_counter()
+    for index in range(iterations):
+        callback(traffic[index % len(traffic)])
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def run_benchmark(traffic: list, iterations: int) -> dict:
+    # keep the benchmark from touching the disk or spending its time in the console
+    config.DEBIT_JOURNAL_ENABLED = False
+    logging.disable(logging.CRITICAL)
+
+    import mm as mm_library
+
+    results = {"messages": len(traffic), "iterations": iterations}
+    for backend in json_codec.BACKENDS:
+        json_codec.use_backend(backend)
+        mm = mm_library.MM("", "127.0.0.1", Queue(), None, use_writer=False)
+        mm.ws = NullWebSocket()
+        decoded = [json_codec.loads(message) for message in traffic]
+
+        results[backend] = {
+            "decode_us": round(time_per_message(json_codec.loads, traffic, iterations), 2),
+            "encode_us": round(time_per_message(json_codec.dumps, decoded, iterations), 2),
+            "dispatch_us": round(time_per_message(lambda message: mm.ws_on_message(mm.ws, message), traffic, iterations), 2),
+        }
+
+    json_codec.use_backend(config.JSON_BACKEND)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark decoding and dispatching portal packets.")
+    parser.add_argument("traffic", nargs="*", help="flight recorder dumps (.bin) or files with one packet per line")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    traffic = load_traffic(args.traffic) if args.traffic else [json.dumps(packet) for packet in SAMPLE_TRAFFIC]
+    if not traffic:
+        parser.error("no whole websocket packets found in the traffic files")
+    print(json.dumps(run_benchmark(traffic, args.iterations), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+import config
+
+logger = logging.getLogger("mm:debit_journal")
+logger.setLevel(config.MM_LOG_LEVEL)
+
+
+class DebitJournal:
+    def __init__(self, path: str, fsync_interval: float = 1.0, fsync_batch_size: int = 20, compact_after: int = 1000):
+        """
+        An append-only journal of debit requests so we can keep vending while the portal is unreachable.
+
+        Every debit is written to the journal before it's sent to the portal. Debits approved while offline are
+        replayed in bulk when the connection comes back, and each one carries an idempotency key so the portal can
+        ignore any it has already processed. Records are flushed to the OS straight away (so they survive the process
+        crashing) and fsync'd in batches, at most fsync_interval seconds or fsync_batch_size records apart, as long
+        as sync() is called at least every fsync_interval. sync() also compacts the journal once compact_after debits
+        have been settled since it was last compacted.
+        """
+
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.fsync_batch_size = fsync_batch_size
+        self.compact_after = compact_after
+
+        self._lock = threading.Lock()
+        self._records = {}  # idempotency key -> debit record for every debit that hasn't been settled yet
+        self._refunds = {}  # key -> refund record for every member charged for a vend that was never dispensed
+        self._unpaid = {}  # key -> debit record for every vend approved offline that the portal then refused
+        self._unsynced = 0
+        self._last_fsync = time.monotonic()
+        self._settled = 0  # settle records appended since the journal was last compacted
+
+        self._load()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        # drop a torn final record so the next append doesn't get glued onto the end of it
+        with open(self.path, "rb+") as journal_file:
+            contents = journal_file.read()
+            if contents and not contents.endswith(b"\n"):
+                journal_file.truncate(contents.rfind(b"\n") + 1)
+
+        with open(self.path, "r", encoding="utf-8") as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a torn write from a crash or power cut, everything before it is still valid
+                    logger.warning("Ignoring corrupt debit journal record.")
+                    continue
+
+                if record.get("type") == "debit":
+                    self._records[record["key"]] = record
+                elif record.get("type") == "refund":
+                    self._refunds[record["key"]] = record
+                elif record.get("type") == "unpaid":
+                    self._records.pop(record["key"], None)
+                    self._unpaid[record["key"]] = record
+                elif record.get("type") == "settle":
+                    self._records.pop(record["key"], None)
+                    self._refunds.pop(record["key"], None)
+                    self._unpaid.pop(record["key"], None)
+
+        # debits sent while online that never got a reply weren't approved, so there's nothing to replay for them
+        for key in [key for key, record in self._records.items() if not record.get("offline")]:
+            del self._records[key]
+
+        if self._records:
+            logger.info(f"Loaded {len(self._records)} unsettled offline debits from the journal.")
+        if self._refunds:
+            logger.warning(f"{len(self._refunds)} refunds are still due, see the refund records in {self.path}.")
+        if self._unpaid:
+            logger.warning(f"{len(self._unpaid)} vends approved offline were refused by the portal, see the unpaid records in {self.path}.")
+
+    def _append(self, record: dict):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        self._unsynced += 1
+
+        if self._unsynced >= self.fsync_batch_size or time.monotonic() - self._last_fsync >= self.fsync_interval:
+            self._fsync()
+
+    def _fsync(self):
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+        self._last_fsync = time.monotonic()
+
+    def sync(self):
+        """
+        Forces any batched records to disk, called periodically and before shutting down. The journal is compacted
+        instead once enough debits have been settled.
+        """
+
+        if self.compact_after and self._settled >= self.compact_after:
+            self.compact()
+            return
+
+        with self._lock:
+            self._fsync()
+
+    def append_debit(self, card_id: str, amount_cents: int, product_external_id=None, offline: bool = False,
+                     device_id: str = None) -> str:
+        key = uuid.uuid4().hex
+        record = {
+            "type": "debit",
+            "key": key,
+            "card_id": card_id,
+            "amount": amount_cents,
+            "product_external_id": product_external_id,
+            "offline": offline,
+            "timestamp": time.time(),
+        }
+        if device_id:
+            record["device_id"] = device_id
+
+        with self._lock:
+            self._records[key] = record
+            self._append(record)
+
+        return key
+
+    def mark_offline(self, key: str):
+        """
+        Marks a debit as approved locally, so it needs to be replayed to the portal once we're back online.
+        """
+
+        with self._lock:
+            record = self._records.get(key)
+            if record is None:
+                return
+
+            record["offline"] = True
+            self._append(record)
+            # the vend is approved as soon as this returns, so the only record of what's owed can't wait for a batch
+            self._fsync()
+
+    def append_refund(self, card_id: str, amount_cents: int, request_id: str = None, device_id: str = None) -> str:
+        """
+        Records that a member was charged for a vend that was never dispensed. Refunds are made by the operator, so
+        the record stays in the journal until it's settled.
+        """
+
+        key = uuid.uuid4().hex
+        record = {
+            "type": "refund",
+            "key": key,
+            "card_id": card_id,
+            "amount": amount_cents,
+            "request_id": request_id,
+            "timestamp": time.time(),
+        }
+        if device_id:
+            record["device_id"] = device_id
+
+        with self._lock:
+            self._refunds[key] = record
+            self._append(record)
+            self._fsync()
+
+        return key
+
+    def refunds_due(self) -> list:
+        with self._lock:
+            return [dict(record) for record in self._refunds.values()]
+
+    def mark_denied(self, key: str):
+        """
+        Marks a debit as denied locally after the portal didn't answer in time, so a late approval from the portal is
+        known to be for a vend that never happened.
+        """
+
+        with self._lock:
+            record = self._records.get(key)
+            if record is None:
+                return
+
+            record["denied"] = True
+            self._append(record)
+
+    def mark_unpaid(self, key: str):
+        """
+        Records that the portal refused a debit for a vend that was approved offline and dispensed. It isn't replayed,
+        it's kept as an unpaid record for the operator until it's settled.
+        """
+
+        with self._lock:
+            record = self._records.pop(key, None)
+            if record is None:
+                return
+
+            record = dict(record, type="unpaid")
+            self._unpaid[key] = record
+            self._append(record)
+            self._fsync()
+
+    def get(self, key: str):
+        with self._lock:
+            record = self._records.get(key)
+            return dict(record) if record is not None else None
+
+    def unpaid_debits(self) -> list:
+        with self._lock:
+            return [dict(record) for record in self._unpaid.values()]
+
+    def settle(self, key: str):
+        with self._lock:
+            if (self._records.pop(key, None) is None and self._refunds.pop(key, None) is None
+                    and self._unpaid.pop(key, None) is None):
+                return
+
+            self._append({"type": "settle", "key": key})
+            self._settled += 1
+
+    def abandon_online(self):
+        """
+        Settles every debit that was sent online but never got a reply, they were never approved so mustn't be
+        replayed.
+        """
+
+        with self._lock:
+            for key in [key for key, record in self._records.items() if not record.get("offline")]:
+                del self._records[key]
+                self._append({"type": "settle", "key": key})
+                self._settled += 1
+
+    def offline_debits(self) -> list:
+        with self._lock:
+            return [dict(record) for record in self._records.values() if record.get("offline")]
+
+    def offline_total(self, card_id: str = None) -> int:
+        """
+        Returns the total (in cents) of unsettled offline debits, optionally just for one card.
+        """
+
+        with self._lock:
+            return sum(
+                record["amount"]
+                for record in self._records.values()
+                if record.get("offline") and (card_id is None or record["card_id"] == card_id)
+            )
+
+    def compact(self):
+        """
+        Rewrites the journal with only the unsettled debits so it doesn't grow forever. The new journal is written
+        to a temporary file and atomically renamed over the old one.
+        """
+
+        with self._lock:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as temp_file:
+                for record in [*self._records.values(), *self._refunds.values(), *self._unpaid.values()]:
+                    temp_file.write(json.dumps(record) + "\n")
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+
+            self._file.close()
+            os.replace(temp_path, self.path)
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._unsynced = 0
+            self._last_fsync = time.monotonic()
+            self._settled = 0
+
+    def close(self):
+        with self._lock:
+            self._fsync()
+            self._file.close()
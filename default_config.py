@@ -1,12 +1,131 @@
 import logging
 
-MDB_LOG_LEVEL = logging.INFO
+MDB_LOG_LEVEL = logging.INFO  # passed to pymultidropbus for its own logging
 MDB_LOG_ACK = False
-MM_LOG_LEVEL = logging.INFO
+MM_LOG_LEVEL = logging.DEBUG  # what mm-mdb's loggers record, CONSOLE_LOG_LEVEL and FLIGHT_RECORDER_LOG_LEVEL decide where it goes
+CONSOLE_LOG_LEVEL = logging.INFO  # log messages written to stderr
+FLIGHT_RECORDER_LOG_LEVEL = logging.DEBUG  # log messages kept in the flight recorder, which only touches the SD card when it's dumped
 PING_PERIOD = 5
 PROCESS_AFFINITY = 3
 MIN_CARD_SCAN_VALUE = 100  # ignore all card scans with an ID lower than this amount (useful if you occasionally get noise on your Wiegand line resulting in erronous scans with low values)
-WIEGAND_32BIT_MODE = True
+WIEGAND_FORMATS = (26, 34, 35, 37)  # Wiegand frame lengths to accept, the format is detected from the length and frames that fail the parity checks are ignored
+WIEGAND_CARD_VALUES = "legacy"  # "legacy" keeps the card ids members are registered with (24 bits of any format), "format" uses each format's data bits, which changes the ids from 34 bit and longer readers
+WIEGAND_MIN_BIT_INTERVAL = 200  # microseconds, frames with bits closer together than this are noise and ignored
+WIEGAND_CAPTURE_MODE = "notify"  # "notify" reads card reader bits in batches from pigpio's notification pipe, "callback" handles every bit in its own Python callback
+REPEAT_TAP_WINDOW = 3  # seconds, repeat scans of the same card within this window only start one session (0 disables it)
 
 API_SECRET = "xyz.xyzabc"
 PORTAL_WS_URL = "wss://portal.blah.blah/ws/access/memberbucks/"
+
+BALANCE_CACHE_ENABLED = True  # start cashless sessions straight away for recently seen cards, then refresh the balance from the portal in the background
+BALANCE_CACHE_SIZE = 500  # maximum number of cards to keep in the balance cache (least recently used are evicted first)
+BALANCE_CACHE_TTL = 300  # seconds a cached balance is trusted for
+
+DEBIT_JOURNAL_ENABLED = True  # journal debits to disk so we can keep vending (up to the limits below) while the portal is unreachable
+DEBIT_JOURNAL_PATH = "debit_journal.jsonl"
+DEBIT_JOURNAL_FSYNC_INTERVAL = 1  # maximum seconds between fsyncs of the debit journal
+DEBIT_JOURNAL_FSYNC_BATCH_SIZE = 20  # maximum number of debit journal records between fsyncs
+DEBIT_JOURNAL_COMPACT_AFTER = 1000  # compact the debit journal after this many debits have been settled (0 disables)
+OFFLINE_CARD_LIMIT = 500  # maximum cents a single card can spend while the portal is unreachable (0 disables offline vending)
+OFFLINE_TOTAL_LIMIT = 5000  # maximum cents all cards can spend while the portal is unreachable (0 disables offline vending)
+
+RUNTIME_MODE = "threaded"  # "threaded" runs a thread per queue, "asyncio" runs everything on one event loop (requires the websockets package)
+
+MDB_MAX_RESPONSE_TIME = 7  # seconds the VMC waits for the reader to respond (sent to the VMC in the reader config data)
+PORTAL_REQUEST_DEADLINE_MARGIN = 1.5  # seconds before the VMC gives up that we stop waiting on the portal and decide the vend locally
+
+MDB_COMMANDS_QUEUE_SIZE = 50  # maximum MDB events waiting to be handled before the oldest ones the VMC has stopped waiting on are dropped
+WS_COMMANDS_QUEUE_SIZE = 50  # maximum portal results waiting to be handled before the oldest balance results are dropped (debit results never are)
+BALANCE_RESULT_MAX_AGE = 10  # seconds a balance result is worth starting a session with, older ones are dropped and the member has to tap again
+
+SUPERVISOR_CHECK_PERIOD = 5  # seconds between checking the worker threads and the resource budget
+SUPERVISOR_MAX_RESTARTS = 5  # a worker thread that crashes more often than this in SUPERVISOR_RESTART_WINDOW restarts everything instead
+SUPERVISOR_RESTART_WINDOW = 300  # seconds
+SUPERVISOR_JOIN_TIMEOUT = 5  # seconds to wait for the worker threads to exit when stopping them
+SUPERVISOR_MAX_THREADS = 64  # threads the process can run before it's over budget (0 is unlimited)
+SUPERVISOR_MAX_RSS_MB = 200  # resident memory the process can use before it's over budget (0 is unlimited)
+SUPERVISOR_MAX_QUEUE_DEPTH = 100  # events waiting on any one queue before it's over budget (0 is unlimited)
+SUPERVISOR_OVER_BUDGET_GRACE = 60  # seconds over budget before taking SUPERVISOR_OVER_BUDGET_ACTION, an alert is logged straight away
+SUPERVISOR_OVER_BUDGET_ACTION = "restart"  # "restart" restarts every worker cleanly (or exits for memory, or if a restart didn't help), "exit" exits for the service manager to restart us, "alert" only logs
+
+RECONNECT_FIRST_DELAY = 0.5  # seconds before the first reconnect attempt after the portal connection drops
+RECONNECT_BASE_DELAY = 2  # seconds before the second attempt, doubling (with jitter) for each attempt after that
+RECONNECT_MAX_DELAY = 60  # maximum seconds between reconnect attempts
+RECONNECT_RESET_AFTER = 30  # seconds a connection has to stay up before the backoff resets
+
+METRICS_PORT = 9464  # serve vend latency and queue depth metrics in the Prometheus format on this localhost port (0 disables it)
+METRICS_REPORT_PERIOD = 300  # seconds between metrics summaries sent to the portal (0 disables them)
+
+WS_WRITER_QUEUE_SIZE = 100  # maximum messages waiting to be sent to the portal before heartbeats and telemetry are dropped
+WS_COMPRESSION = False  # negotiate permessage-deflate with the portal (asyncio runtime only, websocket-client doesn't support it)
+
+OPTIMISTIC_VEND_EXPOSURE_CAP = 1000  # maximum cents per session approved from the running balance before the portal confirms the debits (0 makes every vend wait on its debit)
+
+# reader config data sent to the VMC (MDB_MAX_RESPONSE_TIME above is sent with it)
+MDB_FEATURE_LEVEL = 1
+MDB_COUNTRY_CODE = 0x1036  # Australia
+MDB_SCALE_FACTOR = 1
+MDB_DECIMAL_PLACES = 2
+MDB_READER_OPTIONS = 0x0D
+# peripheral id data sent to the VMC
+MDB_MANUFACTURER_CODE = "BMS"
+MDB_SERIAL_NUMBER = None  # None uses the device serial (from the MAC address) so every reader is unique
+MDB_MODEL_NUMBER = "000000000001"
+MDB_SOFTWARE_VERSION = 0x0101
+
+# Run several vending machines from one Pi. Each machine gets its own MDB bus, card reader and cashless session, and
+# they all share one portal connection (authenticated with this device's serial) and balance cache. Every packet sent
+# on behalf of a machine is tagged with its device_id, so the portal needs to support routing by device_id.
+# An empty list runs a single machine on the default serial port with the card reader on GPIO 5 and 6.
+MACHINES = []
+# MACHINES = [
+#     {"device_id": "snacks", "serial_port": "/dev/ttyAMA0", "wiegand_d0": 5, "wiegand_d1": 6},
+#     {"device_id": "drinks", "serial_port": "/dev/ttyUSB0", "wiegand_d0": 13, "wiegand_d1": 19},
+# ]
+
+FLIGHT_RECORDER_SLOTS = 2048  # recent MDB, websocket, card reader and log events kept in memory (0 disables the flight recorder)
+FLIGHT_RECORDER_SLOT_SIZE = 256  # bytes kept per event, longer events are truncated
+FLIGHT_RECORDER_DIR = "flight_recorder"  # the events are written here when an error is logged, a vend fails or the portal disconnects
+FLIGHT_RECORDER_MIN_DUMP_INTERVAL = 60  # minimum seconds between dumps, to save the SD card
+FLIGHT_RECORDER_MAX_DUMPS = 10  # only the newest dumps are kept
+
+PRODUCT_CATALOG_ENABLED = True  # keep a copy of each machine's products from the portal to deny vends for disabled items or that the member can't afford without asking the portal
+PRODUCT_CATALOG_PATH = "product_catalog.json"  # machines in MACHINES get their own file with the device id added to the name
+PRODUCT_CATALOG_SYNC_PERIOD = 300  # seconds between asking the portal for product changes (it's also synced on every connect)
+
+SALES_LEDGER_ENABLED = True  # keep a record of every vend on disk and upload it to the portal for reconciliation
+SALES_LEDGER_DIR = "sales_ledger"  # machines in MACHINES get their own directory with the device id added to the name
+SALES_LEDGER_SEGMENT_RECORDS = 10000  # vends per ledger file (36 bytes each)
+SALES_LEDGER_MAX_SEGMENTS = 10  # only the newest ledger files are kept, older ones are kept too until the portal acknowledges them
+SALES_LEDGER_UPLOAD_PERIOD = 300  # seconds between uploading new sales to the portal (0 disables uploads)
+SALES_LEDGER_UPLOAD_BATCH_SIZE = 1000  # maximum sales per upload
+
+HEARTBEAT_MAX_PING_PERIOD = 30  # pings back off up to this many seconds apart while the portal is sending other traffic
+HEARTBEAT_MIN_TIMEOUT = 2  # minimum seconds without a reply before a ping counts as missed, the timeout adapts to the measured round trip time up to 3 ping periods
+HEARTBEAT_MISSED_PINGS = 3  # pings in a row that must time out before the connection is considered dead
+REQUEST_MIN_TIMEOUT = 2  # minimum seconds to wait for the portal to answer a balance or debit request, the timeout adapts to how long it's been taking up to MDB_MAX_RESPONSE_TIME - PORTAL_REQUEST_DEADLINE_MARGIN
+
+JSON_BACKEND = "auto"  # "orjson" (pip3 install orjson) or "json", auto uses orjson when it's installed
+
+EVENT_TRACE_PATH = None  # record every MDB command, websocket message and card scan to this file for replay_trace.py, eg "mm-mdb.trace"
+EVENT_TRACE_MAX_BYTES = 50 * 1024 * 1024  # stop recording once the trace reaches this size
+EVENT_TRACE_KEEP = 5  # each start records to a new trace named after the time, eg "mm-mdb-20240101-120000.trace", and only the newest ones are kept
+
+# scheduling for the threads in each role, needs root or CAP_SYS_NICE. "policy" is "fifo", "rr" or "other",
+# "priority" is the real time priority (1-99) for fifo and rr, "nice" is the nice value and "cpus" pins the role to
+# those cores. The MDB bus gets the most and keeps its core to itself, logging gets the least. It's off by default as
+# the cores are a Pi 4's, set SCHEDULING_PROFILE = PI_SCHEDULING_PROFILE (or your own) in config.py to use it.
+PI_SCHEDULING_PROFILE = {
+    "mdb": {"policy": "fifo", "priority": 50, "cpus": [PROCESS_AFFINITY]},
+    "commands": {"policy": "other", "nice": -10, "cpus": [2]},
+    "network": {"policy": "other", "nice": 0, "cpus": [0, 1, 2]},
+    "logging": {"policy": "other", "nice": 10, "cpus": [0, 1]},
+}
+SCHEDULING_PROFILE = None
+JITTER_MONITOR_INTERVAL = 0  # seconds between scheduling jitter samples, eg 0.1 while tuning the scheduling, 0 disables the jitter monitor
+GC_FREEZE_AFTER_INIT = True  # move everything allocated during startup out of the garbage collector's way
+GC_THRESHOLDS = (5000, 20, 20)  # garbage collection thresholds once started up, None keeps Python's defaults
+GC_MAX_DEFERRAL = 30  # seconds garbage collection can be held off for during a vend session, 0 never holds it off
+
+NETWORK_INTERFACE = None  # interface the device serial comes from, None uses wlan0 if there is one, otherwise the first interface with a MAC address
+DEVICE_SERIAL = None  # serial to identify as to the portal, None uses the network interface's MAC address
@@ -0,0 +1,70 @@
+import logging
+
+import config
+
+logger = logging.getLogger("mm:device_identity")
+logger.setLevel(config.MM_LOG_LEVEL)
+
+NULL_MAC = "00:00:00:00:00:00"
+
+
+def _netifaces():
+    # only needed while starting up and connecting, so it's not imported until then
+    import netifaces
+    return netifaces
+
+
+def _mac_address(interface: str) -> str:
+    netifaces = _netifaces()
+    links = netifaces.ifaddresses(interface).get(netifaces.AF_LINK) or []
+    return links[0].get("addr", "") if links else ""
+
+
+def get_interface() -> str:
+    """
+    Returns the network interface the device serial comes from: NETWORK_INTERFACE if it's set, otherwise wlan0 if
+    there is one (it's what older releases always used), otherwise the first interface with a MAC address by name.
+    It doesn't depend on which interface is up, so the serial stays the same from one boot to the next.
+    """
+
+    if config.NETWORK_INTERFACE:
+        return config.NETWORK_INTERFACE
+
+    interfaces = _netifaces().interfaces()
+    if "wlan0" in interfaces:
+        return "wlan0"
+
+    for interface in sorted(interfaces):
+        if interface != "lo" and _mac_address(interface) not in ("", NULL_MAC):
+            return interface
+
+    raise OSError("No network interface with a MAC address, set NETWORK_INTERFACE or DEVICE_SERIAL in config.py")
+
+
+def get_serial_number(interface: str) -> str:
+    if config.DEVICE_SERIAL:
+        return config.DEVICE_SERIAL
+    return _mac_address(interface).replace(":", "")
+
+
+def get_ip_address(interface: str = None) -> str:
+    """
+    Returns our IPv4 address on the interface with the default route, or on interface if there isn't one, or "" if
+    we don't have an address yet, which is common right after boot.
+    """
+
+    netifaces = _netifaces()
+    default_route = netifaces.gateways().get("default", {}).get(netifaces.AF_INET)
+    candidates = [default_route[1]] if default_route else []
+    if interface:
+        candidates.append(interface)
+
+    for candidate in candidates:
+        try:
+            addresses = netifaces.ifaddresses(candidate).get(netifaces.AF_INET)
+        except ValueError:
+            continue
+        if addresses:
+            return addresses[0]["addr"]
+
+    return ""
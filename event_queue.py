@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+from collections import deque
+from queue import Empty
+
+import config
+
+logger = logging.getLogger("mm:event_queue")
+logger.setLevel(config.MM_LOG_LEVEL)
+
+# put on a command queue to wake its thread up and tell it to exit, it's never dropped
+STOP = object()
+
+
+class EventBuffer:
+    def __init__(self, name: str, max_size: int = 0, deadline_for=None, on_expired=None):
+        """
+        The events waiting in a command queue, each stamped with the monotonic time it arrived and the time it's no
+        longer worth handling by. deadline_for(item) returns how many seconds an item is worth handling for, or None
+        if it must always be handled. pop() skips expired items, calling on_expired(item, age) for each on the
+        consumer's thread. When there are max_size items waiting, the oldest item with a deadline is dropped to make
+        room. Items without one are never dropped, so the buffer goes over max_size rather than lose one of them.
+        It's not thread safe, the queues lock around it.
+        """
+
+        self.name = name
+        self.max_size = max_size
+        self.deadline_for = deadline_for
+        self.on_expired = on_expired
+        self.expired = 0
+        self.dropped = 0
+        self.last_received_at = None  # when the item the consumer is handling arrived
+        self._items = deque()  # [received at, deadline or None, item]
+
+    def __len__(self):
+        return len(self._items)
+
+    def push(self, item):
+        now = time.monotonic()
+        seconds = self.deadline_for(item) if self.deadline_for is not None and item is not STOP else None
+        if self.max_size and len(self._items) >= self.max_size:
+            self._shed()
+        self._items.append((now, now + seconds if seconds is not None else None, item))
+
+    def _shed(self):
+        for index, (received_at, deadline, item) in enumerate(self._items):
+            if deadline is not None:
+                del self._items[index]
+                self.dropped += 1
+                logger.warning(f"{self.name} is full, dropped {describe(item)} that had waited {time.monotonic() - received_at:.3f}s.")
+                return
+
+    def pop(self):
+        """
+        Returns the oldest item that hasn't expired and a list of (item, age) that expired, or None and the expired
+        items if there's nothing left.
+        """
+
+        now = time.monotonic()
+        expired = []
+        while self._items:
+            received_at, deadline, item = self._items.popleft()
+            if deadline is not None and now > deadline:
+                self.expired += 1
+                expired.append((item, now - received_at))
+                continue
+            self.last_received_at = received_at
+            return item, expired
+        return None, expired
+
+    def report_expired(self, expired: list):
+        for item, age in expired:
+            if self.on_expired is not None:
+                try:
+                    self.on_expired(item, age)
+                except Exception as e:
+                    logger.error(f"Error handling expired {describe(item)} from {self.name}: {e}")
+            else:
+                logger.warning(f"Dropped {describe(item)} from {self.name}, it expired after waiting {age:.3f}s.")
+
+
+def describe(item) -> str:
+    if isinstance(item, dict):
+        return str(item.get("command"))
+    return str(getattr(item, "command", item))
+
+
+class DeadlineQueue:
+    def __init__(self, name: str, max_size: int = 0, deadline_for=None, on_expired=None):
+        """
+        A bounded replacement for queue.Queue that sheds stale events instead of handing a backlog of them to the
+        consumer after a stall, see EventBuffer. It has the put()/get() interface pymultidropbus and the command
+        queue threads use, with a single consumer.
+        """
+
+        self._buffer = EventBuffer(name, max_size, deadline_for, on_expired)
+        self._condition = threading.Condition()
+
+    @property
+    def name(self) -> str:
+        return self._buffer.name
+
+    @property
+    def expired(self) -> int:
+        return self._buffer.expired
+
+    @property
+    def dropped(self) -> int:
+        return self._buffer.dropped
+
+    @property
+    def last_received_at(self) -> float:
+        return self._buffer.last_received_at
+
+    def put(self, item, block: bool = True, timeout: float = None):
+        # never blocks, a full queue makes room by dropping a stale event instead
+        with self._condition:
+            self._buffer.push(item)
+            self._condition.notify()
+
+    def put_nowait(self, item):
+        self.put(item, False)
+
+    def get(self, block: bool = True, timeout: float = None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with self._condition:
+                item, expired = self._buffer.pop()
+                if item is None and not expired:
+                    remaining = deadline - time.monotonic() if deadline is not None else None
+                    if not block or (remaining is not None and remaining <= 0):
+                        raise Empty
+                    self._condition.wait(remaining)
+                    continue
+
+            self._buffer.report_expired(expired)
+            if item is not None:
+                return item
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self) -> int:
+        return len(self._buffer)
+
+    def empty(self) -> bool:
+        return not len(self._buffer)
@@ -0,0 +1,186 @@
+import atexit
+import glob
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+
+import config
+import json_codec
+from flight_recorder import EVENT_MDB, EVENT_WS_IN, EVENT_WS_OUT, EVENT_WIEGAND, EVENT_NAMES
+
+logger = logging.getLogger("mm:event_trace")
+logger.setLevel(config.MM_LOG_LEVEL)
+
+EVENT_DEVICE = 5  # names the device a device index stands for, the payload is the device id
+TRACE_EVENT_NAMES = {**EVENT_NAMES, EVENT_DEVICE: "device"}
+
+TRACE_MAGIC = b"MMTR1"
+TRACE_HEADER = struct.Struct("<5sd")  # magic, wall clock time the trace started
+# seconds since the trace started (monotonic), event type, device index, payload length
+RECORD_HEADER = struct.Struct("<dBBI")
+WIEGAND_PAYLOAD = struct.Struct("<BQ")  # bits, value
+
+# the MdbCommandEvent fields the command handlers use, prices are stored in cents
+MDB_FIELDS = (
+    "min_price",
+    "max_price",
+    "item_price",
+    "item_number",
+    "manufacturer_code",
+    "serial_number",
+    "model_number",
+    "software_version",
+)
+
+
+def encode_mdb_command(command) -> bytes:
+    fields = {"command": getattr(command.command, "name", str(command.command))}
+    for name in MDB_FIELDS:
+        value = getattr(command, name, None)
+        if value is None:
+            continue
+        if hasattr(value, "dollars"):
+            value = round(value.dollars * 100)
+        fields[name] = value
+    return json_codec.dumps(fields).encode("utf-8")
+
+
+class TraceRecorder:
+    def __init__(self, path: str, max_bytes: int = None):
+        """
+        Records every MDB command, websocket message and card scan with its monotonic time to a compact binary trace,
+        so a problem in the field can be replayed on a dev box with replay_trace.py. Unlike the flight recorder
+        nothing is truncated or overwritten, the trace just stops once it reaches max_bytes. Writes are buffered,
+        flush() is called by the ping thread.
+        """
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.bytes_written = TRACE_HEADER.size
+        self._devices = {None: 0}  # device id -> index
+        self._started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+        self._file = open(path, "wb", buffering=64 * 1024)
+        self._file.write(TRACE_HEADER.pack(TRACE_MAGIC, time.time()))
+
+    def record(self, event: int, payload, device_id: str = None):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+
+        with self._lock:
+            if self._file is None:
+                return
+
+            index = self._devices.get(device_id)
+            if index is None:
+                index = self._devices[device_id] = len(self._devices)
+                self._write(EVENT_DEVICE, index, device_id.encode("utf-8"))
+            self._write(event, index, payload)
+
+    def _write(self, event: int, index: int, payload: bytes):
+        if self.max_bytes and self.bytes_written + RECORD_HEADER.size + len(payload) > self.max_bytes:
+            logger.warning(f"Event trace {self.path} is full, stopping the trace.")
+            self._file.close()
+            self._file = None
+            return
+
+        self._file.write(RECORD_HEADER.pack(time.monotonic() - self._started_at, event, index, len(payload)))
+        self._file.write(payload)
+        self.bytes_written += RECORD_HEADER.size + len(payload)
+
+    def record_mdb(self, command, device_id: str = None):
+        self.record(EVENT_MDB, encode_mdb_command(command), device_id)
+
+    def record_wiegand(self, bits: int, value: int, device_id: str = None):
+        self.record(EVENT_WIEGAND, WIEGAND_PAYLOAD.pack(bits, value), device_id)
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# the running trace, the hooks check for None so tracing costs nothing when it's off
+recorder: TraceRecorder = None
+
+
+def timestamped_path(path: str) -> str:
+    root, extension = os.path.splitext(path)
+    return f"{root}-{time.strftime('%Y%m%d-%H%M%S')}{extension}"
+
+
+def remove_old_traces(path: str, keep: int):
+    root, extension = os.path.splitext(path)
+    # the timestamps sort in the order the traces were started
+    for old_path in sorted(glob.glob(f"{root}-*{extension}"))[:-keep or None]:
+        try:
+            os.remove(old_path)
+        except OSError as e:
+            logger.warning(f"Couldn't remove old event trace {old_path}: {e}")
+
+
+def start(path: str, max_bytes: int = None, keep: int = None) -> TraceRecorder:
+    """
+    Starts recording to path. With keep, each start records to a new file named after the time it started instead,
+    so the trace leading up to a crash or reboot isn't overwritten, and only the newest keep traces are kept.
+    """
+
+    global recorder
+
+    if keep:
+        remove_old_traces(path, keep - 1)
+        path = timestamped_path(path)
+    recorder = TraceRecorder(path, max_bytes)
+    atexit.register(recorder.close)
+    logger.info(f"Recording an event trace to {path}")
+    return recorder
+
+
+def read_trace(path: str):
+    """
+    Yields (seconds since the trace started, event type, device id, payload bytes) for each event in a trace, in the
+    order they happened. A torn last record from a crash is skipped.
+    """
+
+    devices = {0: None}
+    with open(path, "rb") as file:
+        magic, _ = TRACE_HEADER.unpack(file.read(TRACE_HEADER.size))
+        if magic != TRACE_MAGIC:
+            raise ValueError(f"{path} isn't an event trace")
+
+        while True:
+            header = file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            offset, event, index, length = RECORD_HEADER.unpack(header)
+            payload = file.read(length)
+            if len(payload) < length:
+                return
+
+            if event == EVENT_DEVICE:
+                devices[index] = payload.decode("utf-8")
+                continue
+            yield offset, event, devices.get(index), payload
+
+
+def describe_payload(event: int, payload: bytes) -> str:
+    if event == EVENT_WIEGAND:
+        bits, value = WIEGAND_PAYLOAD.unpack(payload)
+        return f"{bits} {value}"
+    return payload.decode("utf-8", "replace")
+
+
+if __name__ == "__main__":
+    # python3 event_trace.py <trace file>
+    for offset, event, device_id, payload in read_trace(sys.argv[1]):
+        print(f"{offset:12.6f} {TRACE_EVENT_NAMES.get(event, str(event)):8} {device_id or '-':10} {describe_payload(event, payload)}")
@@ -0,0 +1,204 @@
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+
+import config
+
+logger = logging.getLogger("mm:flight_recorder")
+logger.setLevel(config.MM_LOG_LEVEL)
+
+EVENT_LOG = 0
+EVENT_MDB = 1
+EVENT_WS_IN = 2
+EVENT_WS_OUT = 3
+EVENT_WIEGAND = 4
+EVENT_NAMES = {
+    EVENT_LOG: "log",
+    EVENT_MDB: "mdb",
+    EVENT_WS_IN: "ws_in",
+    EVENT_WS_OUT: "ws_out",
+    EVENT_WIEGAND: "wiegand",
+}
+
+# each slot starts with the wall clock time, the event type and the payload length
+SLOT_HEADER = struct.Struct("<dBH")
+DUMP_MAGIC = b"MMFR1"
+DUMP_HEADER = struct.Struct("<5sHI")  # magic, slot size, number of slots
+
+
+class FlightRecorder:
+    def __init__(self, slots: int, slot_size: int = 256, dump_dir: str = "flight_recorder", min_dump_interval: float = 60, max_dumps: int = 10):
+        """
+        Keeps the most recent MDB, websocket, card reader and log events in a fixed size binary ring buffer in memory,
+        so there's a detailed record of what led up to a problem without writing every event to the SD card. The
+        buffer is only written to disk when dump() is called, at most once every min_dump_interval seconds, and only
+        the newest max_dumps files are kept. Events longer than a slot are truncated. slots of 0 disables it. Log
+        records are kept as they are and only formatted when they're dumped.
+        """
+
+        self.slots = slots
+        self.slot_size = slot_size
+        self.dump_dir = dump_dir
+        self.min_dump_interval = min_dump_interval
+        self.max_dumps = max_dumps
+        self.max_payload = slot_size - SLOT_HEADER.size
+
+        self._buffer = bytearray(slots * slot_size)
+        self._log_records = [None] * slots  # the log record in each slot that holds one, see record_log()
+        self._next_slot = 0
+        self._count = 0
+        self._last_dump = None
+        self._lock = threading.Lock()
+
+    def record(self, event: int, payload):
+        if not self.slots:
+            return
+
+        if isinstance(payload, str):
+            payload = payload[:self.max_payload].encode("utf-8", "replace")
+        payload = payload[:self.max_payload]
+
+        with self._lock:
+            offset = self._next_slot * self.slot_size
+            SLOT_HEADER.pack_into(self._buffer, offset, time.time(), event, len(payload))
+            start = offset + SLOT_HEADER.size
+            self._buffer[start:start + len(payload)] = payload
+            self._log_records[self._next_slot] = None
+            self._advance()
+
+    def record_log(self, log_record: logging.LogRecord):
+        """
+        Records a log message without formatting it, the slot's payload is filled in when the buffer is dumped.
+        """
+
+        if not self.slots:
+            return
+
+        with self._lock:
+            SLOT_HEADER.pack_into(self._buffer, self._next_slot * self.slot_size, log_record.created, EVENT_LOG, 0)
+            self._log_records[self._next_slot] = log_record
+            self._advance()
+
+    def _advance(self):
+        self._next_slot = (self._next_slot + 1) % self.slots
+        self._count = min(self._count + 1, self.slots)
+
+    def _snapshot_raw(self) -> tuple:
+        # the slots and their log records oldest first, with the log messages still to be formatted
+        with self._lock:
+            if self._count < self.slots:
+                return bytearray(self._buffer[:self._count * self.slot_size]), self._log_records[:self._count]
+            split = self._next_slot * self.slot_size
+            return (self._buffer[split:] + self._buffer[:split],
+                    self._log_records[self._next_slot:] + self._log_records[:self._next_slot])
+
+    def _format_logs(self, buffer: bytearray, log_records: list) -> bytes:
+        for slot, log_record in enumerate(log_records):
+            if log_record is None:
+                continue
+
+            try:
+                message = f"{log_record.levelname} {log_record.name}: {log_record.getMessage()}"
+            except Exception as e:
+                message = f"{log_record.levelname} {log_record.name}: {log_record.msg!r} (couldn't be formatted: {e})"
+            payload = message[:self.max_payload].encode("utf-8", "replace")[:self.max_payload]
+            offset = slot * self.slot_size
+            SLOT_HEADER.pack_into(buffer, offset, log_record.created, EVENT_LOG, len(payload))
+            start = offset + SLOT_HEADER.size
+            buffer[start:start + len(payload)] = payload
+        return bytes(buffer)
+
+    def snapshot(self) -> bytes:
+        """
+        Returns the recorded slots, oldest first.
+        """
+
+        return self._format_logs(*self._snapshot_raw())
+
+    def dump(self, reason: str):
+        """
+        Writes the buffer to a new file in dump_dir from a background thread, so the thread that hit the problem
+        isn't held up formatting the log messages or by the SD card.
+        """
+
+        if not self.slots:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            if self._last_dump is not None and now - self._last_dump < self.min_dump_interval:
+                return
+            self._last_dump = now
+
+        buffer, log_records = self._snapshot_raw()
+        threading.Thread(target=self._write_dump, args=(reason, buffer, log_records), name="flight_recorder", daemon=True).start()
+
+    def _write_dump(self, reason: str, buffer: bytearray, log_records: list):
+        snapshot = self._format_logs(buffer, log_records)
+        try:
+            os.makedirs(self.dump_dir, exist_ok=True)
+            path = os.path.join(self.dump_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{reason}.bin")
+            with open(path, "wb") as file:
+                file.write(DUMP_HEADER.pack(DUMP_MAGIC, self.slot_size, len(snapshot) // self.slot_size))
+                file.write(snapshot)
+            logger.info(f"Wrote flight recorder dump: {path}")
+
+            dumps = sorted(name for name in os.listdir(self.dump_dir) if name.endswith(".bin"))
+            for name in dumps[:-self.max_dumps]:
+                os.remove(os.path.join(self.dump_dir, name))
+        except OSError as e:
+            logger.warning(f"Couldn't write flight recorder dump: {e}")
+
+
+class FlightRecorderHandler(logging.Handler):
+    def __init__(self, recorder: FlightRecorder, level: int = logging.NOTSET):
+        """
+        Records log messages in the flight recorder, and dumps it whenever an error is logged. Messages are
+        formatted when the recorder is dumped rather than by the thread that logged them.
+        """
+
+        super().__init__(level)
+        self.recorder = recorder
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.recorder.record_log(record)
+            if record.levelno >= logging.ERROR and record.name != logger.name:
+                self.recorder.dump("error")
+        except Exception:
+            self.handleError(record)
+
+
+def read_dump(path: str):
+    """
+    Yields (timestamp, event name, payload) for each event in a dump file, oldest first.
+    """
+
+    with open(path, "rb") as file:
+        magic, slot_size, slots = DUMP_HEADER.unpack(file.read(DUMP_HEADER.size))
+        if magic != DUMP_MAGIC:
+            raise ValueError(f"{path} isn't a flight recorder dump")
+
+        for _ in range(slots):
+            slot = file.read(slot_size)
+            timestamp, event, length = SLOT_HEADER.unpack_from(slot)
+            payload = slot[SLOT_HEADER.size:SLOT_HEADER.size + length].decode("utf-8", "replace")
+            yield timestamp, EVENT_NAMES.get(event, str(event)), payload
+
+
+flight_recorder = FlightRecorder(
+    config.FLIGHT_RECORDER_SLOTS,
+    config.FLIGHT_RECORDER_SLOT_SIZE,
+    config.FLIGHT_RECORDER_DIR,
+    config.FLIGHT_RECORDER_MIN_DUMP_INTERVAL,
+    config.FLIGHT_RECORDER_MAX_DUMPS,
+)
+
+
+if __name__ == "__main__":
+    # python3 flight_recorder.py flight_recorder/<dump>.bin
+    for timestamp, event, payload in read_dump(sys.argv[1]):
+        print(f"{time.strftime('%H:%M:%S', time.localtime(timestamp))}.{int(timestamp % 1 * 1000):03d} {event:8} {payload}")
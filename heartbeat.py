@@ -0,0 +1,157 @@
+import threading
+import time
+
+
+class RttEstimator:
+    def __init__(self, min_timeout: float, max_timeout: float, multiplier: float = 4):
+        """
+        Smoothed round trip time and variance, estimated the same way TCP does (RFC 6298). timeout() is the smoothed
+        round trip plus multiplier times the variance, clamped between min_timeout and max_timeout, and is
+        max_timeout until there's been a sample. Like TCP, the timeout doubles each time it expires without a reply
+        until the next sample.
+        """
+
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.multiplier = multiplier
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+        self._backoff = 1
+        self._lock = threading.Lock()
+
+    def observe(self, rtt: float):
+        with self._lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            self.samples += 1
+            self._backoff = 1
+
+    def timed_out(self):
+        with self._lock:
+            self._backoff = min(self._backoff * 2, 64)
+
+    def timeout(self) -> float:
+        with self._lock:
+            if self.srtt is None:
+                return self.max_timeout
+            timeout = (self.srtt + self.multiplier * self.rttvar) * self._backoff
+            return min(max(timeout, self.min_timeout), self.max_timeout)
+
+    def snapshot(self) -> dict:
+        return {
+            "srtt": self.srtt,
+            "rttvar": self.rttvar,
+            "samples": self.samples,
+            "timeout": self.timeout(),
+        }
+
+
+class Heartbeat:
+    def __init__(self, ping_period: float, max_ping_period: float, min_timeout: float, max_timeout: float,
+                 missed_pings: int = 3):
+        """
+        Tracks pings to the portal by sequence number to measure the round trip time, and decides the connection is
+        dead once missed_pings pings in a row have timed out without anything at all arriving from the portal, so one
+        slow pong doesn't drop the connection. Any message from the portal proves the connection is alive, so pings
+        back off from ping_period up to max_ping_period while real traffic is flowing.
+        """
+
+        self.ping_period = ping_period
+        self.max_ping_period = max_ping_period
+        self.missed_pings = missed_pings
+        self.rtt = RttEstimator(min_timeout, max_timeout)
+        self._next_sequence = 1
+        self._outstanding = {}  # sequence number -> monotonic time the ping was sent
+        self._last_ping = 0.0
+        self.last_received = time.monotonic()
+        self._lock = threading.Lock()
+
+    def connected(self):
+        with self._lock:
+            self._outstanding.clear()
+            self._last_ping = 0.0
+            self.last_received = time.monotonic()
+
+    def message_received(self):
+        self.last_received = time.monotonic()
+
+    def should_ping(self) -> bool:
+        now = time.monotonic()
+        since_last_ping = now - self._last_ping
+        if since_last_ping >= self.max_ping_period:
+            # keep the round trip estimate fresh even on a busy connection
+            return True
+        return since_last_ping >= self.ping_period and now - self.last_received >= self.ping_period
+
+    def next_ping(self) -> dict:
+        """
+        Records a ping being sent and returns the fields to send with it.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            sequence = self._next_sequence
+            self._next_sequence += 1
+            self._outstanding[sequence] = now
+            self._last_ping = now
+
+            # forget pings that were never answered once newer traffic has proven the connection is alive
+            for old_sequence, sent_at in list(self._outstanding.items()):
+                if sent_at < self.last_received - self.rtt.max_timeout:
+                    del self._outstanding[old_sequence]
+
+        return {"seq": sequence, "sent_at": now}
+
+    def pong_received(self, sequence: int = None):
+        """
+        Records a pong, which acknowledges its ping and any earlier ones. Portals that don't echo the sequence number
+        are matched to the oldest ping.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            if not self._outstanding:
+                return None
+            if sequence is None:
+                sequence = min(self._outstanding)
+            sent_at = self._outstanding.get(sequence)
+            for acknowledged in [old_sequence for old_sequence in self._outstanding if old_sequence <= sequence]:
+                del self._outstanding[acknowledged]
+
+        if sent_at is None:
+            return None
+
+        rtt = now - sent_at
+        self.rtt.observe(rtt)
+        return rtt
+
+    def liveness_timeout(self) -> float:
+        return self.rtt.timeout()
+
+    def _unanswered(self) -> list:
+        # anything arriving after a ping went out means the connection is still alive, just slow to pong
+        with self._lock:
+            return [sent_at for sent_at in self._outstanding.values() if sent_at > self.last_received]
+
+    def is_dead(self) -> bool:
+        timed_out_before = time.monotonic() - self.liveness_timeout()
+        missed = sum(1 for sent_at in self._unanswered() if sent_at <= timed_out_before)
+        return missed >= self.missed_pings
+
+    def next_check_delay(self) -> float:
+        """
+        Returns how long until the heartbeat next needs attention, either to send a ping or to check whether an
+        unanswered ping has timed out.
+        """
+
+        now = time.monotonic()
+        timeout = self.liveness_timeout()
+        next_ping = min(max(self._last_ping, self.last_received) + self.ping_period, self._last_ping + self.max_ping_period)
+        deadlines = [sent_at + timeout for sent_at in self._unanswered() if sent_at + timeout > now]
+        delay = min([self.ping_period, next_ping - now, *(deadline - now for deadline in deadlines)])
+        return max(delay, 0.1)
@@ -0,0 +1,53 @@
+import json
+import logging
+
+import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger("mm:json_codec")
+logger.setLevel(config.MM_LOG_LEVEL)
+
+# Encodes and decodes websocket packets with orjson when it's installed (pip3 install orjson), it's several times
+# faster than the standard library on the Pi. Otherwise it falls back to the json module, the packets are the same
+# either way.
+
+
+def _json_dumps(obj) -> str:
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def _orjson_dumps(obj) -> str:
+    return orjson.dumps(obj).decode("utf-8")
+
+
+BACKENDS = {"json": (json.loads, _json_dumps)}
+if orjson is not None:
+    BACKENDS["orjson"] = (orjson.loads, _orjson_dumps)
+
+backend = None
+loads = None
+dumps = None
+
+
+def use_backend(name: str = "auto"):
+    """
+    Switches the codec to the named backend, "auto" picks the fastest one installed.
+    """
+
+    global backend, loads, dumps
+
+    if name == "auto":
+        name = "orjson" if "orjson" in BACKENDS else "json"
+    elif name not in BACKENDS:
+        logger.warning(f"JSON backend {name} isn't available, falling back to json.")
+        name = "json"
+
+    backend = name
+    loads, dumps = BACKENDS[name]
+
+
+use_backend(config.JSON_BACKEND)
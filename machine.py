@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+
+import config
+from product_catalog import ProductCatalog
+from sales_ledger import SalesLedger
+from vend_session import VendSession
+
+
+class Machine:
+    def __init__(self, device_id: str = None, serial_port: str = None, wiegand_d0: int = 5, wiegand_d1: int = 6):
+        """
+        One vending machine with its own MDB bus, card reader and cashless session. device_id tags everything we send
+        to the portal for this machine so several machines can share one portal connection, it's None when we're only
+        running a single machine.
+        """
+
+        self.device_id = device_id
+        self.serial_port = serial_port
+        self.wiegand_d0 = wiegand_d0
+        self.wiegand_d1 = wiegand_d1
+        self.wiegand_reader = None
+        self.mdb = None  # the CashlessPeripheral on serial_port
+
+        self.current_session: VendSession or None = None
+        # request id of the debit we're waiting on to approve or deny the current vend
+        self.current_vend_request_id = ""
+        self.current_vend_lock = threading.Lock()
+        # request id -> (session, amount) for locally approved vends being debited from the portal
+        self.settling_debits = {}
+        # request id -> vend for debits still in flight when the VMC gave up on their vend
+        self.abandoned_debits = {}
+        self.last_tap = None  # (card_id, time) of the last scan that started a session
+        self.catalog = ProductCatalog(self.get_file_path(config.PRODUCT_CATALOG_PATH)) if config.PRODUCT_CATALOG_ENABLED else None
+        self.sales_ledger = SalesLedger(
+            self.get_file_path(config.SALES_LEDGER_DIR),
+            config.SALES_LEDGER_SEGMENT_RECORDS,
+            config.SALES_LEDGER_MAX_SEGMENTS,
+        ) if config.SALES_LEDGER_ENABLED else None
+        # (requested at, item number, price) of the vend the VMC is waiting on or dispensing
+        self.current_vend = None
+
+    def is_repeat_tap(self, card_id: str, window: float) -> bool:
+        """
+        Returns True if the same card was scanned on this machine less than window seconds ago, so an impatient double
+        tap or a card left on the reader only asks the portal for the balance once. Otherwise records the scan.
+        """
+
+        now = time.monotonic()
+        if window and self.last_tap is not None:
+            last_card_id, last_tapped_at = self.last_tap
+            if card_id == last_card_id and now - last_tapped_at < window:
+                return True
+
+        self.last_tap = (card_id, now)
+        return False
+
+    @property
+    def name(self) -> str:
+        return self.device_id or "default"
+
+    def abandon_debit(self) -> bool:
+        """
+        Called when the VMC gives up on the current vend. If its debit is still in flight, returns True and keeps the
+        vend in abandoned_debits so its sale can be recorded once we know whether the member was charged for it.
+        """
+
+        with self.current_vend_lock:
+            if not self.current_vend_request_id:
+                return False
+            self.abandoned_debits[self.current_vend_request_id] = self.current_vend
+            self.current_vend_request_id = ""
+            self.current_vend = None
+            return True
+
+    def record_sale(self, outcome: int, card_id: str = None, flags: int = 0, vend: tuple = None):
+        """
+        Records how the current vend, or an abandoned one, ended in the sales ledger.
+        """
+
+        if vend is None:
+            vend = self.current_vend
+            self.current_vend = None
+        if vend is None or self.sales_ledger is None:
+            return
+
+        requested_at, item_number, price = vend
+        self.sales_ledger.append(requested_at, card_id, item_number, price, outcome, flags)
+
+    def get_file_path(self, path: str) -> str:
+        # each machine keeps its own copy of per machine files, the single machine uses the path as is
+        if not path or not self.device_id:
+            return path
+        root, extension = os.path.splitext(path)
+        return f"{root}-{self.device_id}{extension}"
+
+    def queue_name(self, queue_name: str) -> str:
+        # keep the single machine metric names the same as they've always been
+        return f"{queue_name}:{self.device_id}" if self.device_id else queue_name
+
+
+def load_machines() -> list:
+    """
+    Returns the machines listed in config.MACHINES, or a single machine using the library's default serial port and
+    the original Wiegand pins if none are configured.
+    """
+
+    if not config.MACHINES:
+        return [Machine()]
+
+    machines = []
+    for machine_config in config.MACHINES:
+        if not machine_config.get("device_id"):
+            raise ValueError(f"Every machine in MACHINES needs a device_id: {machine_config}")
+
+        machines.append(Machine(
+            machine_config["device_id"],
+            machine_config.get("serial_port"),
+            machine_config.get("wiegand_d0", 5),
+            machine_config.get("wiegand_d1", 6),
+        ))
+
+    device_ids = [machine.device_id for machine in machines]
+    if len(set(device_ids)) != len(device_ids):
+        raise ValueError(f"Machine device ids must be unique: {device_ids}")
+
+    return machines
@@ -0,0 +1,87 @@
+from typing import NamedTuple
+
+import config
+
+# Responses the reader sends to the VMC that never change while we're running. They're built once at startup instead
+# of formatting a hex string every time the VMC asks for them. A frame is only the cached hex string, the bytes
+# themselves are written by pymultidropbus.
+
+
+class MdbFrame(NamedTuple):
+    hex: str  # the frame's bytes as the hex string _send_cmd() takes, it adds the checksum
+
+
+def build_frame(data: bytes) -> MdbFrame:
+    return MdbFrame(bytes(data).hex(" ").upper())
+
+
+def _ascii_field(value: str, length: int) -> bytes:
+    field = str(value).upper().rjust(length, "0").encode("ascii")
+    if len(field) != length:
+        raise ValueError(f"{value} doesn't fit in a {length} character MDB field")
+    return field
+
+
+def build_reader_config_frame(feature_level: int, country_code: int, scale_factor: int, decimal_places: int,
+                              max_response_time: int, options: int) -> MdbFrame:
+    return build_frame(bytes([
+        0x01,  # reader config data
+        feature_level,
+        country_code >> 8,
+        country_code & 0xFF,
+        scale_factor,
+        decimal_places,
+        max_response_time,
+        options,
+    ]))
+
+
+def build_peripheral_id_frame(manufacturer_code: str, serial_number: str, model_number: str,
+                              software_version: int) -> MdbFrame:
+    return build_frame(
+        bytes([0x09])  # peripheral id
+        + _ascii_field(manufacturer_code, 3)
+        + _ascii_field(serial_number, 12)
+        + _ascii_field(model_number, 12)
+        + software_version.to_bytes(2, "big")
+    )
+
+
+class ResponseFrames(NamedTuple):
+    reader_config: MdbFrame
+    peripheral_id: MdbFrame
+
+    @classmethod
+    def from_config(cls, device_serial: str = None) -> "ResponseFrames":
+        """
+        Builds the frames from config, using the device serial (from the MAC address) as the peripheral serial
+        number unless MDB_SERIAL_NUMBER overrides it, so each reader in a fleet identifies itself uniquely.
+        """
+
+        serial_number = config.MDB_SERIAL_NUMBER or device_serial or "1"
+        return cls(
+            build_reader_config_frame(
+                config.MDB_FEATURE_LEVEL,
+                config.MDB_COUNTRY_CODE,
+                config.MDB_SCALE_FACTOR,
+                config.MDB_DECIMAL_PLACES,
+                config.MDB_MAX_RESPONSE_TIME,
+                config.MDB_READER_OPTIONS,
+            ),
+            build_peripheral_id_frame(
+                config.MDB_MANUFACTURER_CODE,
+                serial_number,
+                config.MDB_MODEL_NUMBER,
+                config.MDB_SOFTWARE_VERSION,
+            ),
+        )
+
+
+def send_frame(mdb, frame: MdbFrame):
+    """
+    Writes a precompiled frame to the bus with the peripheral's _send_cmd(), which pymultidropbus uses for its own
+    replies and appends the checksum to. Only the hex string is prebuilt, the peripheral's serial port and mode bit
+    handling are left to it.
+    """
+
+    mdb._send_cmd(frame.hex)
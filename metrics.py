@@ -0,0 +1,230 @@
+import bisect
+import logging
+import os
+import threading
+import time
+
+import config
+
+logger = logging.getLogger("mm:metrics")
+logger.setLevel(config.MM_LOG_LEVEL)
+
+# upper bounds (in seconds) of the histogram buckets, from 1ms up to 60s in steps of 1.5x
+BUCKETS = []
+_bound = 0.001
+while _bound < 60:
+    BUCKETS.append(round(_bound, 6))
+    _bound *= 1.5
+BUCKETS.append(float("inf"))
+
+# finer buckets for scheduling delays, from 20us up to 10s
+FINE_BUCKETS = []
+_bound = 0.00002
+while _bound < 10:
+    FINE_BUCKETS.append(round(_bound, 7))
+    _bound *= 1.5
+FINE_BUCKETS.append(float("inf"))
+
+# stages timed from the card tap
+TAP_STAGES = ["balance_request_sent", "balance_reply", "session_started"]
+# stages timed from the VMC's vend request
+VEND_STAGES = ["debit_request_sent", "debit_reply", "vend_approved", "vend_denied"]
+# round trip times to the portal, timed from when each request was sent
+RTT_STAGES = ["portal_balance_rtt", "portal_debit_rtt", "portal_ping_rtt"]
+# how late threads wake up and how long garbage collections pause everything
+SCHEDULING_STAGES = ["scheduling_jitter", "gc_pause"]
+
+
+class Histogram:
+    def __init__(self, buckets: list = None):
+        """
+        A fixed bucket histogram, cheap enough to update from the vend path. Percentiles are interpolated within
+        the bucket they fall in.
+        """
+
+        self.buckets = buckets or BUCKETS
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def percentile(self, percentile: float):
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+
+        if not count:
+            return None
+
+        target = count * percentile / 100
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count and seen + bucket_count >= target:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                if upper == float("inf"):
+                    return lower
+                return lower + (upper - lower) * (target - seen) / bucket_count
+            seen += bucket_count
+
+        return self.buckets[-2]
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+def resource_usage() -> dict:
+    """
+    Returns how many threads the process is running and its resident memory in bytes (0 without /proc).
+    """
+
+    try:
+        with open("/proc/self/statm") as file:
+            rss_bytes = int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        rss_bytes = 0
+    return {"threads": threading.active_count(), "rss_bytes": rss_bytes}
+
+
+class VendMetrics:
+    def __init__(self):
+        """
+        Records how long each stage of a vend takes, from the card tap through to approving or denying the vend,
+        along with the depth of the command queues. Each machine times its stages from its own tap and vend request,
+        keyed by device id, so machines sharing the process don't time their stages from each other's.
+        """
+
+        self.histograms = {stage: Histogram() for stage in TAP_STAGES + VEND_STAGES + RTT_STAGES}
+        self.histograms.update({stage: Histogram(FINE_BUCKETS) for stage in SCHEDULING_STAGES})
+        self.queues = {}
+        self._tap_times = {}  # device id -> when its card was last tapped
+        self._vend_times = {}  # device id -> when its VMC last requested a vend
+
+    def register_queue(self, name: str, queue):
+        self.queues[name] = queue
+
+    def tap(self, device_id: str = None):
+        self._tap_times[device_id] = time.monotonic()
+
+    def vend_request(self, device_id: str = None):
+        self._vend_times[device_id] = time.monotonic()
+
+    def stage(self, stage: str, device_id: str = None):
+        origin = (self._tap_times if stage in TAP_STAGES else self._vend_times).get(device_id)
+        if origin is not None:
+            self.histograms[stage].observe(time.monotonic() - origin)
+
+    def observe(self, stage: str, seconds: float):
+        self.histograms[stage].observe(seconds)
+
+    def queue_depths(self) -> dict:
+        return {name: queue.qsize() for name, queue in self.queues.items()}
+
+    def queue_shed(self) -> dict:
+        # how many events each queue has dropped because they expired or it was full, for the queues that shed any
+        return {
+            name: {"expired": getattr(queue, "expired", 0), "dropped": getattr(queue, "dropped", 0)}
+            for name, queue in self.queues.items()
+            if hasattr(queue, "dropped")
+        }
+
+    def summary(self) -> dict:
+        return {
+            "stages": {
+                stage: histogram.snapshot()
+                for stage, histogram in self.histograms.items()
+                if histogram.count
+            },
+            "queues": self.queue_depths(),
+            "queue_shed": self.queue_shed(),
+            "resources": resource_usage(),
+        }
+
+    def prometheus_text(self) -> str:
+        lines = [
+            "# HELP mm_mdb_stage_seconds Time taken to reach each stage of a vend.",
+            "# TYPE mm_mdb_stage_seconds histogram",
+        ]
+        for stage, histogram in self.histograms.items():
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets, histogram.counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'mm_mdb_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'mm_mdb_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'mm_mdb_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+        lines.append("# HELP mm_mdb_stage_quantile_seconds Percentiles of the time taken to reach each stage.")
+        lines.append("# TYPE mm_mdb_stage_quantile_seconds gauge")
+        for stage, histogram in self.histograms.items():
+            for percentile in (50, 95, 99):
+                value = histogram.percentile(percentile)
+                if value is not None:
+                    lines.append(f'mm_mdb_stage_quantile_seconds{{stage="{stage}",quantile="{percentile / 100}"}} {value}')
+
+        lines.append("# HELP mm_mdb_queue_depth Number of events waiting in each command queue.")
+        lines.append("# TYPE mm_mdb_queue_depth gauge")
+        for name, depth in self.queue_depths().items():
+            lines.append(f'mm_mdb_queue_depth{{queue="{name}"}} {depth}')
+
+        lines.append("# HELP mm_mdb_queue_shed_total Events dropped from each queue because they expired or it was full.")
+        lines.append("# TYPE mm_mdb_queue_shed_total counter")
+        for name, shed in self.queue_shed().items():
+            for reason, count in shed.items():
+                lines.append(f'mm_mdb_queue_shed_total{{queue="{name}",reason="{reason}"}} {count}')
+
+        usage = resource_usage()
+        lines.append("# HELP mm_mdb_threads Number of threads the process is running.")
+        lines.append("# TYPE mm_mdb_threads gauge")
+        lines.append(f"mm_mdb_threads {usage['threads']}")
+        lines.append("# HELP mm_mdb_resident_memory_bytes Resident memory of the process.")
+        lines.append("# TYPE mm_mdb_resident_memory_bytes gauge")
+        lines.append(f"mm_mdb_resident_memory_bytes {usage['rss_bytes']}")
+
+        return "\n".join(lines) + "\n"
+
+
+vend_metrics = VendMetrics()
+
+
+def start_metrics_server(port: int, metrics: VendMetrics = vend_metrics):
+    """
+    Serves the metrics in the Prometheus text format on localhost from a daemon thread.
+    """
+
+    # only imported when the server's enabled, it's slow to import on a Pi
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+
+            body = metrics.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics_server", daemon=True).start()
+    logger.info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+    return server
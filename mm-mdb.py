@@ -2,175 +2,439 @@ import mm as mm_library
 import config
 
 import threading
-import netifaces
+from concurrent.futures import ThreadPoolExecutor
 import websocket
-from websocket import WebSocket, WebSocketConnectionClosedException
+from websocket import WebSocket
 import logging
+import os
 import time
 from queue import Queue
+from event_queue import DeadlineQueue, STOP
+import pigpio
 import pymultidropbus
-import pywiegandpi
+import wiegand
 import pymultidropbus.protocol as protocol
 import pymultidropbus.protocol.peripherals.Cashless as Cashless
-
-logging.basicConfig()
+from reconnect import ReconnectBackoff
+from metrics import vend_metrics, start_metrics_server
+from vend_session import VendSession
+from machine import Machine, load_machines
+from mdb_frames import ResponseFrames, send_frame
+from flight_recorder import flight_recorder, EVENT_MDB, EVENT_WIEGAND
+from mm_logging import setup_logging, console_handler
+import event_trace
+import scheduling
+import device_identity
+from startup import StartupTimeline
+from supervisor import Supervisor, ResourceBudget
+from sales_ledger import OUTCOME_SUCCESS, OUTCOME_FAILURE, OUTCOME_DENIED, OUTCOME_CANCELLED, FLAG_LOCAL_APPROVAL, FLAG_CHARGED
+
+logging.basicConfig(handlers=[console_handler()])
 logger = logging.getLogger("mm-mdb")
-logger.setLevel(config.MDB_LOG_LEVEL)
+logger.setLevel(config.MM_LOG_LEVEL)
+
+
+interface_name = None
+mdb_bus_held = False  # a peripheral from the last run couldn't be stopped, so we can't restart without exiting
+ip_address = ""
+serial_number = ""
+PORTAL_WS_URL = ""
+
+
+def load_device_identity():
+    # done at startup rather than import time so the command handlers can be imported on any machine, and we don't
+    # need an IP address yet, we often don't have one straight after boot
+    global interface_name, ip_address, serial_number, PORTAL_WS_URL
+    interface_name = device_identity.get_interface()
+    serial_number = device_identity.get_serial_number(interface_name)
+    ip_address = device_identity.get_ip_address(interface_name)
+    logger.info(f"Device serial: {serial_number} (from {interface_name})")
+    logger.info(f"Device IP: {ip_address or 'not assigned yet'}")
+
+    PORTAL_WS_URL = config.PORTAL_WS_URL + serial_number
+
+
+# the VMC stops waiting for our reply to these after MDB_MAX_RESPONSE_TIME and asks again, so a late one is worse
+# than none. Everything else changes the reader's state and is always handled.
+TIMED_MDB_COMMANDS = (
+    Cashless.MdbCommand.VEND_REQUEST,
+    Cashless.MdbCommand.SETUP_CONFIG_DATA,
+    Cashless.MdbCommand.EXPANSION_REQUEST_ID,
+)
 
 
-interface_name = 'wlan0'
-mac_address = str(netifaces.ifaddresses(interface_name)[netifaces.AF_LINK][0]['addr'])
-ip_address = str(netifaces.ifaddresses(interface_name)[netifaces.AF_INET][0]['addr'])
-serial_number = mac_address.replace(':', '')
-logger.info("Device serial: " + serial_number)
-logger.info("Device IP: " + ip_address)
+def mdb_event_deadline(command: protocol.MdbCommandEvent) -> float:
+    return config.MDB_MAX_RESPONSE_TIME if command.command in TIMED_MDB_COMMANDS else None
 
-PORTAL_WS_URL = config.PORTAL_WS_URL + serial_number
 
-CURRENT_SESSION_CARD_ID: str = ""
+def ws_event_deadline(command: dict) -> float:
+    # a debit result is never dropped, it's the only record of whether the member was charged
+    return config.BALANCE_RESULT_MAX_AGE if command.get("command") == "BALANCE_RESULT" else None
+
+
+def command_queue_options(machine: Machine) -> tuple:
+    """
+    Returns the DeadlineQueue keyword arguments for a machine's MDB and ws command queues.
+    """
+
+    def on_mdb_event_expired(command: protocol.MdbCommandEvent, age: float):
+        logger.warning(f"Dropped {command.command} for {machine.name}, the VMC stopped waiting for it {age:.3f}s ago.")
+        flight_recorder.dump("mdb_event_expired")
+
+    def on_ws_event_expired(command: dict, age: float):
+        card_id = command.get("data", {}).get("card_id")
+        logger.warning(f"Dropped {command.get('command')} for card {card_id} on {machine.name} after {age:.3f}s.")
+        session = machine.current_session
+        if session is not None and not session.active and session.card_id == card_id:
+            # the tap is too old to start a session from now, the member can tap again
+            machine.current_session = None
+
+    return (
+        {
+            "name": machine.queue_name("mdb_commands_queue"),
+            "max_size": config.MDB_COMMANDS_QUEUE_SIZE,
+            "deadline_for": mdb_event_deadline,
+            "on_expired": on_mdb_event_expired,
+        },
+        {
+            "name": machine.queue_name("ws_commands_queue"),
+            "max_size": config.WS_COMMANDS_QUEUE_SIZE,
+            "deadline_for": ws_event_deadline,
+            "on_expired": on_ws_event_expired,
+        },
+    )
 
 
 class WsCommandQueueThread(threading.Thread):
-    def __init__(self, queue: Queue, mm_client: mm_library.MM, mdb_client: pymultidropbus.CashlessPeripheral):
+    def __init__(self, queue: Queue, mm_client: mm_library.MM, mdb_client: pymultidropbus.CashlessPeripheral, machine: Machine):
         super().__init__()
         self._stop_event = threading.Event()
         self.queue = queue
         self.mm = mm_client
         self.mdb = mdb_client
+        self.machine = machine
 
     def stop(self):
         self._stop_event.set()
+        # wake the thread up if it's waiting on an empty queue
+        self.queue.put(STOP)
 
     def stopped(self):
         return self._stop_event.is_set()
 
     def run(self):
-        global CURRENT_SESSION_CARD_ID
+        scheduling.apply_role("commands")
         while self._stop_event.is_set() is False:
             command = self.queue.get()
-            logger.debug(command)
-
-            if command.get("command") == "BALANCE_RESULT":
-                success = command.get("data").get("success")
-
-                if success:
-                    balance_cents = int(command.get("data").get("balance"))
-                    logger.debug("Balance request successful: " + str(balance_cents))
-                    self.mdb.start_cashless_session(balance_cents)
+            if command is STOP:
+                break
+            self.handle_command(command)
+
+    def handle_command(self, command):
+        machine = self.machine
+        logger.debug(command)
+
+        if command.get("command") == "BALANCE_RESULT":
+            success = command.get("data").get("success")
+            card_id = command.get("data").get("card_id")
+            cached = command.get("data").get("cached")
+            session = machine.current_session
+
+            if session is None or card_id != session.card_id:
+                logger.debug("Ignoring balance result for card %s as it's not the current card.", card_id)
+
+            elif session.active:
+                # the session was already started from the cached balance, so just bring the running balance up to
+                # date, the debits are still authoritative
+                if not success:
+                    logger.warning("Balance refresh failed for a session started from the cache, no longer approving vends locally!")
+                    session.refresh_failed()
                 else:
-                    logger.warning("Balance request failed!")
-                    CURRENT_SESSION_CARD_ID = ""
-
-            if command.get("command") == "DEBIT_RESULT":
-                success = command.get("data").get("success")
-                # balance_dollars = float(command.get("data").get("balance"))
-                # balance_cents = int(balance_dollars * 100)  # convert dollars to cents
-                amount = command.get("data").get("amount") or 0
-
-                if success:
-                    self.mdb.approve_vend(amount)
-                else:
-                    self.mdb.deny_vend()
+                    balance_cents = int(command.get("data").get("balance"))
+                    if balance_cents != session.start_balance:
+                        logger.info("Cached balance was out of date, refreshed from the portal.")
+                    session.reconcile(balance_cents)
+
+            elif success:
+                balance_cents = int(command.get("data").get("balance"))
+                logger.debug("Cached balance: %s" if cached else "Balance request successful: %s", balance_cents)
+                # hold off garbage collection until the session's over so it can't delay a reply to the VMC
+                scheduling.gc_guard.hold(machine.name)
+                self.mdb.start_cashless_session(balance_cents)
+                vend_metrics.stage("session_started", machine.device_id)
+                session.start(balance_cents)
+            else:
+                logger.warning("Balance request failed!")
+                machine.current_session = None
+
+        if command.get("command") == "DEBIT_RESULT":
+            success = command.get("data").get("success")
+            # balance_dollars = float(command.get("data").get("balance"))
+            # balance_cents = int(balance_dollars * 100)  # convert dollars to cents
+            amount = command.get("data").get("amount") or 0
+            request_id = command.get("data").get("request_id")
+
+            if request_id in machine.settling_debits:
+                # a vend we already approved locally, the item has been dispensed so there's nothing to tell the VMC
+                session, settled_amount = machine.settling_debits.pop(request_id)
+                session.settle(settled_amount, success, command.get("data").get("balance"))
+                if not success:
+                    logger.error(f"Portal refused the debit for a vend approved locally for card {session.card_id}!")
+                return
+
+            with machine.current_vend_lock:
+                abandoned_vend = machine.abandoned_debits.pop(request_id, None)
+                if abandoned_vend is None:
+                    if request_id != machine.current_vend_request_id:
+                        logger.warning("Ignoring debit result that isn't for the current vend.")
+                        return
+                    machine.current_vend_request_id = ""
+
+            session = machine.current_session
+            if abandoned_vend is None and session is None:
+                # the session ended some other way while we waited on the portal
+                abandoned_vend = machine.current_vend
+                machine.current_vend = None
+
+            if abandoned_vend is not None:
+                # the VMC gave up on the vend while we waited on the portal, so there's nothing left to approve
+                logger.info(f"Debit {request_id} of {amount} cents finished after the VMC gave up on its vend.")
+                charged = bool(success) and self.mm.reverse_debit(command.get("data"), machine.device_id)
+                machine.record_sale(OUTCOME_CANCELLED, command.get("data").get("card_id"), FLAG_CHARGED if charged else 0, abandoned_vend)
+                if charged:
+                    flight_recorder.dump("debit_after_session")
+                return
+
+            if success:
+                self.mdb.approve_vend(amount)
+                vend_metrics.stage("vend_approved", machine.device_id)
+            else:
+                self.mdb.deny_vend()
+                vend_metrics.stage("vend_denied", machine.device_id)
+                machine.record_sale(OUTCOME_DENIED, session.card_id)
 
 
 class CommandQueueThread(threading.Thread):
-    def __init__(self, queue: Queue, mm_client: mm_library.MM, mdb_client: pymultidropbus.CashlessPeripheral):
+    def __init__(self, queue: Queue, mm_client: mm_library.MM, mdb_client: pymultidropbus.CashlessPeripheral, machine: Machine, response_frames: ResponseFrames = None):
         super().__init__()
         self._stop_event = threading.Event()
         self.queue = queue
         self.mm = mm_client
         self.mdb = mdb_client
+        self.machine = machine
+        self.response_frames = response_frames or ResponseFrames.from_config(serial_number)
 
     def stop(self):
         self._stop_event.set()
+        # wake the thread up if it's waiting on an empty queue
+        self.queue.put(STOP)
 
     def stopped(self):
         return self._stop_event.is_set()
 
     def run(self):
-        global CURRENT_SESSION_CARD_ID
+        scheduling.apply_role("commands")
         while self._stop_event.is_set() is False:
-            command: protocol.MdbCommandEvent = self.queue.get()
-            logger.debug("Got command: " + str(command.command))
-
-            if command.command == Cashless.MdbCommand.SETUP_CONFIG_DATA:
-                # reader config data
-                self.mdb._send_cmd("01 01 10 36 01 02 07 0D")  # TODO: make this a function and not a call to _send_cmd
-
-            elif command.command == Cashless.MdbCommand.SETUP_PRICE_DATA:
-                min_price = command.min_price
-                max_price = command.max_price
-                logger.debug(f"Got min price: {min_price} and max price: {max_price}")
-                # ack already sent
-
-            elif command.command == Cashless.MdbCommand.EXPANSION_REQUEST_ID:
-                manufacturer_code = command.manufacturer_code
-                vmc_serial_number = command.serial_number
-                model_number = command.model_number
-                software_version = command.software_version
-                logger.debug(f"Got expansion request id: {manufacturer_code}, {vmc_serial_number}, {model_number}, {software_version}")
-
-                # reader peripheral id data
-                # TODO: document and generate this dynamically
-                self.mdb._send_cmd(
-                    "09 42 4D 53 30 30 30 30 30 30 30 30 30 30 30 31 30 30 30 30 30 30 30 30 30 30 30 31 01 01")
-
-            elif command.command == Cashless.MdbCommand.RESET:
-                logger.info("Cashless reader reset!")
-
-            elif command.command == Cashless.MdbCommand.READER_DISABLE:
-                # ack already sent
-                logger.info("Cashless reader disabled!")
-
-            elif command.command == Cashless.MdbCommand.READER_ENABLE:
-                # ack already sent
-                # self.mdb.start_cashless_session(420)
-                logger.info("Cashless reader enabled!")
-
-            if command.command == Cashless.MdbCommand.VEND_REQUEST:
-                # ack already sent
-                item_price = command.item_price
-                item_number = command.item_number
-
-                if not item_price:
-                    logger.warning("Item price not provided!")
-                    item_price = 0
-
-                if not item_number:
-                    logger.warning("Item number not provided!")
-
-                logger.debug(f"Got vend request for item {item_number} with price {item_price} cents")
-
-                rfid_card_number = CURRENT_SESSION_CARD_ID
-                self.mm.send_debit_request(item_price, rfid_card_number, item_number)
-
-            elif command.command == Cashless.MdbCommand.VEND_CANCEL:
-                # deny_vend() already sent
-                logger.debug("Vend cancelled!")
-
-            elif command.command == Cashless.MdbCommand.VEND_SUCCESS:
-                # ack already sent
-                item_number = command.item_number
-                logger.info(f"Vend success for item {item_number}")
-
-            elif command.command == Cashless.MdbCommand.VEND_FAILURE:
-                # TODO: handle refunds
-                logger.warning("Vend failure!")
-                refund_success = True
-                if refund_success:
-                    self.mdb.send_ack()
-                else:
-                    self.mdb.send_ack()
-                    # TODO: send MALFUNCTION ERROR code 1100yyyy
+            command = self.queue.get()
+            if command is STOP:
+                break
+            self.handle_command(command)
+
+    def debit_timeout(self) -> float:
+        # the VMC's response time started when the vend request arrived, not when we got to it
+        received_at = getattr(self.queue, "last_received_at", None)
+        if received_at is None:
+            return None
+
+        remaining = config.MDB_MAX_RESPONSE_TIME - config.PORTAL_REQUEST_DEADLINE_MARGIN - (time.monotonic() - received_at)
+        return max(min(self.mm.get_request_timeout(), remaining), 0)
+
+    def handle_command(self, command: protocol.MdbCommandEvent):
+        machine = self.machine
+        logger.debug("Got command: %s", command.command)
+        flight_recorder.record(EVENT_MDB, str(command.command))
+        if event_trace.recorder is not None:
+            event_trace.recorder.record_mdb(command, machine.device_id)
+
+        if command.command == Cashless.MdbCommand.SETUP_CONFIG_DATA:
+            # reader config data
+            send_frame(self.mdb, self.response_frames.reader_config)
+
+        elif command.command == Cashless.MdbCommand.SETUP_PRICE_DATA:
+            min_price = command.min_price
+            max_price = command.max_price
+            logger.debug("Got min price: %s and max price: %s", min_price, max_price)
+            # ack already sent
+            if machine.catalog is not None:
+                machine.catalog.set_vmc_price_range(mm_library.money_to_cents(min_price), mm_library.money_to_cents(max_price))
+
+        elif command.command == Cashless.MdbCommand.EXPANSION_REQUEST_ID:
+            manufacturer_code = command.manufacturer_code
+            vmc_serial_number = command.serial_number
+            model_number = command.model_number
+            software_version = command.software_version
+            logger.debug("Got expansion request id: %s, %s, %s, %s", manufacturer_code, vmc_serial_number, model_number, software_version)
+
+            # reader peripheral id data
+            send_frame(self.mdb, self.response_frames.peripheral_id)
+
+        elif command.command == Cashless.MdbCommand.RESET:
+            logger.info("Cashless reader reset!")
+            session = machine.current_session
+            if session is not None:
+                # the VMC forgets its session when it resets the reader, so end ours too or no other card could be used
+                if session.rollback() is not None:
+                    logger.warning("Rolled back a locally approved vend the VMC reset before completing.")
+                machine.current_session = None
+                scheduling.gc_guard.release(machine.name)
+            machine.abandon_debit()
+
+        elif command.command == Cashless.MdbCommand.READER_DISABLE:
+            # ack already sent
+            logger.info("Cashless reader disabled!")
+
+        elif command.command == Cashless.MdbCommand.READER_ENABLE:
+            # ack already sent
+            # self.mdb.start_cashless_session(420)
+            logger.info("Cashless reader enabled!")
+
+        if command.command == Cashless.MdbCommand.VEND_REQUEST:
+            # ack already sent
+            vend_metrics.vend_request(machine.device_id)
+            item_price = command.item_price
+            item_number = command.item_number
+
+            if not item_price:
+                logger.warning("Item price not provided!")
+                item_price = 0
+
+            if not item_number:
+                logger.warning("Item number not provided!")
+
+            logger.debug("Got vend request for item %s with price %s cents", item_number, item_price)
+
+            item_price_cents = mm_library.money_to_cents(item_price)
+            machine.current_vend = (time.time(), item_number, item_price_cents)
+
+            session = machine.current_session
+            if session is None:
+                logger.warning("Got a vend request without a session!")
+                self.mdb.deny_vend()
+                vend_metrics.stage("vend_denied", machine.device_id)
+                machine.record_sale(OUTCOME_DENIED)
+                return
+
+            denial_reason = machine.catalog.check_vend(item_number, item_price_cents, session.balance) if machine.catalog is not None else None
+            if denial_reason:
+                # there's no point asking the portal, and the VMC gets its answer straight away
+                logger.info("Denying vend for item %s locally, %s.", item_number, denial_reason)
+                self.mdb.deny_vend()
+                vend_metrics.stage("vend_denied", machine.device_id)
+                machine.record_sale(OUTCOME_DENIED, session.card_id)
+                return
+
+            # only the portal knows whether the member may buy a restricted product
+            restricted = machine.catalog is not None and machine.catalog.is_restricted(item_number)
+            # while the portal's unreachable a local approval is offline debt, so it has to fit the offline limits too,
+            # otherwise the debit request below decides it against them
+            within_offline_limits = self.mm.connected or self.mm.get_offline_allowance(session.card_id) >= item_price_cents
+            if not restricted and within_offline_limits and session.can_approve_locally(item_price_cents):
+                # the running balance covers it, so approve now and debit the portal once the item is dispensed
+                logger.debug("Approving vend from the session's running balance.")
+                session.reserve(item_price_cents, item_number)
+                self.mdb.approve_vend(item_price_cents)
+                vend_metrics.stage("vend_approved", machine.device_id)
+                return
+
+            rfid_card_number = session.card_id
+            with machine.current_vend_lock:
+                # hold the lock so an offline result can't be handled before we know which request it's for
+                debit_future = self.mm.send_debit_request(item_price, rfid_card_number, item_number, machine.device_id, self.debit_timeout(), not restricted)
+                machine.current_vend_request_id = debit_future.request_id
+
+        elif command.command == Cashless.MdbCommand.VEND_CANCEL:
+            # deny_vend() already sent
+            logger.debug("Vend cancelled!")
+            if not machine.abandon_debit():
+                # otherwise the sale is recorded once the debit result says whether the member was charged
+                session = machine.current_session
+                machine.record_sale(OUTCOME_CANCELLED, session.card_id if session else None)
+
+        elif command.command == Cashless.MdbCommand.VEND_SUCCESS:
+            # ack already sent
+            item_number = command.item_number
+            logger.info("Vend success for item %s", item_number)
+
+            session = machine.current_session
+            settled_vend = session.commit() if session else None
+            machine.record_sale(OUTCOME_SUCCESS, session.card_id if session else None, FLAG_LOCAL_APPROVAL if settled_vend else 0)
+            if settled_vend:
+                settled_amount, settled_item_number = settled_vend
+                debit_future = self.mm.send_settlement_debit(settled_amount, session.card_id, settled_item_number, machine.device_id)
+                machine.settling_debits[debit_future.request_id] = (session, settled_amount)
+
+        elif command.command == Cashless.MdbCommand.VEND_FAILURE:
+            logger.warning("Vend failure!")
+            flight_recorder.dump("vend_failure")
+
+            # a locally approved vend hasn't been debited yet, so we only need to give the running balance back
+            session = machine.current_session
+            rolled_back = session.rollback() if session else None
+            if rolled_back is not None:
+                logger.info("Rolled back locally approved vend.")
+            machine.record_sale(OUTCOME_FAILURE, session.card_id if session else None, FLAG_LOCAL_APPROVAL if rolled_back is not None else 0)
+
+            # TODO: handle refunds for vends that were debited before they were approved
+            refund_success = True
+            if refund_success:
+                self.mdb.send_ack()
+            else:
+                self.mdb.send_ack()
+                # TODO: send MALFUNCTION ERROR code 1100yyyy
+
+        elif command.command == Cashless.MdbCommand.VEND_SESSION_COMPLETE:
+            # reader_session_ended already sent
+            logger.info("Vend session complete!")
+            machine.abandon_debit()
+            machine.current_session = None
+            scheduling.gc_guard.release(machine.name)
+
+        elif command.command == Cashless.MdbCommand.READER_CANCEL:
+            # reader_cancelled already sent
+            logger.debug("Reader cancelled!")
+
+
+class DiskSyncThread(threading.Thread):
+    def __init__(self, mm_object: mm_library.MM):
+        """
+        Forces the debit journal and the sales ledgers to disk every DEBIT_JOURNAL_FSYNC_INTERVAL whether or not the
+        portal is connected, offline is when it matters most. The event trace is flushed too. In asyncio mode sync()
+        is run in the loop's executor instead, so the event loop never waits on the disk.
+        """
+
+        super().__init__()
+        self._stop_event = threading.Event()
+        self.mm = mm_object
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
 
-            elif command.command == Cashless.MdbCommand.VEND_SESSION_COMPLETE:
-                # reader_session_ended already sent
-                logger.info("Vend session complete!")
-                CURRENT_SESSION_CARD_ID = ""
+    def run(self):
+        scheduling.apply_role("logging")
+        while not self._stop_event.wait(config.DEBIT_JOURNAL_FSYNC_INTERVAL):
+            self.sync()
+        self.sync()
 
-            elif command.command == Cashless.MdbCommand.READER_CANCEL:
-                # reader_cancelled already sent
-                logger.debug("Reader cancelled!")
+    def sync(self):
+        if self.mm.debit_journal is not None:
+            self.mm.debit_journal.sync()
+        for sales_ledger in self.mm.sales_ledgers.values():
+            sales_ledger.flush()
+        if event_trace.recorder is not None:
+            event_trace.recorder.flush()
 
 
 class PingThread(threading.Thread):
@@ -178,6 +442,9 @@ class PingThread(threading.Thread):
         super().__init__()
         self._stop_event = threading.Event()
         self.mm = mm_object
+        self.last_metrics_report = time.monotonic()
+        self.last_catalog_sync = time.monotonic()
+        self.last_sales_upload = time.monotonic()
 
         logging.basicConfig(level=config.MM_LOG_LEVEL)
         self.logger = logging.getLogger("mm:ping_thread")
@@ -189,102 +456,431 @@ class PingThread(threading.Thread):
         return self._stop_event.is_set()
 
     def run(self):
-        while not self._stop_event.wait(config.PING_PERIOD):
-            if self.mm.last_pong < time.time() - config.PING_PERIOD * 3:
-                self.logger.warning("Ping thread detected websocket connection failure!")
-                self.mm.ws.close()
+        scheduling.apply_role("network")
+        while not self._stop_event.wait(self.mm.heartbeat.next_check_delay()):
+            self.ping()
 
-            else:
-                self.mm.send_ping()
+    def ping(self):
+        scheduling.gc_guard.check()
 
+        if self.mm.heartbeat.is_dead():
+            self.logger.warning(f"Ping thread detected websocket connection failure, {self.mm.heartbeat.missed_pings} pings in a row got no reply in {self.mm.heartbeat.liveness_timeout():.1f} seconds!")
+            ws = self.mm.ws
+            if ws is not None:
+                ws.close()
 
-if __name__ == "__main__":
-    while True:
-        queue_thread: CommandQueueThread or None = None
-        ws_queue_thread: WsCommandQueueThread or None = None
-        thread_for_ping: PingThread or None = None
+        else:
+            if self.mm.heartbeat.should_ping():
+                self.mm.send_ping()
 
-        try:
-            mdb_commands_queue = Queue()
-            ws_commands_queue = Queue()
-            mdb = pymultidropbus.CashlessPeripheral(mdb_commands_queue, log_level=config.MDB_LOG_LEVEL, process_affinity=config.PROCESS_AFFINITY)
-            mm = mm_library.MM(config.API_SECRET, ip_address, ws_commands_queue, mdb_commands_queue)
-            queue_thread = CommandQueueThread(mdb_commands_queue, mm, mdb)
-            ws_queue_thread = WsCommandQueueThread(ws_commands_queue, mm, mdb)
-            thread_for_ping = PingThread(mm)
-
-            def wiegand_callback(bits: int, value: int):
-                global CURRENT_SESSION_CARD_ID
-                try:
-                    if config.MIN_CARD_SCAN_VALUE and value > config.MIN_CARD_SCAN_VALUE:
-                        CURRENT_SESSION_CARD_ID = str(value)
-                        logger.info("Card scanned: " + CURRENT_SESSION_CARD_ID)
-                        mm.send_balance_request(CURRENT_SESSION_CARD_ID)
-
-                    else:
-                        logger.info("Ignoring card scan with value: " + str(value))
-                        return
-                except WebSocketConnectionClosedException:
-                    logger.warning("Websocket connection closed, will automatically reconnect soon.")
-                    mm.ws.close()
+            if config.METRICS_REPORT_PERIOD and time.monotonic() - self.last_metrics_report >= config.METRICS_REPORT_PERIOD:
+                self.last_metrics_report = time.monotonic()
+                self.mm.send_metrics()
+
+            if config.PRODUCT_CATALOG_SYNC_PERIOD and time.monotonic() - self.last_catalog_sync >= config.PRODUCT_CATALOG_SYNC_PERIOD:
+                self.last_catalog_sync = time.monotonic()
+                self.mm.sync_catalogs()
 
-            wiegand_reader = pywiegandpi.WiegandDecoder(5, 6, wiegand_callback)
+            if config.SALES_LEDGER_UPLOAD_PERIOD and time.monotonic() - self.last_sales_upload >= config.SALES_LEDGER_UPLOAD_PERIOD:
+                self.last_sales_upload = time.monotonic()
+                self.mm.upload_sales()
 
 
-            def ws_on_open(ws: WebSocket) -> None:
-                global thread_for_ping
-                logger.info("MM WS Connected")
-                mm.ws = ws
-                mm.send_authentication()
-                mm.last_pong = time.time()
+class PortalConnectionThread(threading.Thread):
+    def __init__(self, url: str, backoff: ReconnectBackoff, on_open, on_message, on_error, on_close):
+        super().__init__()
+        self._stop_event = threading.Event()
+        self.url = url
+        self.backoff = backoff
+        self.callbacks = {"on_open": on_open, "on_message": on_message, "on_error": on_error, "on_close": on_close}
+        self.websocket_client = None
 
-                # create a new ping thread and start it
-                thread_for_ping = PingThread(mm)
-                thread_for_ping.start()
+    def stop(self):
+        self._stop_event.set()
+        if self.websocket_client:
+            self.websocket_client.close()
 
+    def stopped(self):
+        return self._stop_event.is_set()
 
-            def ws_on_close(ws: WebSocket, status_code, msg) -> None:
-                global CURRENT_SESSION_CARD_ID
-                logger.warning(f"WS Disconnected: {status_code} ({msg or 'no message'})")
-                mdb.serial_port.close()
-                CURRENT_SESSION_CARD_ID = ""
-                time.sleep(5)
-                raise RuntimeError("Websocket connection closed, reconnecting...")
+    def run(self):
+        scheduling.apply_role("network")
+        # only the portal connection is re-established, the MDB peripherals and card readers keep running throughout
+        while not self._stop_event.is_set():
+            self.websocket_client = websocket.WebSocketApp(self.url, **self.callbacks)
+            # websocket-client never pings without a ping_interval, but ping_timeout is also how often it checks whether
+            # it's been closed, so stop() doesn't have to wait the default 10 seconds
+            self.websocket_client.run_forever(ping_timeout=1)
+
+            if not self._stop_event.is_set():
+                delay = self.backoff.next_delay()
+                logger.warning(f"Reconnecting to the portal in {delay:.1f} seconds.")
+                self._stop_event.wait(delay)
+
+
+def make_wiegand_callback(mm: mm_library.MM, machine: Machine):
+    def wiegand_callback(bits: int, value: int):
+        flight_recorder.record(EVENT_WIEGAND, f"{machine.name} {bits} {value}")
+        if event_trace.recorder is not None:
+            event_trace.recorder.record_wiegand(bits, value, machine.device_id)
+        if config.MIN_CARD_SCAN_VALUE and value > config.MIN_CARD_SCAN_VALUE:
+            card_id = str(value)
+            if machine.is_repeat_tap(card_id, config.REPEAT_TAP_WINDOW):
+                logger.debug("Ignoring repeat scan of card: %s", card_id)
+                return
+
+            session = machine.current_session
+            if session is not None and session.active:
+                # replacing a started session would lose its running balance and any vend reserved against it,
+                # the member has to finish the session on the VMC before another card can be used
+                logger.info("Ignoring scan of card %s during the session for card %s.", card_id, session.card_id)
+                return
+
+            logger.info("Card scanned: %s", card_id)
+            if not mm.connected and mm.get_offline_allowance(card_id) <= 0:
+                # checked before asking for the balance, so a cached result it queues can't start a session we then drop
+                logger.warning("Portal is temporarily unavailable, not starting a session.")
+                machine.current_session = None
+                return
+
+            vend_metrics.tap(machine.device_id)
+            # a locally approved vend is dispensed before it's debited, so it needs the journal to be sure it's charged
+            exposure_cap = config.OPTIMISTIC_VEND_EXPOSURE_CAP if mm.debit_journal is not None else 0
+            machine.current_session = VendSession(card_id, exposure_cap)
+            mm.request_balance(card_id, machine.device_id)
+
+        else:
+            logger.info("Ignoring card scan with value: %s", value)
+            return
+
+    return wiegand_callback
+
+
+def create_card_reader(pi: pigpio.pi, mm: mm_library.MM, machine: Machine):
+    args = (pi, machine.wiegand_d0, machine.wiegand_d1, make_wiegand_callback(mm, machine))
+    kwargs = {
+        "formats": config.WIEGAND_FORMATS,
+        "min_bit_interval": config.WIEGAND_MIN_BIT_INTERVAL,
+        "values": config.WIEGAND_CARD_VALUES,
+    }
+
+    if config.WIEGAND_CAPTURE_MODE == "notify":
+        try:
+            return wiegand.NotifyDecoder(*args, **kwargs)
+        except OSError as e:
+            # the notification pipe is only available when pigpiod is running on this Pi
+            logger.warning(f"Couldn't open the pigpio notification pipe ({e}), reading cards with callbacks instead.")
+
+    return wiegand.Decoder(*args, **kwargs)
+
+
+def make_reconnect_backoff() -> ReconnectBackoff:
+    return ReconnectBackoff(
+        config.RECONNECT_FIRST_DELAY,
+        config.RECONNECT_BASE_DELAY,
+        config.RECONNECT_MAX_DELAY,
+        config.RECONNECT_RESET_AFTER,
+    )
+
+
+def create_peripheral(machine: Machine, mdb_commands_queue) -> pymultidropbus.CashlessPeripheral:
+    kwargs = {"com_port": machine.serial_port} if machine.serial_port else {}
+    # the peripheral starts its own bus servicing thread, which inherits the mdb role's real time scheduling
+    with scheduling.inherited_role("mdb"):
+        return pymultidropbus.CashlessPeripheral(mdb_commands_queue, log_level=config.MDB_LOG_LEVEL, process_affinity=config.PROCESS_AFFINITY, **kwargs)
+
+
+def stop_machines(machines: list, pi: pigpio.pi = None):
+    """
+    Releases what the last run set up, so a restart doesn't leave pigpio callbacks and MDB bus threads behind.
+    """
+
+    global mdb_bus_held
+
+    for machine in machines:
+        if machine.sales_ledger is not None:
+            machine.sales_ledger.flush()
+        if machine.wiegand_reader is not None:
+            machine.wiegand_reader.cancel()
+            machine.wiegand_reader = None
+        if machine.mdb is not None:
+            # not every pymultidropbus release can be stopped, then only exiting releases the serial port
+            stop_peripheral = getattr(machine.mdb, "stop", None)
+            if stop_peripheral is not None:
+                stop_peripheral()
+            else:
+                logger.warning(f"Couldn't stop the MDB peripheral for {machine.name}.")
+                mdb_bus_held = True
+            machine.mdb = None
+    if pi is not None:
+        pi.stop()
+
+
+def exit_for_restart(listener):
+    """
+    Exits so the service manager starts us again, for when restarting in process can't release what we're holding.
+    """
+
+    logger.error("Exiting to be restarted by the service manager.")
+    if event_trace.recorder is not None:
+        event_trace.recorder.close()
+    listener.stop()
+    # a peripheral that couldn't be stopped may still have threads running that sys.exit() would wait on forever
+    os._exit(1)
+
+
+def run_threaded(timeline: StartupTimeline, budget: ResourceBudget = None):
+    machines: list = []
+    mm: mm_library.MM or None = None
+    pi_future = None
+    supervisor = Supervisor(budget, config.SUPERVISOR_CHECK_PERIOD, config.SUPERVISOR_MAX_RESTARTS,
+                            config.SUPERVISOR_RESTART_WINDOW, config.SUPERVISOR_JOIN_TIMEOUT)
+
+    try:
+        with timeline.timed("load machines"):
+            machines = load_machines()
+        response_frames = ResponseFrames.from_config(serial_number)
+        # every machine shares the one portal connection and balance cache, results are routed back by device id
+        with timeline.timed("portal client"):
+            mm = mm_library.MM(config.API_SECRET, ip_address, None, None)
+        vend_metrics.register_queue("ws_send_queue", mm.writer)
+        timeline.require("portal connected", *(f"{machine.name} ready" for machine in machines))
+
+        machine_queues = []
+        for machine in machines:
+            mdb_queue_options, ws_queue_options = command_queue_options(machine)
+            mdb_commands_queue = DeadlineQueue(**mdb_queue_options)
+            ws_commands_queue = DeadlineQueue(**ws_queue_options)
+            mm.register_device(machine.device_id, ws_commands_queue, machine.catalog, machine.sales_ledger)
+            vend_metrics.register_queue(machine.queue_name("mdb_commands_queue"), mdb_commands_queue)
+            vend_metrics.register_queue(machine.queue_name("ws_commands_queue"), ws_commands_queue)
+            machine_queues.append((machine, mdb_commands_queue, ws_commands_queue))
+
+        backoff = make_reconnect_backoff()
+
+
+        def ws_on_open(ws: WebSocket) -> None:
+            logger.info("MM WS Connected")
+            timeline.mark("portal connected")
+            backoff.connected()
+            mm.ws = ws
+            # we may not have had an address when we started
+            mm.ip_address = device_identity.get_ip_address(interface_name)
+            mm.send_authentication()
+            mm.heartbeat.connected()
+
+            # one ping thread per connection, starting it stops the last connection's if it's still running
+            supervisor.start_worker("ping", lambda: PingThread(mm))
+
+
+        def ws_on_close(ws: WebSocket, status_code, msg) -> None:
+            logger.warning(f"WS Disconnected: {status_code} ({msg or 'no message'})")
+            supervisor.stop_worker("ping")
+            mm.ws_on_close()
+
+        def ws_on_error(ws, error) -> None:
+            logger.error(f"WS Error: {error}")
+
+
+        def ws_on_message(ws: WebSocket, message: str):
+            logger.debug("Got message: %s", message)
+            mm.ws_on_message(ws, message)
+
+
+        def start_machine(machine: Machine, mdb_commands_queue: Queue, ws_commands_queue: Queue, pi_future):
+            machine.mdb = mdb = timeline.call(f"{machine.name} mdb", create_peripheral, machine, mdb_commands_queue)
+            supervisor.start_worker(machine.queue_name("mdb_commands"), lambda: CommandQueueThread(mdb_commands_queue, mm, mdb, machine, response_frames))
+            supervisor.start_worker(machine.queue_name("ws_commands"), lambda: WsCommandQueueThread(ws_commands_queue, mm, mdb, machine))
+
+            machine.wiegand_reader = create_card_reader(pi_future.result(), mm, machine)
+            timeline.mark(f"{machine.name} ready")
+
+
+        # connect to the portal while the MDB peripherals and pigpio start up, after a power cut every machine in
+        # the building is doing the same thing
+        supervisor.start()
+        supervisor.start_worker("disk_sync", lambda: DiskSyncThread(mm))
+        supervisor.start_worker("websocket", lambda: PortalConnectionThread(PORTAL_WS_URL, backoff, ws_on_open, ws_on_message, ws_on_error, ws_on_close))
+
+        with ThreadPoolExecutor(max_workers=len(machines) + 1, thread_name_prefix="startup") as executor:
+            pi_future = executor.submit(timeline.call, "pigpio", pigpio.pi)
+            machine_futures = [executor.submit(start_machine, *queues, pi_future) for queues in machine_queues]
+            for future in machine_futures:
+                future.result()
+
+        scheduling.tune_gc()
+        supervisor.restart_requested.wait()
+
+    except Exception as e:
+        logger.error(f"Unhandled exception in the main thread: {e}")
+        logger.error(str(e))
+
+    try:
+        supervisor.stop_all()
+        if mm and mm.writer:
+            mm.writer.stop()
+            mm.writer.join(config.SUPERVISOR_JOIN_TIMEOUT)
+        pi = pi_future.result() if pi_future is not None and pi_future.done() and not pi_future.exception() else None
+        stop_machines(machines, pi)
+    except Exception as e:
+        logger.error(f"Exception stopping threads: {e}")
+
+
+async def run_asyncio(timeline: StartupTimeline, budget: ResourceBudget = None):
+    """
+    Runs the MDB and websocket command handlers, the pings and the portal connection as tasks on one event loop.
+    The MDB peripherals and the Wiegand decoders still call back from their own threads, their events are handed to
+    the loop with call_soon_threadsafe.
+    """
+
+    import asyncio
+    import mm_async
+
+    loop = asyncio.get_running_loop()
+    tasks = []
+    ping_task: asyncio.Task or None = None
+
+    with timeline.timed("load machines"):
+        machines = load_machines()
+    response_frames = ResponseFrames.from_config(serial_number)
+    # sends on the event loop never block the caller, so there's no need for a separate writer thread
+    with timeline.timed("portal client"):
+        mm = mm_library.MM(config.API_SECRET, ip_address, None, None, use_writer=False)
+    pinger = PingThread(mm)
+    disk_sync = DiskSyncThread(mm)
+    backoff = make_reconnect_backoff()
+    timeline.require("portal connected", *(f"{machine.name} ready" for machine in machines))
+
+    machine_queues = []
+    for machine in machines:
+        mdb_queue_options, ws_queue_options = command_queue_options(machine)
+        mdb_commands_queue = mm_async.ThreadSafeQueue(loop, **mdb_queue_options)
+        ws_commands_queue = mm_async.ThreadSafeQueue(loop, **ws_queue_options)
+        mm.register_device(machine.device_id, ws_commands_queue, machine.catalog, machine.sales_ledger)
+        vend_metrics.register_queue(machine.queue_name("mdb_commands_queue"), mdb_commands_queue)
+        vend_metrics.register_queue(machine.queue_name("ws_commands_queue"), ws_commands_queue)
+        machine_queues.append((machine, mdb_commands_queue, ws_commands_queue))
+
+    def ws_on_open(ws) -> None:
+        nonlocal ping_task
+        logger.info("MM WS Connected")
+        timeline.mark("portal connected")
+        backoff.connected()
+        mm.ws = ws
+        # we may not have had an address when we started
+        mm.ip_address = device_identity.get_ip_address(interface_name)
+        mm.send_authentication()
+        mm.heartbeat.connected()
+
+        # one ping task per connection, it's cancelled when the connection closes
+        if ping_task:
+            ping_task.cancel()
+        ping_task = loop.create_task(mm_async.run_periodically(mm.heartbeat.next_check_delay, pinger.ping))
+
+    def ws_on_close(ws, status_code, msg) -> None:
+        logger.warning(f"WS Disconnected: {status_code} ({msg or 'no message'})")
+        if ping_task:
+            ping_task.cancel()
+        mm.ws_on_close()
+
+    def ws_on_error(ws, error) -> None:
+        logger.error(f"WS Error: {error}")
+
+    def ws_on_message(ws, message: str):
+        logger.debug("Got message: %s", message)
+        mm.ws_on_message(ws, message)
+
+    async def connect_forever():
+        # only the portal connection is re-established, the MDB peripherals and card readers keep running throughout
+        while True:
+            await mm_async.run_websocket(PORTAL_WS_URL, ws_on_open, ws_on_message, ws_on_close, ws_on_error)
+
+            delay = backoff.next_delay()
+            logger.warning(f"Reconnecting to the portal in {delay:.1f} seconds.")
+            await asyncio.sleep(delay)
+
+    pi_future = loop.run_in_executor(None, timeline.call, "pigpio", pigpio.pi)
+
+    async def start_machine(machine: Machine, mdb_commands_queue, ws_commands_queue):
+        machine.mdb = mdb = await loop.run_in_executor(None, timeline.call, f"{machine.name} mdb", create_peripheral, machine, mdb_commands_queue)
+        command_handler = CommandQueueThread(mdb_commands_queue, mm, mdb, machine, response_frames)
+        ws_command_handler = WsCommandQueueThread(ws_commands_queue, mm, mdb, machine)
+        tasks.append(loop.create_task(mm_async.run_queue_worker(mdb_commands_queue, command_handler.handle_command)))
+        tasks.append(loop.create_task(mm_async.run_queue_worker(ws_commands_queue, ws_command_handler.handle_command)))
+
+        machine.wiegand_reader = create_card_reader(await pi_future, mm, machine)
+        timeline.mark(f"{machine.name} ready")
+
+    # connect to the portal while the MDB peripherals and pigpio start up, after a power cut every machine in the
+    # building is doing the same thing
+    connection_task = loop.create_task(connect_forever())
+    tasks.append(connection_task)
+    tasks.append(loop.create_task(mm_async.run_periodically(config.DEBIT_JOURNAL_FSYNC_INTERVAL, disk_sync.sync, in_executor=True)))
+
+    restart_requested = asyncio.Event()
+
+    def check_budget():
+        if budget.check():
+            restart_requested.set()
+
+    if budget is not None:
+        tasks.append(loop.create_task(mm_async.run_periodically(config.SUPERVISOR_CHECK_PERIOD, check_budget)))
+    restart_task = loop.create_task(restart_requested.wait())
+    tasks.append(restart_task)
+
+    # the event loop runs the command handlers as well as the websocket
+    scheduling.apply_role("commands")
+
+    try:
+        await asyncio.gather(*(start_machine(*queues) for queues in machine_queues))
+        scheduling.tune_gc()
+        await asyncio.wait((connection_task, restart_task), return_when=asyncio.FIRST_COMPLETED)
+        if connection_task.done():
+            connection_task.result()
+    finally:
+        logger.warning("Stopping event loop tasks")
+        if ping_task:
+            tasks.append(ping_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        disk_sync.sync()
+        stop_machines(machines, pi_future.result() if pi_future.done() and not pi_future.exception() else None)
 
-            def ws_on_error(ws, error) -> None:
-                logger.error(f"WS Error: {error}")
 
+if __name__ == "__main__":
+    timeline = StartupTimeline()
+    log_listener = setup_logging()
+    timeline.mark("logging")
+    timeline.call("device identity", load_device_identity)
 
-            def ws_on_message(ws: WebSocket, message: str):
-                logger.debug("Got message: " + message)
-                mm.ws_on_message(ws, message)
+    if config.EVENT_TRACE_PATH:
+        event_trace.start(config.EVENT_TRACE_PATH, config.EVENT_TRACE_MAX_BYTES, config.EVENT_TRACE_KEEP)
 
+    if config.METRICS_PORT:
+        start_metrics_server(config.METRICS_PORT)
 
-            websocket_client = websocket.WebSocketApp(PORTAL_WS_URL,
-                                                      on_open=ws_on_open,
-                                                      on_message=ws_on_message,
-                                                      on_error=ws_on_error,
-                                                      on_close=ws_on_close)
+    if config.JITTER_MONITOR_INTERVAL:
+        scheduling.JitterMonitor(config.JITTER_MONITOR_INTERVAL).start()
 
-            queue_thread.start()
-            ws_queue_thread.start()
+    # the budget outlives the restarts, so growth from one run to the next is caught
+    budget = ResourceBudget.from_config()
 
-            websocket_client.run_forever()
-            logger.warning("Exiting main thread")
-            queue_thread.stop()
-            ws_queue_thread.stop()
-            thread_for_ping.stop()
+    while True:
+        if config.RUNTIME_MODE == "asyncio":
+            import asyncio
 
-        except Exception as e:
-            logger.error(f"Unhandled exception in the main thread: {e}")
-            logger.error(str(e))
             try:
-                if queue_thread:
-                    queue_thread.stop()
-                if ws_queue_thread:
-                    ws_queue_thread.stop()
-                if thread_for_ping:
-                    thread_for_ping.stop()
+                asyncio.run(run_asyncio(timeline, budget))
             except Exception as e:
-                logger.error(f"Exception stopping threads: {e}")
-            continue
+                logger.error(f"Unhandled exception in the event loop: {e}")
+
+        else:
+            run_threaded(timeline, budget)
+
+        if budget.exit_requested or mdb_bus_held:
+            exit_for_restart(log_listener)
+        time.sleep(5)
+
+        # a restart after an error is timed from when it restarts
+        timeline = StartupTimeline(time.monotonic())
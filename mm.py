@@ -1,16 +1,27 @@
-import json
 import config
+import json_codec
 import logging
 import time
 import threading
 from queue import Queue
 from websocket import WebSocketApp, WebSocket, WebSocketConnectionClosedException
 import pymultidropbus.protocol
+from balance_cache import BalanceCache
+from debit_journal import DebitJournal
+from pending_requests import PendingRequests, PendingRequest
+from metrics import vend_metrics
+from flight_recorder import flight_recorder, EVENT_WS_IN, EVENT_WS_OUT
+from mm_logging import console_handler
+import event_trace
+from product_catalog import ProductCatalog
+from sales_ledger import SalesLedger
+from heartbeat import Heartbeat, RttEstimator
+from ws_writer import WebSocketWriter, PRIORITY_CRITICAL, PRIORITY_BALANCE, PRIORITY_HEARTBEAT, PRIORITY_TELEMETRY
 
 # This is meant to be a more generic implementation of the MM websocket protocol that will hopefully one day be used
 # across both the mm-mdb code and the beepbeep-mainboard firmware code.
 
-logging.basicConfig()
+logging.basicConfig(handlers=[console_handler()])
 logger = logging.getLogger("mm")
 logger.setLevel(config.MM_LOG_LEVEL)
 
@@ -22,11 +33,32 @@ def build_packet(command: str, data=None) -> str:
         "command": command,
         **data
     }
-    command_packet = json.dumps(command_object)
-    logger.debug(f"Built command:\n{command_packet}")
+    command_packet = json_codec.dumps(command_object)
+    logger.debug("Built command:\n%s", command_packet)
     return command_packet
 
 
+# commands for the other device roles that share this protocol, a door or interlock registers its own handlers for them
+DOOR_COMMANDS = ("bump", "sync", "unlock", "lock")
+INTERLOCK_COMMANDS = ("interlock_session_start", "interlock_session_rejected", "interlock_session_update")
+
+
+def redact_secrets(message: str) -> str:
+    # the authenticate packet carries the device's API secret, which mustn't end up in a trace or flight recorder dump
+    # copied off the device
+    if '"secret_key"' not in message:
+        return message
+    command_object = json_codec.loads(message)
+    command_object["secret_key"] = "REDACTED"
+    return json_codec.dumps(command_object)
+
+
+def money_to_cents(amount) -> int:
+    if isinstance(amount, int):
+        return amount
+    return round(amount.dollars * 100)
+
+
 def get_command_object(command: str, data: object = None):
     return {
         "command": command,
@@ -35,121 +67,317 @@ def get_command_object(command: str, data: object = None):
 
 
 class MM:
-    def __init__(self, websocket_secret: str, ip_address: str, ws_command_queue: Queue, mdb_command_queue: Queue):
+    def __init__(self, websocket_secret: str, ip_address: str, ws_command_queue: Queue, mdb_command_queue: Queue, use_writer: bool = True):
         logger.debug("Initializing MM module")
         self.ws: WebSocket = None
         self.api_secret = websocket_secret
         self.ip_address = ip_address
         self.ws_command_queue = ws_command_queue
         self.mdb_command_queue = mdb_command_queue
-        self.last_pong = 0
+        self.device_command_queues = {}  # device id -> ws command queue, for machines sharing this connection
+        self.catalogs = {}  # device id -> product catalog
+        self.sales_ledgers = {}  # device id -> sales ledger
+        self.heartbeat = Heartbeat(
+            config.PING_PERIOD,
+            config.HEARTBEAT_MAX_PING_PERIOD,
+            config.HEARTBEAT_MIN_TIMEOUT,
+            config.PING_PERIOD * 3,
+            config.HEARTBEAT_MISSED_PINGS,
+        )
+        # how long the portal takes to answer balance and debit requests, the upper bound leaves enough of the VMC's
+        # response time to deny the vend
+        self.request_rtt = RttEstimator(
+            config.REQUEST_MIN_TIMEOUT,
+            max(config.MDB_MAX_RESPONSE_TIME - config.PORTAL_REQUEST_DEADLINE_MARGIN, 0.5),
+        )
         self.device_locked_out = False
+        # the portal's command packets are dispatched by command name, see register_handler()
+        self.command_handlers = {
+            "pong": self._on_pong,
+            "ping": self._on_ping,
+            "reboot": self._on_reboot,
+            "update_device_locked_out": self._on_update_device_locked_out,
+            "balance": self._on_balance,
+            "debit": self._on_debit,
+            "products": self._on_products,
+            "sales_batch": self._on_sales_batch,
+            "debit_batch": self._on_debit_batch,
+        }
+        for command in DOOR_COMMANDS:
+            self.command_handlers[command] = self._ignore_other_role("a door")
+        for command in INTERLOCK_COMMANDS:
+            self.command_handlers[command] = self._ignore_other_role("an interlock")
+        self.balance_cache = BalanceCache(config.BALANCE_CACHE_SIZE, config.BALANCE_CACHE_TTL) if config.BALANCE_CACHE_ENABLED else None
+        self.pending_requests = PendingRequests(self._on_request_expired)
+        self.writer: WebSocketWriter = None
+        if use_writer:
+            self.writer = WebSocketWriter(self._ws_send_now, config.WS_WRITER_QUEUE_SIZE)
+            self.writer.start()
+        self.debit_journal = DebitJournal(
+            config.DEBIT_JOURNAL_PATH,
+            config.DEBIT_JOURNAL_FSYNC_INTERVAL,
+            config.DEBIT_JOURNAL_FSYNC_BATCH_SIZE,
+            config.DEBIT_JOURNAL_COMPACT_AFTER,
+        ) if config.DEBIT_JOURNAL_ENABLED else None
+
+    def register_device(self, device_id: str, ws_command_queue: Queue, catalog: ProductCatalog = None, sales_ledger: SalesLedger = None):
+        """
+        Routes results for requests made on behalf of device_id to its own ws command queue, so several machines can
+        share one portal connection.
+        """
+
+        self.device_command_queues[device_id] = ws_command_queue
+        if catalog is not None:
+            self.catalogs[device_id] = catalog
+        if sales_ledger is not None:
+            self.sales_ledgers[device_id] = sales_ledger
+
+    def _get_command_queue(self, device_id: str = None) -> Queue:
+        return self.device_command_queues.get(device_id, self.ws_command_queue)
+
+    def _ws_send(self, message: str, priority: int = PRIORITY_CRITICAL, coalesce_key: str = None, on_failed=None):
+        # on_failed(superseded) is called if the message is never sent, see WebSocketWriter
+        if self.writer is not None:
+            self.writer.send(message, priority, coalesce_key, on_failed)
+            return
 
-    def _ws_send(self, message: str):
-        if self.ws:
-            self.ws.send(message)
+        try:
+            self._ws_send_now(message, on_failed)
+        except Exception as e:
+            logger.warning(f"Failed to send websocket message: {e}")
+            if on_failed is not None:
+                on_failed(False)
+
+    def _ws_send_now(self, message: str, on_failed=None):
+        recorded_message = redact_secrets(message)
+        flight_recorder.record(EVENT_WS_OUT, recorded_message)
+        if event_trace.recorder is not None:
+            event_trace.recorder.record(EVENT_WS_OUT, recorded_message)
+        if not self.ws:
+            raise WebSocketConnectionClosedException("no websocket connection")
+        if on_failed is not None and getattr(self.ws, "reports_send_errors", False):
+            # an asyncio connection sends later on the event loop, so it reports a failed send itself
+            self.ws.send(message, on_failed)
         else:
-            logger.warning(f"Tried to send message but no websocket connection! {message}")
+            self.ws.send(message)
+
+    @property
+    def connected(self) -> bool:
+        return self.ws is not None
+
+    def ws_on_close(self):
+        self.ws = None
+        flight_recorder.dump("disconnect")
+        for sales_ledger in self.sales_ledgers.values():
+            sales_ledger.upload_failed()
+        if self.writer is not None:
+            self.writer.clear()
+        # no replies can arrive now, so decide any in flight requests locally before the VMC gives up on them
+        self.pending_requests.expire_all()
+        if self.debit_journal is not None:
+            self.debit_journal.abandon_online()
+
+    def register_handler(self, command: str, handler):
+        """
+        Handles the portal's command packets with handler(command_object) from now on. A door or interlock sharing
+        this protocol registers handlers for its own commands here, they're ignored by default.
+        """
+
+        self.command_handlers[command] = handler
+
+    def _ignore_other_role(self, role: str):
+        def handler(command_object: dict):
+            # we can safely ignore this command, it's for another kind of device
+            logger.debug("Received %s request but not %s!", command_object.get("command"), role)
+
+        return handler
 
     def ws_on_message(self, ws: WebSocket, message: str) -> None:
+        flight_recorder.record(EVENT_WS_IN, message)
+        if event_trace.recorder is not None:
+            event_trace.recorder.record(EVENT_WS_IN, message)
+        self.heartbeat.message_received()
         try:
-            command_object = json.loads(message)
+            command_object = json_codec.loads(message)
 
             if command_object.get("authorised") is not None:
-                logger.info("Got authorisation packet.")
-                self.send_ip()
-
-            elif command_object.get("command") == "pong":
-                logger.debug("Got pong packet.")
-                self.last_pong = time.time()
-
-            elif command_object.get("command") == "ping":
-                logger.debug("Got ping packet.")
-                self.send_pong()
-
-            elif command_object.get("command") == "reboot":
-                logger.warning("Rebooting device!")
-                import os
-                os.system('sudo shutdown -r now')
-
-            elif command_object.get("command") == "update_device_locked_out":
-                locked_out = command_object.get("locked_out")
-                logger.info(f"Updating device locked out to {locked_out}!")
-                self.device_locked_out = locked_out
-
-            elif command_object.get("command") == "bump":
-                # we can safely ignore this command if we're not a door
-                logger.debug("Received bump request but not a door!")
-
-            elif command_object.get("command") == "sync":
-                # we can safely ignore this command if we're not a door
-                logger.debug("Received sync request but not a door!")
-
-            elif command_object.get("command") == "unlock":
-                # we can safely ignore this command if we're not a door
-                logger.debug("Received unlock request but not a door!")
-
-            elif command_object.get("command") == "lock":
-                # we can safely ignore this command if we're not a door
-                logger.debug("Received lock request but not a door!")
-
-            elif command_object.get("command") == "interlock_session_start":
-                # we can safely ignore this command if we're not an interlock
-                logger.debug("Received interlock session_start request but not an interlock!")
-
-            elif command_object.get("command") == "interlock_session_rejected":
-                # we can safely ignore this command if we're not an interlock
-                logger.debug("Received interlock session_rejected request but not an interlock!")
-
-            elif command_object.get("command") == "interlock_session_update":
-                # we can safely ignore this command if we're not an interlock
-                logger.debug("Received interlock session_update request but not an interlock!")
-
-            elif command_object.get("command") == "balance":
-                logger.debug("Received balance: " + json.dumps(command_object))
-                success = command_object.get("success", True)
-                balance = command_object.get("balance")
-
-                success_string = "successful" if success else "unsuccessful"
-                balance_string = (
-                    f"${str(balance/100)}"
-                    if balance
-                    else "Unknown"
-                )
-                logger.info(f"Balance request was {success_string}, balance is {balance_string}.")
-
-                data = {
-                    "success": success,
-                    "balance": balance,
-                }
-                self.ws_command_queue.put(get_command_object("BALANCE_RESULT", data))
-
-            elif command_object.get("command") == "debit":
-                logger.debug("Received debit request: " + json.dumps(command_object))
-                success = command_object.get("success")
-                balance = command_object.get("balance")
+                self._on_authorised(command_object)
 
-                success_string = "successful" if success else "unsuccessful"
-                balance_string = (
-                    f"${str(balance/100)}"
-                    if balance
-                    else "Unknown"
-                )
-                logger.info(f"Debit was {success_string}, balance remaining is {balance_string}.")
-
-                data = {
-                    "success": success,
-                    "balance": balance,
-                }
-                self.ws_command_queue.put(get_command_object("DEBIT_RESULT", data))
             else:
-                logger.warning("Unknown websocket packet!")
-                logger.warning(command_object)
+                handler = self.command_handlers.get(command_object.get("command"))
+                if handler is None:
+                    logger.warning("Unknown websocket packet!")
+                    logger.warning(command_object)
+                else:
+                    handler(command_object)
 
         except Exception as e:
             logger.error("Error parsing JSON websocket packet: " + message)
             logger.error(str(e))
 
+    def _on_authorised(self, command_object: dict):
+        logger.info("Got authorisation packet.")
+        self.send_ip()
+        self.replay_debit_journal()
+        self.sync_catalogs()
+        self.upload_sales()
+
+    def _on_pong(self, command_object: dict):
+        logger.debug("Got pong packet.")
+        rtt = self.heartbeat.pong_received(command_object.get("seq"))
+        if rtt is not None:
+            vend_metrics.observe("portal_ping_rtt", rtt)
+
+    def _on_ping(self, command_object: dict):
+        logger.debug("Got ping packet.")
+        self.send_pong(command_object)
+
+    def _on_reboot(self, command_object: dict):
+        logger.warning("Rebooting device!")
+        import os
+        os.system('sudo shutdown -r now')
+
+    def _on_update_device_locked_out(self, command_object: dict):
+        locked_out = command_object.get("locked_out")
+        logger.info(f"Updating device locked out to {locked_out}!")
+        self.device_locked_out = locked_out
+
+    def _on_balance(self, command_object: dict):
+        logger.debug("Received balance: %s", command_object)
+        success = command_object.get("success", True)
+        balance = command_object.get("balance")
+
+        success_string = "successful" if success else "unsuccessful"
+        balance_string = (
+            f"${str(balance/100)}"
+            if balance
+            else "Unknown"
+        )
+        logger.info("Balance request was %s, balance is %s.", success_string, balance_string)
+
+        request = self._pop_request_for_reply("balance", command_object)
+        if request is None:
+            logger.warning("Ignoring balance reply that doesn't match a pending request.")
+
+        else:
+            vend_metrics.stage("balance_reply", request.device_id)
+            vend_metrics.observe("portal_balance_rtt", time.monotonic() - request.sent_at)
+            self.request_rtt.observe(time.monotonic() - request.sent_at)
+
+            if self.balance_cache is not None:
+                if success and balance is not None:
+                    self.balance_cache.put(request.card_id, balance)
+                else:
+                    self.balance_cache.invalidate(request.card_id)
+
+            data = {
+                "success": success,
+                "balance": balance,
+                "card_id": request.card_id,
+                "cached": False,
+            }
+            self._complete_request(request, "BALANCE_RESULT", data)
+
+    def _on_debit(self, command_object: dict):
+        logger.debug("Received debit request: %s", command_object)
+        success = command_object.get("success")
+        balance = command_object.get("balance")
+
+        success_string = "successful" if success else "unsuccessful"
+        balance_string = (
+            f"${str(balance/100)}"
+            if balance
+            else "Unknown"
+        )
+        logger.info("Debit was %s, balance remaining is %s.", success_string, balance_string)
+
+        request = self._pop_request_for_reply("debit", command_object)
+        if request is None:
+            # the vend was already approved or denied locally when the request expired
+            logger.warning(f"Got a late {success_string} debit reply, the vend was already handled locally!")
+            self._on_late_debit(command_object)
+
+        else:
+            vend_metrics.stage("debit_reply", request.device_id)
+            vend_metrics.observe("portal_debit_rtt", time.monotonic() - request.sent_at)
+            self.request_rtt.observe(time.monotonic() - request.sent_at)
+
+            if self.debit_journal is not None:
+                self.debit_journal.settle(request.idempotency_key)
+
+            if self.balance_cache is not None:
+                # the cached balance is stale after a debit, only keep the portal's post-debit balance
+                self.balance_cache.invalidate(request.card_id)
+                if success and balance is not None:
+                    self.balance_cache.put(request.card_id, balance)
+
+            data = {
+                "success": success,
+                "balance": balance,
+                "amount": request.amount_cents,
+                "card_id": request.card_id,
+            }
+            self._complete_request(request, "DEBIT_RESULT", data)
+
+    def _on_late_debit(self, command_object: dict):
+        """
+        Reconciles the portal's answer to a debit with what we decided locally when it didn't answer in time, using
+        the decision kept in the journal.
+        """
+
+        key = command_object.get("idempotency_key")
+        record = self.debit_journal.get(key) if self.debit_journal is not None and key else None
+        if record is None:
+            return
+
+        success = command_object.get("success")
+        if record.get("denied") and success:
+            # the member was charged for a vend the VMC was told to deny
+            self.reverse_debit({"card_id": record["card_id"], "amount": record["amount"], "request_id": command_object.get("request_id")}, record.get("device_id"))
+            self.debit_journal.settle(key)
+
+        elif record.get("offline") and not success:
+            # the item's been dispensed, so it can only be recovered from the member by the operator
+            logger.error(f"Portal refused a debit of {record['amount']} cents for card_id: {record['card_id']} that was approved offline!")
+            self.debit_journal.mark_unpaid(key)
+
+        else:
+            self.debit_journal.settle(key)
+
+    def _on_products(self, command_object: dict):
+        catalog = self.catalogs.get(command_object.get("device_id"))
+        if catalog is None:
+            logger.warning(f"Ignoring product catalog for unknown device: {command_object.get('device_id')}")
+        else:
+            catalog.apply_update(
+                command_object.get("products") or [],
+                command_object.get("removed"),
+                command_object.get("version"),
+                command_object.get("full", False),
+            )
+
+    def _on_sales_batch(self, command_object: dict):
+        device_id = command_object.get("device_id")
+        sales_ledger = self.sales_ledgers.get(device_id)
+        if sales_ledger is None:
+            logger.warning(f"Ignoring sales batch acknowledgement for unknown device: {device_id}")
+        else:
+            logger.debug("Portal acknowledged sales up to %s.", command_object.get("last_sequence"))
+            sales_ledger.acknowledge(int(command_object.get("last_sequence")))
+            # keep going until the backlog is uploaded
+            self._upload_sales(device_id, sales_ledger)
+
+    def _on_debit_batch(self, command_object: dict):
+        results = command_object.get("results") or []
+        logger.info(f"Portal processed {len(results)} replayed offline debits.")
+
+        if self.debit_journal is not None:
+            for result in results:
+                if not result.get("success"):
+                    logger.warning(f"Portal rejected offline debit {result.get('idempotency_key')}!")
+                self.debit_journal.settle(result.get("idempotency_key"))
+            self.debit_journal.compact()
+
     def send_authentication(self):
         logger.debug("Sending authentication packet")
         auth_packet = build_packet("authenticate", {"secret_key": self.api_secret})
@@ -158,31 +386,359 @@ class MM:
     def send_ip(self):
         logger.debug("Sending IP packet")
         ip_packet = build_packet("ip_address", {"ip_address": self.ip_address})
-        self._ws_send(ip_packet)
+        self._ws_send(ip_packet, PRIORITY_TELEMETRY)
 
     def send_ping(self):
         logger.debug("Sending ping packet")
-        self._ws_send(build_packet("ping"))
+        # a newer ping replaces one that hasn't been sent yet, its pong acknowledges the older one too
+        self._ws_send(build_packet("ping", self.heartbeat.next_ping()), PRIORITY_HEARTBEAT, "ping")
 
-    def send_pong(self):
+    def send_pong(self, ping_object: dict = None):
         logger.debug("Sending pong packet")
-        self._ws_send(build_packet("pong"))
+        # echo the portal's sequence number and timestamp so it can measure the round trip too
+        echo = {key: ping_object[key] for key in ("seq", "sent_at") if ping_object and key in ping_object}
+        self._ws_send(build_packet("pong", echo), PRIORITY_HEARTBEAT, "pong")
 
-    def send_debit_request(self, amount: pymultidropbus.protocol.Money, card_id: str, item_number: int = None):
-        logger.info(f"Sending debit request for {amount} cents.")
+    def get_request_timeout(self) -> float:
+        """
+        Returns how long to wait for the portal to reply, from how long it's been taking to answer requests. It's
+        never more than leaves enough of the VMC's response time to deny the vend.
+        """
+
+        return self.request_rtt.timeout()
+
+    def _pop_request_for_reply(self, command: str, command_object: dict):
+        request_id = command_object.get("request_id")
+        if request_id:
+            return self.pending_requests.pop(request_id)
+
+        # older portals don't echo the request id, so fall back to the oldest request they're replying to
+        return self.pending_requests.pop_oldest(command, command_object.get("device_id"))
+
+    def _complete_request(self, request: PendingRequest, result_command: str, data: dict):
+        data["request_id"] = request.request_id
+        request.future.set_result(data)
+        self._get_command_queue(request.device_id).put(get_command_object(result_command, data))
+
+    def _on_request_expired(self, request: PendingRequest):
+        if self.ws:
+            # the portal is slower than we estimated, wait longer next time (requests expired by a disconnect aren't)
+            self.request_rtt.timed_out()
+
+        logger.warning(f"{request.command.capitalize()} request {request.request_id} timed out.")
+        self._decide_locally(request)
+
+    def _request_send_failed(self, request_id: str, superseded: bool):
+        if superseded:
+            # a newer balance request for the same machine replaced it before it was sent, so nothing's waiting on it
+            self.pending_requests.cancel(request_id)
+            return
+
+        request = self.pending_requests.pop(request_id)
+        if request is not None:
+            logger.warning(f"Couldn't send {request.command} request {request.request_id}.")
+            self._decide_locally(request)
+
+    def _decide_locally(self, request: PendingRequest):
+        # the portal won't answer the request, so complete it without waiting any longer
+        if request.command == "debit":
+            self.send_offline_debit(request)
+
+        elif request.command == "settle":
+            self.defer_settlement_debit(request)
+
+        else:
+            data = {
+                "success": False,
+                "balance": None,
+                "card_id": request.card_id,
+                "cached": False,
+                "timeout": True,
+            }
+            self._complete_request(request, "BALANCE_RESULT", data)
+
+    def sync_catalogs(self):
+        """
+        Asks the portal for the products that changed since each catalog's version (or all of them if we don't have
+        a version yet).
+        """
+
+        for device_id, catalog in self.catalogs.items():
+            logger.debug("Sending product catalog request")
+            command_object = {"since": catalog.version}
+            if device_id:
+                command_object["device_id"] = device_id
+            self._ws_send(build_packet("products", command_object), PRIORITY_TELEMETRY, f"products:{device_id}")
+
+    def upload_sales(self):
+        for device_id, sales_ledger in self.sales_ledgers.items():
+            self._upload_sales(device_id, sales_ledger)
+
+    def _upload_sales(self, device_id: str, sales_ledger: SalesLedger):
+        if not self.ws:
+            return
+
+        batch = sales_ledger.next_upload_batch(config.SALES_LEDGER_UPLOAD_BATCH_SIZE)
+        if batch is None:
+            return
+
+        logger.debug("Uploading %s sales.", batch["count"])
+        if device_id:
+            batch["device_id"] = device_id
+        self._ws_send(build_packet("sales_batch", batch), PRIORITY_TELEMETRY)
+
+    def send_metrics(self):
+        logger.debug("Sending metrics packet")
+        metrics = {
+            **vend_metrics.summary(),
+            "rtt": {
+                "ping": self.heartbeat.rtt.snapshot(),
+                "requests": self.request_rtt.snapshot(),
+            },
+            "refunds_due": len(self.debit_journal.refunds_due()) if self.debit_journal is not None else 0,
+            "unpaid_debits": len(self.debit_journal.unpaid_debits()) if self.debit_journal is not None else 0,
+        }
+        self._ws_send(build_packet("metrics", metrics), PRIORITY_TELEMETRY, "metrics")
+
+    def send_debit_request(self, amount: pymultidropbus.protocol.Money, card_id: str, item_number: int = None, device_id: str = None,
+                           timeout: float = None, allow_offline: bool = True):
+        """
+        Sends a debit request and returns a future that resolves with the DEBIT_RESULT data, which is also put on the
+        ws command queue. The future's request_id is echoed back in the result so stale replies can be ignored.
+        timeout overrides how long to wait for the portal before deciding the debit locally, and without
+        allow_offline it's denied then.
+        """
+
+        amount_cents = money_to_cents(amount)
+        logger.info("Sending debit request for %s cents.", amount_cents)
+
+        # always journal the debit first so it can't be lost if the connection drops
+        key = None
+        if self.debit_journal is not None:
+            key = self.debit_journal.append_debit(card_id, amount_cents, item_number, device_id=device_id)
+
+        timeout = self.get_request_timeout() if timeout is None else timeout
+        request = self.pending_requests.add("debit", card_id, timeout, key, amount_cents, device_id, allow_offline)
         debit_object = {
             "card_id": card_id,
-            "amount": amount.dollars,  # api expects dollars
+            "amount": amount_cents / 100,  # api expects dollars
+            "request_id": request.request_id,
         }
         if item_number:
             debit_object["product_external_id"] = item_number
+        if key:
+            debit_object["idempotency_key"] = key
+        if device_id:
+            debit_object["device_id"] = device_id
         debit_packet = build_packet("debit", debit_object)
-        self._ws_send(debit_packet)
 
-    def send_balance_request(self, card_id: str):
-        logger.info(f"Sending balance request for card_id: {card_id}.")
+        if self.ws:
+            self._ws_send(debit_packet, on_failed=lambda superseded: self._request_send_failed(request.request_id, superseded))
+            vend_metrics.stage("debit_request_sent", device_id)
+        elif self.pending_requests.pop(request.request_id) is not None:
+            self.send_offline_debit(request)
+        return request.future
+
+    def send_settlement_debit(self, amount_cents: int, card_id: str, item_number: int = None, device_id: str = None):
+        """
+        Debits a vend that was approved locally and has already been dispensed, so it must never be denied here. It's
+        journalled as an offline debit before it's sent, and if the portal doesn't answer it's left in the journal to
+        be replayed with the other offline debits. Returns a future like send_debit_request. Vends are only approved
+        locally with the debit journal enabled.
+        """
+
+        logger.info("Sending settlement debit for %s cents.", amount_cents)
+        key = self.debit_journal.append_debit(card_id, amount_cents, item_number, offline=True, device_id=device_id)
+        request = self.pending_requests.add("settle", card_id, self.get_request_timeout(), key, amount_cents, device_id)
+        debit_object = {
+            "card_id": card_id,
+            "amount": amount_cents / 100,  # api expects dollars
+            "request_id": request.request_id,
+            "idempotency_key": key,
+        }
+        if item_number:
+            debit_object["product_external_id"] = item_number
+        if device_id:
+            debit_object["device_id"] = device_id
+
+        if self.ws:
+            self._ws_send(build_packet("debit", debit_object), on_failed=lambda superseded: self._request_send_failed(request.request_id, superseded))
+        elif self.pending_requests.pop(request.request_id) is not None:
+            self.defer_settlement_debit(request)
+        return request.future
+
+    def defer_settlement_debit(self, request: PendingRequest):
+        logger.warning(f"Settlement debit {request.request_id} wasn't answered, it'll be replayed with the offline debits.")
+        if (self.debit_journal.offline_total(request.card_id) > config.OFFLINE_CARD_LIMIT
+                or self.debit_journal.offline_total() > config.OFFLINE_TOTAL_LIMIT):
+            # the item's already been dispensed, so it's still owed, but the approval shouldn't have been local
+            logger.error(f"Offline debits for card_id: {request.card_id} are over the offline limits.")
+        # the debit stays in the journal until the portal processes it, so as far as the session is concerned it's done
+        data = {
+            "success": True,
+            "balance": None,
+            "amount": request.amount_cents,
+            "offline": True,
+        }
+        self._complete_request(request, "DEBIT_RESULT", data)
+
+    def get_offline_allowance(self, card_id: str) -> int:
+        """
+        Returns how many cents this card can still spend before the portal is reachable again.
+        """
+
+        if self.debit_journal is None or not config.OFFLINE_CARD_LIMIT or not config.OFFLINE_TOTAL_LIMIT:
+            return 0
+
+        allowance = min(
+            config.OFFLINE_CARD_LIMIT - self.debit_journal.offline_total(card_id),
+            config.OFFLINE_TOTAL_LIMIT - self.debit_journal.offline_total(),
+        )
+
+        cached_balance = self.get_cached_balance(card_id)
+        if cached_balance is not None:
+            allowance = min(allowance, cached_balance)
+
+        return max(allowance, 0)
+
+    def send_offline_debit(self, request: PendingRequest):
+        """
+        Approves or denies a debit locally while the portal is unreachable. Approved debits stay in the journal and
+        are replayed to the portal once we reconnect.
+        """
+
+        card_id = request.card_id
+        amount_cents = request.amount_cents
+        key = request.idempotency_key
+        success = key is not None and request.allow_offline and amount_cents <= self.get_offline_allowance(card_id)
+        balance = None
+
+        if success:
+            logger.warning(f"Approved offline debit of {amount_cents} cents for card_id: {card_id}.")
+            self.debit_journal.mark_offline(key)
+
+            cached_balance = self.get_cached_balance(card_id)
+            if cached_balance is not None:
+                balance = cached_balance - amount_cents
+                self.balance_cache.put(card_id, balance)
+        else:
+            logger.warning(f"Denied offline debit of {amount_cents} cents for card_id: {card_id}.")
+            if key is not None:
+                # kept until the connection closes in case the portal's answer turns up late
+                self.debit_journal.mark_denied(key)
+
+        data = {
+            "success": success,
+            "balance": balance,
+            "amount": amount_cents,
+            "card_id": card_id,
+            "offline": True,
+            "idempotency_key": key,
+        }
+        self._complete_request(request, "DEBIT_RESULT", data)
+
+    def reverse_debit(self, result: dict, device_id: str = None) -> bool:
+        """
+        Undoes a debit that went through for a vend the VMC gave up on, so nothing was dispensed. One approved
+        offline hasn't reached the portal yet, so it's dropped from the journal before it's replayed. The portal has
+        no reversal, so one it took is journalled as a refund that's due and counted in the metrics. Returns True if
+        the member was charged.
+        """
+
+        card_id = result.get("card_id")
+        amount_cents = result.get("amount")
+        key = result.get("idempotency_key")
+        if result.get("offline") and key and self.debit_journal is not None:
+            logger.warning(f"Dropped offline debit of {amount_cents} cents for card_id: {card_id}, its vend was never dispensed.")
+            self.debit_journal.settle(key)
+            return False
+
+        logger.error(f"Card_id: {card_id} was charged {amount_cents} cents for a vend that was never dispensed and is owed a refund!")
+        if self.debit_journal is not None:
+            self.debit_journal.append_refund(card_id, amount_cents, result.get("request_id"), device_id)
+        return True
+
+    def replay_debit_journal(self):
+        if self.debit_journal is None:
+            return
+
+        debits = self.debit_journal.offline_debits()
+        if not debits:
+            return
+
+        logger.info(f"Replaying {len(debits)} offline debits to the portal.")
+        batch = []
+        for debit in debits:
+            replayed_debit = {
+                "idempotency_key": debit["key"],
+                "card_id": debit["card_id"],
+                "amount": debit["amount"] / 100,  # api expects dollars
+                "product_external_id": debit["product_external_id"],
+                "timestamp": debit["timestamp"],
+            }
+            if debit.get("device_id"):
+                replayed_debit["device_id"] = debit["device_id"]
+            batch.append(replayed_debit)
+        self._ws_send(build_packet("debit_batch", {"debits": batch}))
+
+    def send_balance_request(self, card_id: str, device_id: str = None):
+        """
+        Sends a balance request and returns a future that resolves with the BALANCE_RESULT data, which is also put on
+        the ws command queue.
+        """
+
+        logger.info("Sending balance request for card_id: %s.", card_id)
+        request = self.pending_requests.add("balance", card_id, self.get_request_timeout(), device_id=device_id)
         command_object = {
             "card_id": card_id,
+            "request_id": request.request_id,
         }
+        if device_id:
+            command_object["device_id"] = device_id
         debit_packet = build_packet("balance", command_object)
-        self._ws_send(debit_packet)
+
+        # a newer tap on the same machine supersedes any balance request that hasn't been sent yet
+        coalesce_key = f"balance:{device_id}" if device_id else "balance"
+        self._ws_send(debit_packet, PRIORITY_BALANCE, coalesce_key, lambda superseded: self._request_send_failed(request.request_id, superseded))
+        vend_metrics.stage("balance_request_sent", device_id)
+
+        return request.future
+
+    def get_cached_balance(self, card_id: str):
+        if self.balance_cache is None:
+            return None
+        return self.balance_cache.get(card_id)
+
+    def request_balance(self, card_id: str, device_id: str = None):
+        """
+        Queues a BALANCE_RESULT straight away if we have a cached balance for this card so the cashless session can
+        start without waiting on the portal, then always asks the portal for the real balance to reconcile against.
+        While the portal is unreachable the session only gets the card's offline allowance, which is never more than
+        its cached balance.
+        """
+
+        if not self.ws:
+            offline_allowance = self.get_offline_allowance(card_id)
+            if offline_allowance:
+                logger.warning(f"No websocket connection, starting an offline session for card_id: {card_id}.")
+                data = {
+                    "success": True,
+                    "balance": offline_allowance,
+                    "card_id": card_id,
+                    "cached": True,
+                }
+                self._get_command_queue(device_id).put(get_command_object("BALANCE_RESULT", data))
+            return None
+
+        cached_balance = self.get_cached_balance(card_id)
+        if cached_balance is not None:
+            logger.debug("Using cached balance of %s cents for card_id: %s.", cached_balance, card_id)
+            data = {
+                "success": True,
+                "balance": cached_balance,
+                "card_id": card_id,
+                "cached": True,
+            }
+            self._get_command_queue(device_id).put(get_command_object("BALANCE_RESULT", data))
+
+        return self.send_balance_request(card_id, device_id)
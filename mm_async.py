@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import threading
+
+import config
+from event_queue import EventBuffer
+
+# Helpers for running mm-mdb on a single asyncio event loop instead of a thread per queue. The websockets package is
+# only needed for this runtime mode (RUNTIME_MODE = "asyncio"), so this module is only imported when it's enabled.
+
+logger = logging.getLogger("mm:async")
+logger.setLevel(config.MM_LOG_LEVEL)
+
+
+class ThreadSafeQueue:
+    def __init__(self, loop: asyncio.AbstractEventLoop, name: str = "queue", max_size: int = 0, deadline_for=None,
+                 on_expired=None):
+        """
+        An asyncio queue that can be fed from other threads (pymultidropbus, pigpio callbacks, timers) with the same
+        put() interface as queue.Queue. It stamps and sheds events like event_queue.DeadlineQueue, the event loop is
+        woken with call_soon_threadsafe.
+        """
+
+        self.loop = loop
+        self._buffer = EventBuffer(name, max_size, deadline_for, on_expired)
+        self._lock = threading.Lock()
+        self._ready = asyncio.Event()
+        self._thread_id = threading.get_ident()  # must be created on the event loop's thread
+
+    @property
+    def name(self) -> str:
+        return self._buffer.name
+
+    @property
+    def expired(self) -> int:
+        return self._buffer.expired
+
+    @property
+    def dropped(self) -> int:
+        return self._buffer.dropped
+
+    @property
+    def last_received_at(self) -> float:
+        return self._buffer.last_received_at
+
+    def put(self, item):
+        with self._lock:
+            self._buffer.push(item)
+        if threading.get_ident() == self._thread_id:
+            self._ready.set()
+        else:
+            self.loop.call_soon_threadsafe(self._ready.set)
+
+    def qsize(self) -> int:
+        return len(self._buffer)
+
+    async def get(self):
+        while True:
+            with self._lock:
+                item, expired = self._buffer.pop()
+                if item is None:
+                    self._ready.clear()
+
+            self._buffer.report_expired(expired)
+            if item is not None:
+                return item
+            await self._ready.wait()
+
+
+class AsyncWebSocket:
+    def __init__(self, loop: asyncio.AbstractEventLoop, connection):
+        """
+        Wraps a websockets connection with the blocking send()/close() interface that MM expects from a
+        websocket.WebSocket. Both just schedule the work on the event loop, so they never block the caller, and a
+        send that fails later is reported to its on_failed callback like a WebSocketWriter would.
+        """
+
+        self.loop = loop
+        self.connection = connection
+        self._thread_id = threading.get_ident()  # must be created on the event loop's thread
+        self._tasks = set()  # the event loop only keeps weak references to its tasks
+        self.reports_send_errors = True  # send() takes an on_failed callback, see MM._ws_send_now()
+
+    def _create_task(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _schedule(self, coroutine):
+        if threading.get_ident() == self._thread_id:
+            self._create_task(coroutine)
+        else:
+            self.loop.call_soon_threadsafe(self._create_task, coroutine)
+
+    async def _send(self, message: str, on_failed=None):
+        try:
+            await self.connection.send(message)
+        except Exception as e:
+            logger.warning(f"Failed to send websocket message: {e}")
+            if on_failed is not None:
+                on_failed(False)
+
+    def send(self, message: str, on_failed=None):
+        self._schedule(self._send(message, on_failed))
+
+    def close(self):
+        self._schedule(self.connection.close())
+
+
+async def run_websocket(url: str, on_open, on_message, on_close, on_error):
+    """
+    Connects to the portal and calls the same callbacks as websocket.WebSocketApp until the connection is closed.
+    """
+
+    import websockets
+
+    loop = asyncio.get_running_loop()
+    compression = "deflate" if config.WS_COMPRESSION else None
+    close_code = None
+    close_reason = None
+
+    try:
+        async with websockets.connect(url, compression=compression, ping_interval=None) as connection:
+            ws = AsyncWebSocket(loop, connection)
+            on_open(ws)
+
+            try:
+                async for message in connection:
+                    on_message(ws, message)
+            finally:
+                close_code = connection.close_code
+                close_reason = connection.close_reason
+
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        on_error(None, e)
+
+    on_close(None, close_code, close_reason)
+
+
+async def run_queue_worker(queue: ThreadSafeQueue, handler):
+    """
+    Hands every item on the queue to the handler until the task is cancelled.
+    """
+
+    while True:
+        command = await queue.get()
+        try:
+            handler(command)
+        except Exception as e:
+            logger.error(f"Unhandled exception handling {command}: {e}")
+
+
+async def run_periodically(period, callback, in_executor: bool = False):
+    # period is either the seconds between calls or a function returning the seconds until the next one, a callback
+    # that blocks (on the disk, say) is run in_executor so it doesn't hold up the event loop
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(period() if callable(period) else period)
+        if in_executor:
+            await loop.run_in_executor(None, callback)
+        else:
+            callback()
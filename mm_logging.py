@@ -0,0 +1,44 @@
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+import config
+import scheduling
+from flight_recorder import flight_recorder, FlightRecorderHandler
+
+
+class ScheduledQueueListener(QueueListener):
+    def _monitor(self):
+        scheduling.apply_role("logging")
+        super()._monitor()
+
+
+def console_handler() -> logging.Handler:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    handler.setLevel(config.CONSOLE_LOG_LEVEL)
+    return handler
+
+
+def setup_logging() -> QueueListener:
+    """
+    Routes every log record through a queue to a listener thread that writes it to stderr, so the threads servicing
+    the MDB bus and the card reader never wait on the console or the SD card. Records are also kept in the flight
+    recorder, which is dumped to disk when an error is logged. The console and the flight recorder each have their
+    own level, so debug messages can be kept in the recorder without flooding the console.
+    """
+
+    log_queue = SimpleQueue()
+    listener = ScheduledQueueListener(log_queue, console_handler(), respect_handler_level=True)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    # filter before queueing too, QueueHandler.prepare() formats every record it's given on the thread that logged it
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.setLevel(config.CONSOLE_LOG_LEVEL)
+    root.addHandler(queue_handler)
+    root.addHandler(FlightRecorderHandler(flight_recorder, config.FLIGHT_RECORDER_LOG_LEVEL))
+
+    listener.start()
+    return listener
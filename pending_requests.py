@@ -0,0 +1,145 @@
+import heapq
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+import config
+
+logger = logging.getLogger("mm:pending_requests")
+logger.setLevel(config.MM_LOG_LEVEL)
+
+
+class RequestFuture(Future):
+    def __init__(self, request_id: str):
+        super().__init__()
+        self.request_id = request_id
+
+
+class PendingRequest:
+    def __init__(self, command: str, card_id: str, timeout: float, idempotency_key: str = None, amount_cents: int = None,
+                 device_id: str = None, allow_offline: bool = True):
+        """
+        A balance or debit request that's waiting on a reply from the portal. The future resolves with the result
+        data that's also put on the ws command queue once the reply arrives or the deadline passes.
+        """
+
+        self.request_id = uuid.uuid4().hex
+        self.command = command
+        self.card_id = card_id
+        self.idempotency_key = idempotency_key
+        self.amount_cents = amount_cents
+        self.device_id = device_id  # the machine the request was made for
+        self.allow_offline = allow_offline  # whether a debit can be approved locally if the portal doesn't answer
+        self.sent_at = time.monotonic()
+        self.deadline = self.sent_at + timeout
+        self.future = RequestFuture(self.request_id)
+
+
+class PendingRequests:
+    def __init__(self, on_expired):
+        """
+        Tracks in flight requests by their request id so replies can be routed to the request that caused them, and
+        calls on_expired(request) for any request that doesn't get a reply before its deadline. The deadlines are kept
+        in a heap watched by a single thread, which is started when a request is added and exits once there's nothing
+        left to wait for.
+        """
+
+        self.on_expired = on_expired
+        self._requests = {}
+        self._deadlines = []  # heap of (deadline, sequence, request id), answered requests are skipped when they come up
+        self._sequence = 0
+        self._thread = None
+        self._condition = threading.Condition()
+
+    def add(self, command: str, card_id: str, timeout: float, idempotency_key: str = None, amount_cents: int = None,
+            device_id: str = None, allow_offline: bool = True) -> PendingRequest:
+        request = PendingRequest(command, card_id, timeout, idempotency_key, amount_cents, device_id, allow_offline)
+
+        with self._condition:
+            self._requests[request.request_id] = request
+            self._sequence += 1
+            heapq.heappush(self._deadlines, (request.deadline, self._sequence, request.request_id))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="request_deadlines", daemon=True)
+                self._thread.start()
+            elif self._deadlines[0][2] == request.request_id:
+                # it's due before whatever the thread is waiting on
+                self._condition.notify()
+
+        return request
+
+    def pop(self, request_id: str):
+        with self._condition:
+            return self._requests.pop(request_id, None)
+
+    def cancel(self, request_id: str):
+        """
+        Forgets a request that nothing is waiting on any more, without a result.
+        """
+
+        request = self.pop(request_id)
+        if request is not None:
+            request.future.cancel()
+
+    def pop_oldest(self, command: str, device_id: str = None):
+        """
+        Pops the oldest request for a command, used for replies from portals that don't echo the request id yet.
+        """
+
+        with self._condition:
+            matching = [
+                request for request in self._requests.values()
+                if request.command == command and (device_id is None or request.device_id == device_id)
+            ]
+            if not matching:
+                return None
+            request = min(matching, key=lambda pending: pending.sent_at)
+            del self._requests[request.request_id]
+
+        return request
+
+    def _next_expired(self):
+        # waits for the earliest deadline, returns None once there's nothing left to wait for
+        with self._condition:
+            while True:
+                while self._deadlines and self._deadlines[0][2] not in self._requests:
+                    heapq.heappop(self._deadlines)
+                if not self._deadlines:
+                    self._thread = None
+                    return None
+
+                deadline, _, request_id = self._deadlines[0]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    heapq.heappop(self._deadlines)
+                    return self._requests.pop(request_id)
+                self._condition.wait(remaining)
+
+    def _run(self):
+        while True:
+            request = self._next_expired()
+            if request is None:
+                return
+
+            try:
+                self.on_expired(request)
+            except Exception as e:
+                logger.error(f"Error handling expired {request.command} request {request.request_id}: {e}")
+
+    def expire_all(self):
+        """
+        Expires every pending request straight away, used when the connection closes and no replies can arrive.
+        """
+
+        with self._condition:
+            requests = list(self._requests.values())
+            self._requests.clear()
+
+        for request in requests:
+            self.on_expired(request)
+
+    def __len__(self):
+        with self._condition:
+            return len(self._requests)
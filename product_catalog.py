@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import threading
+
+import config
+
+logger = logging.getLogger("mm:product_catalog")
+logger.setLevel(config.MM_LOG_LEVEL)
+
+
+class Product:
+    def __init__(self, item_number: int, price: int = None, enabled: bool = True, restrictions: dict = None):
+        self.item_number = item_number
+        self.price = price  # cents, None if the portal doesn't set one
+        self.enabled = enabled
+        # who may buy it, checked by the portal, so a restricted product is never approved without asking it
+        self.restrictions = restrictions or {}
+
+    @classmethod
+    def from_dict(cls, product: dict) -> "Product":
+        return cls(
+            int(product["item_number"]),
+            product.get("price"),
+            product.get("enabled", True),
+            product.get("restrictions"),
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "item_number": self.item_number,
+            "price": self.price,
+            "enabled": self.enabled,
+            "restrictions": self.restrictions,
+        }
+
+
+class ProductCatalog:
+    def __init__(self, path: str = None):
+        """
+        The products a machine sells keyed by MDB item number, synced from the portal so vends for disabled items or
+        that the member obviously can't afford are denied without a round trip. The portal sends the products that
+        changed since the version we have, and the catalog is saved to path (if given) so it survives a restart.
+        """
+
+        self.path = path
+        self.version = None
+        self.products = {}
+        # the price range the VMC reported in its setup price data, in cents
+        self.vmc_min_price = None
+        self.vmc_max_price = None
+        self._lock = threading.Lock()
+
+        if path:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as file:
+                catalog = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable product catalog {self.path}: {e}")
+            return
+
+        self.version = catalog.get("version")
+        self.products = {
+            int(item_number): Product.from_dict(product)
+            for item_number, product in catalog.get("products", {}).items()
+        }
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as file:
+                json.dump({
+                    "version": self.version,
+                    "products": {item_number: product.to_dict() for item_number, product in self.products.items()},
+                }, file)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Couldn't save the product catalog: {e}")
+
+    def apply_update(self, products: list, removed: list = None, version=None, full: bool = False):
+        """
+        Applies an update from the portal. A full update replaces the whole catalog, otherwise only the products
+        listed are replaced and the removed item numbers are dropped.
+        """
+
+        with self._lock:
+            if full:
+                self.products = {}
+            for product in products:
+                product = Product.from_dict(product)
+                self.products[product.item_number] = product
+            for item_number in removed or []:
+                self.products.pop(int(item_number), None)
+            self.version = version
+
+            if self.path:
+                self._save()
+
+        logger.info(f"Product catalog updated to version {version} with {len(self.products)} products.")
+
+    def set_vmc_price_range(self, min_price: int, max_price: int):
+        self.vmc_min_price = min_price
+        self.vmc_max_price = max_price
+
+    def get(self, item_number: int):
+        return self.products.get(item_number)
+
+    def is_restricted(self, item_number: int) -> bool:
+        product = self.get(item_number) if item_number is not None else None
+        return product is not None and bool(product.restrictions)
+
+    def check_vend(self, item_number: int, price: int, balance: int = None):
+        """
+        Returns why a vend should be denied without asking the portal, or None if it's up to the portal. price and
+        balance are in cents, balance is None when we don't know it. Restrictions aren't checked here, see
+        is_restricted().
+        """
+
+        product = self.get(item_number) if item_number is not None else None
+        if product is not None and not product.enabled:
+            return "item is disabled"
+
+        if product is not None and product.price is not None and product.price != price:
+            logger.warning(f"VMC price of {price} cents for item {item_number} doesn't match the catalog price of {product.price} cents.")
+
+        if balance is not None and price > balance:
+            return "price is more than the member's balance"
+
+        return None
+
+    def __len__(self):
+        return len(self.products)
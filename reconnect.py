@@ -0,0 +1,36 @@
+import random
+import time
+
+
+class ReconnectBackoff:
+    def __init__(self, first_delay: float = 0.5, base_delay: float = 2, max_delay: float = 60, reset_after: float = 30):
+        """
+        Works out how long to wait before reconnecting to the portal. The first retry after a connection drops is
+        fast, as most drops are a short Wi-Fi blip, then the delay doubles up to max_delay with jitter so a building
+        full of readers doesn't reconnect in lock step. A connection that stays up for reset_after seconds resets it.
+        """
+
+        self.first_delay = first_delay
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.reset_after = reset_after
+        self.attempt = 0
+        self.connected_at = None
+
+    def connected(self):
+        self.connected_at = time.monotonic()
+
+    def reset(self):
+        self.attempt = 0
+
+    def next_delay(self) -> float:
+        if self.connected_at is not None and time.monotonic() - self.connected_at >= self.reset_after:
+            self.reset()
+        self.connected_at = None
+
+        self.attempt += 1
+        if self.attempt == 1:
+            return self.first_delay
+
+        delay = min(self.base_delay * 2 ** (self.attempt - 2), self.max_delay)
+        return random.uniform(delay / 2, delay)
@@ -0,0 +1,212 @@
+import argparse
+import cProfile
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import defaultdict, deque
+from queue import Queue, Empty
+from types import SimpleNamespace
+
+import config
+import json_codec
+import mm as mm_library
+import pymultidropbus.protocol.peripherals.Cashless as Cashless
+from event_trace import read_trace, EVENT_MDB, EVENT_WS_IN, EVENT_WS_OUT, EVENT_WIEGAND, WIEGAND_PAYLOAD, TRACE_EVENT_NAMES
+from flight_recorder import flight_recorder
+from machine import Machine
+from metrics import Histogram
+from simulator import FakeCashlessPeripheral, mm_mdb
+
+# Replays an event trace recorded with EVENT_TRACE_PATH through the command handlers, at the speed it was recorded
+# or faster, and reports how long each event took to handle. Everything runs on one thread so a replay is
+# repeatable and easy to profile.
+#
+#   python3 replay_trace.py mm-mdb.trace --speed 10 --profile replay.prof
+#
+# The request ids are different each run, so the portal's replies are matched to the replayed requests by sending
+# them with the id of the replayed request that stands in for the recorded one.
+
+
+class RecordingWebSocket:
+    def __init__(self, on_send=None):
+        self.sent = []
+        self.on_send = on_send
+
+    def send(self, message: str):
+        self.sent.append(message)
+        if self.on_send is not None:
+            self.on_send(message)
+
+    def close(self):
+        pass
+
+
+def decode_mdb_command(payload: bytes) -> SimpleNamespace:
+    fields = json_codec.loads(payload)
+    command = Cashless.MdbCommand[fields.pop("command")]
+    return SimpleNamespace(command=command, **fields)
+
+
+def request_key(command_object: dict) -> tuple:
+    return command_object.get("command"), command_object.get("device_id"), command_object.get("card_id")
+
+
+class TraceReplay:
+    def __init__(self, speed: float = 1, on_event=None):
+        """
+        Feeds a trace's MDB commands to CommandQueueThread.handle_command, its websocket messages to MM.ws_on_message
+        and its card scans to the Wiegand callback, then handles any results on the ws command queue before moving on
+        to the next event. speed 0 replays as fast as possible. on_event(offset, event, device_id, seconds) is called
+        after each event with how long it took to handle.
+        """
+
+        self.speed = speed
+        self.on_event = on_event
+
+        # keep the replay's journal, catalogs, ledgers and dumps away from the real ones
+        replay_dir = tempfile.mkdtemp()
+        config.DEBIT_JOURNAL_PATH = os.path.join(replay_dir, "debit_journal.jsonl")
+        config.PRODUCT_CATALOG_PATH = os.path.join(replay_dir, "product_catalog.json")
+        config.SALES_LEDGER_DIR = os.path.join(replay_dir, "sales_ledger")
+        flight_recorder.dump_dir = os.path.join(replay_dir, "flight_recorder")
+
+        self.mm = mm_library.MM(config.API_SECRET, "127.0.0.1", None, None, use_writer=False)
+        self.mm.ws = RecordingWebSocket(self._on_sent)
+        self.mm.heartbeat.connected()
+        self.machines = {}  # device id -> (machine, command handler, ws command handler, ws command queue, wiegand callback)
+
+        self.latency = {name: Histogram() for name in ("mdb", "ws_in", "wiegand")}
+        self.events = []  # (seconds to handle, offset, event name, device id)
+        self.recorded_ws_out = 0
+        # (command, device id, card id) -> recorded request ids not yet stood in for, recorded id -> replayed id
+        self._recorded_requests = defaultdict(deque)
+        self._request_ids = {}
+
+    def _on_sent(self, message: str):
+        command_object = json_codec.loads(message)
+        request_id = command_object.get("request_id")
+        recorded_requests = self._recorded_requests.get(request_key(command_object))
+        if request_id and recorded_requests:
+            self._request_ids[recorded_requests.popleft()] = request_id
+
+    def _remap_request_id(self, payload: bytes) -> str:
+        command_object = json_codec.loads(payload)
+        request_id = self._request_ids.get(command_object.get("request_id"))
+        if request_id is None:
+            # a reply to a request the replay didn't make, it's ignored like any other stale reply
+            return payload.decode("utf-8")
+        command_object["request_id"] = request_id
+        return json_codec.dumps(command_object)
+
+    def _get_machine(self, device_id: str):
+        if device_id not in self.machines:
+            machine = Machine(device_id)
+            ws_commands_queue = Queue()
+            self.mm.register_device(device_id, ws_commands_queue, machine.catalog, machine.sales_ledger)
+            mdb = FakeCashlessPeripheral(Queue())
+            self.machines[device_id] = (
+                machine,
+                mm_mdb.CommandQueueThread(Queue(), self.mm, mdb, machine),
+                mm_mdb.WsCommandQueueThread(ws_commands_queue, self.mm, mdb, machine),
+                ws_commands_queue,
+                mm_mdb.make_wiegand_callback(self.mm, machine),
+            )
+        return self.machines[device_id]
+
+    def _drain_ws_commands(self):
+        for _, _, ws_command_handler, ws_commands_queue, _ in self.machines.values():
+            while True:
+                try:
+                    ws_command_handler.handle_command(ws_commands_queue.get_nowait())
+                except Empty:
+                    break
+
+    def run(self, path: str):
+        events = list(read_trace(path))
+        for _, event, _, payload in events:
+            if event == EVENT_WS_OUT:
+                command_object = json_codec.loads(payload)
+                if command_object.get("request_id"):
+                    self._recorded_requests[request_key(command_object)].append(command_object["request_id"])
+
+        started_at = time.monotonic()
+        for offset, event, device_id, payload in events:
+            if event == EVENT_WS_OUT:
+                # what we sent is what the replay should reproduce, not something to feed back in
+                self.recorded_ws_out += 1
+                continue
+
+            # decode before timing, so only the handlers are measured
+            if event == EVENT_MDB:
+                handler, argument = self._get_machine(device_id)[1].handle_command, decode_mdb_command(payload)
+            elif event == EVENT_WS_IN:
+                handler, argument = lambda message: self.mm.ws_on_message(self.mm.ws, message), self._remap_request_id(payload)
+            elif event == EVENT_WIEGAND:
+                callback = self._get_machine(device_id)[4]
+                handler, argument = lambda value: callback(*value), WIEGAND_PAYLOAD.unpack(payload)
+            else:
+                continue
+
+            if self.speed:
+                time.sleep(max(started_at + offset / self.speed - time.monotonic(), 0))
+
+            handle_started_at = time.perf_counter()
+            handler(argument)
+            self._drain_ws_commands()
+            seconds = time.perf_counter() - handle_started_at
+
+            name = TRACE_EVENT_NAMES[event]
+            self.latency[name].observe(seconds)
+            self.events.append((seconds, offset, name, device_id))
+            if self.on_event is not None:
+                self.on_event(offset, event, device_id, seconds)
+
+        self._drain_ws_commands()
+        self.mm.pending_requests.expire_all()
+        return time.monotonic() - started_at
+
+    def summary(self, elapsed: float, slowest: int = 10) -> dict:
+        return {
+            "events": len(self.events),
+            "replay_seconds": round(elapsed, 3),
+            "ws_out_recorded": self.recorded_ws_out,
+            "ws_out_replayed": len(self.mm.ws.sent),
+            "handling_seconds": {name: histogram.snapshot() for name, histogram in self.latency.items() if histogram.count},
+            "slowest": [
+                {"offset": round(offset, 6), "event": name, "device_id": device_id, "seconds": round(seconds, 6)}
+                for seconds, offset, name, device_id in sorted(self.events, reverse=True, key=lambda event: event[0])[:slowest]
+            ],
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay an mm-mdb event trace through the command handlers.")
+    parser.add_argument("trace", help="trace file recorded with EVENT_TRACE_PATH")
+    parser.add_argument("--speed", type=float, default=1, help="replay speed multiplier (0 replays as fast as possible)")
+    parser.add_argument("--profile", help="write cProfile stats for the replay to this file")
+    parser.add_argument("--slowest", type=int, default=10, help="number of slowest events to list")
+    parser.add_argument("--repeat-tap-window", type=float, default=config.REPEAT_TAP_WINDOW, help="seconds repeat taps of a card are ignored for, match the config of the device the trace came from (simulator traces are recorded with 0)")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    for name in ("mm", "mm-mdb", "mm:debit_journal", "mm:product_catalog", "mm:sales_ledger", "mm:event_trace"):
+        logging.getLogger(name).setLevel(args.log_level)
+
+    config.REPEAT_TAP_WINDOW = args.repeat_tap_window
+    replay = TraceReplay(args.speed)
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    elapsed = replay.run(args.trace)
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+
+    print(json.dumps(replay.summary(elapsed, args.slowest), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+import base64
+import hashlib
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+import config
+
+logger = logging.getLogger("mm:sales_ledger")
+logger.setLevel(config.MM_LOG_LEVEL)
+
+OUTCOME_SUCCESS = 0
+OUTCOME_FAILURE = 1
+OUTCOME_DENIED = 2
+OUTCOME_CANCELLED = 3
+OUTCOME_NAMES = {
+    OUTCOME_SUCCESS: "success",
+    OUTCOME_FAILURE: "failure",
+    OUTCOME_DENIED: "denied",
+    OUTCOME_CANCELLED: "cancelled",
+}
+
+FLAG_LOCAL_APPROVAL = 1  # approved from the session's running balance before the portal confirmed the debit
+FLAG_CHARGED = 2  # the debit went through after the VMC gave up on the vend, so the member is owed a refund
+FLAG_CARD_HASHED = 4  # the card id isn't a number that fits the record, so the first 8 bytes of its blake2b hash are stored
+
+# sequence number, vend requested at, outcome at, card id, item number, price in cents, outcome, flags
+RECORD = struct.Struct("<IddQHIBB")
+UPLOAD_FORMAT = "mm-sales-v1"
+SEGMENT_EXTENSION = ".bin"
+ACKNOWLEDGED_FILE = "acknowledged"
+
+
+class SalesLedger:
+    def __init__(self, directory: str, segment_records: int = 10000, max_segments: int = 10, ack_timeout: float = 60):
+        """
+        An on-device record of every vend and how it ended, kept as fixed size binary records in segment files that
+        rotate every segment_records records. Only the newest max_segments segments are kept so it can't fill the
+        SD card, but a segment is never deleted until the portal has acknowledged all of it. Appends are buffered and
+        written out and fsync'd by flush(), which the disk sync thread calls every second or so, so the vend path
+        never waits on the disk. Records are uploaded to the portal in compressed batches and the portal acknowledges
+        them by sequence number, a batch that isn't acknowledged within ack_timeout seconds is sent again.
+        """
+
+        self.directory = directory
+        self.segment_records = segment_records
+        self.max_segments = max_segments
+        self.ack_timeout = ack_timeout
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.acknowledged = self._load_acknowledged()
+        self.next_sequence = self._recover()
+        self._segment_first = None
+        self._file = None
+        self._unsynced = False  # records have been appended since the last fsync
+        self._upload_sent_at = None  # when the batch waiting on the portal's acknowledgement was sent
+
+    def _segments(self) -> list:
+        # segments are named after the sequence number of their first record, so sorting them by name works
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_EXTENSION))
+
+    def _segment_path(self, first_sequence: int) -> str:
+        return os.path.join(self.directory, f"{first_sequence:010d}{SEGMENT_EXTENSION}")
+
+    def _load_acknowledged(self) -> int:
+        try:
+            with open(os.path.join(self.directory, ACKNOWLEDGED_FILE)) as file:
+                return int(file.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _recover(self) -> int:
+        segments = self._segments()
+        if not segments:
+            return self.acknowledged + 1
+
+        path = os.path.join(self.directory, segments[-1])
+        size = os.path.getsize(path)
+        if size % RECORD.size:
+            # a torn record from losing power mid write
+            with open(path, "r+b") as file:
+                file.truncate(size - size % RECORD.size)
+        return int(segments[-1][:-len(SEGMENT_EXTENSION)]) + size // RECORD.size
+
+    def append(self, requested_at: float, card_id: str, item_number: int, price: int, outcome: int, flags: int = 0):
+        card_number, card_flags = card_record_value(card_id)
+        flags |= card_flags
+
+        with self._lock:
+            if self._file is None or self.next_sequence - self._segment_first >= self.segment_records:
+                self._rotate()
+
+            self._file.write(RECORD.pack(
+                self.next_sequence,
+                requested_at or 0.0,
+                time.time(),
+                card_number,
+                item_number or 0,
+                price or 0,
+                outcome,
+                flags,
+            ))
+            self.next_sequence += 1
+            self._unsynced = True
+
+    def _rotate(self):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+
+        # carry on with the newest segment after a restart if it has room
+        segments = self._segments()
+        if segments and self._file is None:
+            first_sequence = int(segments[-1][:-len(SEGMENT_EXTENSION)])
+            if self.next_sequence - first_sequence < self.segment_records:
+                self._segment_first = first_sequence
+                self._file = open(self._segment_path(first_sequence), "ab")
+                return
+
+        self._segment_first = self.next_sequence
+        self._file = open(self._segment_path(self._segment_first), "ab")
+
+        segments = self._segments()
+        kept = 0
+        for name, next_name in zip(segments[:-self.max_segments], segments[1:]):
+            # a segment's last record is the one before the next segment's first
+            if int(next_name[:-len(SEGMENT_EXTENSION)]) - 1 > self.acknowledged:
+                kept += 1
+                continue
+            os.remove(os.path.join(self.directory, name))
+
+        if kept:
+            logger.error(f"Keeping {kept} sales ledger segments beyond the limit of {self.max_segments} until the portal acknowledges them, it has only acknowledged up to sale {self.acknowledged}.")
+
+    def _sync(self):
+        self._file.flush()
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = False
+
+    def flush(self):
+        """
+        Writes out the buffered records and forces them to disk.
+        """
+
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+
+    def read(self, after_sequence: int = 0, limit: int = None) -> bytes:
+        """
+        Returns the raw records with a sequence number after after_sequence, up to limit records.
+        """
+
+        self.flush()
+        data = []
+        remaining = limit
+        for name in self._segments():
+            first_sequence = int(name[:-len(SEGMENT_EXTENSION)])
+            with open(os.path.join(self.directory, name), "rb") as file:
+                file.seek(max(after_sequence + 1 - first_sequence, 0) * RECORD.size)
+                chunk = file.read(remaining * RECORD.size if remaining is not None else -1)
+            chunk = chunk[:len(chunk) - len(chunk) % RECORD.size]
+            data.append(chunk)
+
+            if remaining is not None:
+                remaining -= len(chunk) // RECORD.size
+                if remaining <= 0:
+                    break
+        return b"".join(data)
+
+    def records(self, after_sequence: int = 0):
+        for record in RECORD.iter_unpack(self.read(after_sequence)):
+            yield record
+
+    def next_upload_batch(self, limit: int):
+        """
+        Returns the next batch of unacknowledged records to send to the portal, or None if there's nothing to send
+        or the last batch hasn't been acknowledged yet.
+        """
+
+        with self._lock:
+            if self._upload_sent_at is not None and time.monotonic() - self._upload_sent_at < self.ack_timeout:
+                return None
+
+        data = self.read(self.acknowledged, limit)
+        if not data:
+            return None
+
+        first_sequence = RECORD.unpack_from(data)[0]
+        last_sequence = RECORD.unpack_from(data, len(data) - RECORD.size)[0]
+        with self._lock:
+            self._upload_sent_at = time.monotonic()
+
+        return {
+            "format": UPLOAD_FORMAT,
+            "first_sequence": first_sequence,
+            "last_sequence": last_sequence,
+            "count": len(data) // RECORD.size,
+            "data": base64.b64encode(zlib.compress(data)).decode("ascii"),
+        }
+
+    def upload_failed(self):
+        with self._lock:
+            self._upload_sent_at = None
+
+    def acknowledge(self, last_sequence: int):
+        with self._lock:
+            self._upload_sent_at = None
+            if last_sequence <= self.acknowledged:
+                return
+            self.acknowledged = last_sequence
+
+        tmp_path = os.path.join(self.directory, ACKNOWLEDGED_FILE + ".tmp")
+        with open(tmp_path, "w") as file:
+            file.write(str(last_sequence))
+        os.replace(tmp_path, os.path.join(self.directory, ACKNOWLEDGED_FILE))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def card_record_value(card_id: str) -> tuple:
+    """
+    Returns the card id as it's stored in a record and the flags that go with it. Card ids are normally numbers
+    from the card reader, anything else is stored as a hash so it can still be matched.
+    """
+
+    if not card_id:
+        return 0, 0
+    try:
+        card_number = int(card_id)
+        if 0 <= card_number < 1 << 64 and str(card_number) == card_id:
+            return card_number, 0
+    except ValueError:
+        pass
+    return int.from_bytes(hashlib.blake2b(card_id.encode(), digest_size=8).digest(), "little"), FLAG_CARD_HASHED
+
+
+def export_dex(ledger: SalesLedger, machine_serial: str = "000000000001") -> str:
+    """
+    Builds a DEX style audit report of the successful vends in the ledger, with the totals and a PA1/PA2 pair for
+    each item. It's enough for reconciling sales, it doesn't include the cash or G85 checksum blocks.
+    """
+
+    items = {}
+    total_value = 0
+    total_count = 0
+    for _, _, _, _, item_number, price, outcome, _ in ledger.records():
+        if outcome != OUTCOME_SUCCESS:
+            continue
+        count, value, _ = items.get(item_number, (0, 0, price))
+        items[item_number] = (count + 1, value + price, price)
+        total_value += price
+        total_count += 1
+
+    lines = [
+        "DXS*MMMDB00001*VA*V1/1*1",
+        "ST*001*0001",
+        f"ID1*{machine_serial}*MM-MDB*0001",
+        f"VA1*{total_value}*{total_count}*{total_value}*{total_count}",
+    ]
+    for item_number in sorted(items):
+        count, value, price = items[item_number]
+        lines.append(f"PA1*{item_number}*{price}")
+        lines.append(f"PA2*{count}*{value}*{count}*{value}")
+    lines.append(f"SE*{len(lines)}*0001")
+    lines.append("DXE*1*1")
+    return "\r\n".join(lines) + "\r\n"
+
+
+if __name__ == "__main__":
+    # python3 sales_ledger.py [dump|dex] <ledger directory>
+    command, directory = sys.argv[1], sys.argv[2]
+    sales_ledger = SalesLedger(directory)
+    if command == "dex":
+        sys.stdout.write(export_dex(sales_ledger))
+    else:
+        for sequence, requested_at, outcome_at, card_id, item_number, price, outcome, flags in sales_ledger.records():
+            print(f"{sequence} {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(requested_at))} card={card_id} item={item_number} price={price} {OUTCOME_NAMES.get(outcome, outcome)} latency={outcome_at - requested_at:.3f}s flags={flags}")
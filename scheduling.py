@@ -0,0 +1,196 @@
+import gc
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+from metrics import vend_metrics
+
+logger = logging.getLogger("mm:scheduling")
+logger.setLevel(config.MM_LOG_LEVEL)
+
+POLICIES = {
+    "fifo": getattr(os, "SCHED_FIFO", None),
+    "rr": getattr(os, "SCHED_RR", None),
+    "other": getattr(os, "SCHED_OTHER", None),
+}
+
+_warned_roles = set()
+_gc_started_at = None
+_gc_tuned = False
+
+
+def _thread_id() -> int:
+    # on Linux the scheduling and affinity calls with a thread id (or 0) only apply to that thread
+    return threading.get_native_id()
+
+
+def _apply(profile: dict):
+    cpus = profile.get("cpus")
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
+    policy = POLICIES[profile.get("policy", "other")]
+    priority = profile.get("priority", 1) if policy != os.SCHED_OTHER else 0
+    os.sched_setscheduler(0, policy, os.sched_param(priority))
+    if profile.get("nice") is not None:
+        os.setpriority(os.PRIO_PROCESS, _thread_id(), profile["nice"])
+
+
+def apply_role(role: str):
+    """
+    Applies the scheduling profile for role from config.SCHEDULING_PROFILE to the calling thread, its CPU affinity,
+    scheduling policy and priority and nice value. It's best effort, without the privileges for it
+    (root or CAP_SYS_NICE) we log a warning once per role and carry on.
+    """
+
+    profile = config.SCHEDULING_PROFILE.get(role) if config.SCHEDULING_PROFILE else None
+    if not profile or not hasattr(os, "sched_setaffinity"):
+        return
+
+    try:
+        _apply(profile)
+        logger.debug("Applied %s scheduling profile to thread %s.", role, threading.current_thread().name)
+    except (OSError, ValueError) as e:
+        if role not in _warned_roles:
+            _warned_roles.add(role)
+            logger.warning(f"Couldn't apply the {role} scheduling profile: {e}")
+
+
+@contextmanager
+def inherited_role(role: str):
+    """
+    Runs the block with the calling thread in role, so threads and processes it creates inherit the role's
+    scheduling, then restores the calling thread. Used for the MDB bus, which pymultidropbus runs itself.
+    """
+
+    if not hasattr(os, "sched_getaffinity"):
+        yield
+        return
+
+    affinity = os.sched_getaffinity(0)
+    policy = os.sched_getscheduler(0)
+    param = os.sched_getparam(0)
+    nice = os.getpriority(os.PRIO_PROCESS, _thread_id())
+    apply_role(role)
+    try:
+        yield
+    finally:
+        try:
+            os.sched_setscheduler(0, policy, param)
+            os.setpriority(os.PRIO_PROCESS, _thread_id(), nice)
+            os.sched_setaffinity(0, affinity)
+        except OSError as e:
+            logger.warning(f"Couldn't restore the scheduling profile after creating the {role} thread: {e}")
+
+
+class GcGuard:
+    def __init__(self, max_deferral: float = 30):
+        """
+        Holds off Python's cyclic garbage collector while any machine has a vend session open, so a collection can't
+        stall a reply to the VMC, and collects the youngest generation once the last session ends. Collection is
+        never held off for more than max_deferral seconds, in case a session is never closed.
+        """
+
+        self.max_deferral = max_deferral
+        self._holders = set()
+        self._disabled_at = None
+        self._lock = threading.Lock()
+
+    def hold(self, holder: str):
+        if not self.max_deferral:
+            return
+
+        with self._lock:
+            self._holders.add(holder)
+            if self._disabled_at is None and gc.isenabled():
+                gc.disable()
+                self._disabled_at = time.monotonic()
+
+    def release(self, holder: str):
+        with self._lock:
+            self._holders.discard(holder)
+            if self._holders or self._disabled_at is None:
+                return
+            self._enable()
+
+        gc.collect(0)
+
+    def check(self):
+        """
+        Called periodically to re-enable collection if it's been held off for too long.
+        """
+
+        with self._lock:
+            if self._disabled_at is None or time.monotonic() - self._disabled_at < self.max_deferral:
+                return
+            logger.warning(f"Garbage collection was held off for {self.max_deferral} seconds, enabling it again.")
+            self._holders.clear()
+            self._enable()
+
+    def _enable(self):
+        self._disabled_at = None
+        gc.enable()
+
+
+def _gc_callback(phase: str, info: dict):
+    global _gc_started_at
+
+    if phase == "start":
+        _gc_started_at = time.perf_counter()
+    elif _gc_started_at is not None:
+        vend_metrics.observe("gc_pause", time.perf_counter() - _gc_started_at)
+        _gc_started_at = None
+
+
+def tune_gc():
+    """
+    Moves everything allocated during startup into the permanent generation so collections only walk objects
+    created since, raises the collection thresholds and starts timing collection pauses. Call it once everything is
+    initialised, it only does anything the first time so a restart doesn't freeze the last run's garbage for good.
+    """
+
+    global _gc_tuned
+
+    if not config.GC_FREEZE_AFTER_INIT or _gc_tuned:
+        return
+    _gc_tuned = True
+
+    gc.collect()
+    gc.freeze()
+    if config.GC_THRESHOLDS:
+        gc.set_threshold(*config.GC_THRESHOLDS)
+    if _gc_callback not in gc.callbacks:
+        gc.callbacks.append(_gc_callback)
+    logger.info(f"Froze {gc.get_freeze_count()} objects allocated during startup.")
+
+
+class JitterMonitor(threading.Thread):
+    def __init__(self, interval: float = 0.01, role: str = "commands"):
+        """
+        Measures scheduling jitter as seen by threads in role, how much later than asked a short sleep wakes up,
+        and records it in the scheduling_jitter histogram.
+        """
+
+        super().__init__(name="jitter_monitor", daemon=True)
+        self._stop_event = threading.Event()
+        self.interval = interval
+        self.role = role
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def run(self):
+        apply_role(self.role)
+        while not self._stop_event.is_set():
+            started_at = time.perf_counter()
+            time.sleep(self.interval)
+            vend_metrics.observe("scheduling_jitter", max(time.perf_counter() - started_at - self.interval, 0))
+
+
+gc_guard = GcGuard(config.GC_MAX_DEFERRAL)
@@ -0,0 +1,428 @@
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from queue import Queue
+from types import SimpleNamespace
+
+import config
+import event_trace
+from event_queue import DeadlineQueue
+import mm as mm_library
+import scheduling
+import websocket
+import pymultidropbus.protocol.peripherals.Cashless as Cashless
+from metrics import Histogram, vend_metrics
+from machine import Machine
+from flight_recorder import flight_recorder
+
+# An offline harness for exercising the command queue threads and the MM client without a vending machine, a Pi or
+# the portal. A simulated VMC drives MDB events into the command queue, a stub portal answers over a real local
+# websocket, and a synthetic card reader taps cards through the same callback as the Wiegand decoder.
+#
+#   python3 simulator.py --vends 500 --cards 50 --latency 0.05 --failure-rate 0.01
+#
+# The stub portal needs the websockets package (pip3 install -r requirements-asyncio.txt).
+
+logger = logging.getLogger("mm:simulator")
+
+mm_mdb = importlib.import_module("mm-mdb")
+
+
+class SimMoney:
+    def __init__(self, cents: int):
+        self.cents = cents
+        self.dollars = cents / 100
+
+    def __str__(self):
+        return str(self.cents)
+
+
+class FakeSerialPort:
+    def close(self):
+        pass
+
+
+class FakeCashlessPeripheral:
+    def __init__(self, commands_queue: Queue):
+        """
+        Stands in for pymultidropbus.CashlessPeripheral, recording every response the reader would send to the VMC.
+        """
+
+        self.commands_queue = commands_queue
+        self.serial_port = FakeSerialPort()
+        self.frames = []
+        self.session_started = threading.Event()
+        self.vend_decided = threading.Event()
+        self.session_balance = None
+        self.vend_approved = None
+
+    def start_cashless_session(self, available_balance_in_cents: int = None):
+        self.session_balance = available_balance_in_cents
+        self.session_started.set()
+
+    def approve_vend(self, amount_charged_in_cents: int):
+        self.vend_approved = True
+        self.vend_decided.set()
+
+    def deny_vend(self):
+        self.vend_approved = False
+        self.vend_decided.set()
+
+    def send_ack(self):
+        pass
+
+    def _send_cmd(self, command_string: str):
+        self.frames.append(command_string)
+
+
+class SimulatedVmc:
+    def __init__(self, machine: Machine, mdb: FakeCashlessPeripheral, commands_queue: Queue, tap_card, response_timeout: float, vend_failure_rate: float = 0):
+        """
+        Plays the part of the vending machine controller, driving the same MdbCommandEvents into the command queue
+        that pymultidropbus would and timing how long the reader takes to answer.
+        """
+
+        self.machine = machine
+        self.mdb = mdb
+        self.commands_queue = commands_queue
+        self.tap_card = tap_card
+        self.response_timeout = response_timeout
+        self.vend_failure_rate = vend_failure_rate
+
+        self.session_latency = Histogram()
+        self.vend_latency = Histogram()
+        self.approved = 0
+        self.denied = 0
+        self.no_session = 0
+        self.missed_deadlines = 0
+
+    def _send(self, command, **fields):
+        self.commands_queue.put(SimpleNamespace(command=command, **fields))
+
+    def _wait_for_idle(self):
+        # the VMC waits for the reader to finish with the last session before the next member can tap
+        while self.commands_queue.qsize() or self.machine.current_session:
+            time.sleep(0.0005)
+
+    def setup(self):
+        self._send(Cashless.MdbCommand.RESET)
+        self._send(Cashless.MdbCommand.SETUP_CONFIG_DATA)
+        self._send(Cashless.MdbCommand.SETUP_PRICE_DATA, min_price=SimMoney(0), max_price=SimMoney(1000))
+        self._send(
+            Cashless.MdbCommand.EXPANSION_REQUEST_ID,
+            manufacturer_code="SIM",
+            serial_number="000000000001",
+            model_number="000000000001",
+            software_version=1,
+        )
+        self._send(Cashless.MdbCommand.READER_ENABLE)
+
+    def vend(self, card_id: int, item_number: int, item_price: int):
+        self._wait_for_idle()
+        self.mdb.session_started.clear()
+        self.mdb.vend_decided.clear()
+
+        tapped_at = time.monotonic()
+        self.tap_card(card_id)
+        if not self.mdb.session_started.wait(self.response_timeout * 2):
+            self.no_session += 1
+            self.machine.current_session = None
+            return
+        self.session_latency.observe(time.monotonic() - tapped_at)
+
+        requested_at = time.monotonic()
+        self._send(Cashless.MdbCommand.VEND_REQUEST, item_price=SimMoney(item_price), item_number=item_number)
+        decided = self.mdb.vend_decided.wait(self.response_timeout)
+        latency = time.monotonic() - requested_at
+
+        if not decided:
+            # the VMC gives up on the vend, just like a real one would
+            self.missed_deadlines += 1
+            self._send(Cashless.MdbCommand.VEND_CANCEL)
+            self.mdb.vend_decided.wait()
+        else:
+            self.vend_latency.observe(latency)
+
+        if decided and self.mdb.vend_approved:
+            self.approved += 1
+            if random.random() < self.vend_failure_rate:
+                self._send(Cashless.MdbCommand.VEND_FAILURE)
+            else:
+                self._send(Cashless.MdbCommand.VEND_SUCCESS, item_number=item_number)
+        else:
+            self.denied += 1
+
+        self._send(Cashless.MdbCommand.VEND_SESSION_COMPLETE)
+
+
+class StubPortal:
+    def __init__(self, port: int, latency: float = 0.05, jitter: float = 0.02, failure_rate: float = 0, drop_rate: float = 0, starting_balance: int = 10000):
+        """
+        A local websocket server that answers authenticate, ping, balance and debit packets like the portal does,
+        after a configurable latency. failure_rate is the chance a balance or debit is refused and drop_rate is the
+        chance a request is never answered at all.
+        """
+
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.starting_balance = starting_balance
+        self.balances = {}
+        self.charged_keys = set()
+        self.sales_uploaded = 0
+        self.loop: asyncio.AbstractEventLoop = None
+        self._ready = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name="stub_portal", daemon=True).start()
+        self._ready.wait()
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self._serve())
+
+    async def _serve(self):
+        import websockets
+
+        async with websockets.serve(self._handle_connection, "127.0.0.1", self.port):
+            self._ready.set()
+            await asyncio.Future()
+
+    async def _handle_connection(self, connection, path=None):
+        async for message in connection:
+            asyncio.get_running_loop().create_task(self._reply(connection, json.loads(message)))
+
+    async def _reply(self, connection, packet: dict):
+        command = packet.get("command")
+
+        if command in ("balance", "debit"):
+            if random.random() < self.drop_rate:
+                return
+            await asyncio.sleep(max(random.gauss(self.latency, self.jitter), 0))
+
+        if command == "authenticate":
+            reply = {"authorised": True}
+        elif command == "ping":
+            reply = {"command": "pong", "seq": packet.get("seq"), "sent_at": packet.get("sent_at")}
+        elif command == "balance":
+            reply = {
+                "command": "balance",
+                "request_id": packet.get("request_id"),
+                "success": random.random() >= self.failure_rate,
+                "balance": self.balances.setdefault(packet["card_id"], self.starting_balance),
+            }
+        elif command == "debit":
+            reply = self._debit(packet)
+        elif command == "products":
+            # every item the simulated VMC sells is enabled and priced by the VMC
+            reply = {
+                "command": "products",
+                "device_id": packet.get("device_id"),
+                "version": 1,
+                "full": True,
+                "products": [{"item_number": item_number, "enabled": True} for item_number in range(1, 41)],
+            }
+        elif command == "sales_batch":
+            self.sales_uploaded += packet["count"]
+            reply = {"command": "sales_batch", "device_id": packet.get("device_id"), "last_sequence": packet["last_sequence"]}
+        elif command == "debit_batch":
+            reply = {
+                "command": "debit_batch",
+                "results": [self._debit(debit) for debit in packet.get("debits", [])],
+            }
+        else:
+            return
+
+        await connection.send(json.dumps(reply))
+
+    def _debit(self, packet: dict) -> dict:
+        card_id = packet["card_id"]
+        amount = round(packet["amount"] * 100)
+        balance = self.balances.setdefault(card_id, self.starting_balance)
+        success = amount <= balance and random.random() >= self.failure_rate
+
+        # idempotency keys mean a replayed debit is never charged twice
+        if success and packet.get("idempotency_key") not in self.charged_keys:
+            self.charged_keys.add(packet.get("idempotency_key"))
+            balance -= amount
+            self.balances[card_id] = balance
+
+        return {
+            "command": "debit",
+            "request_id": packet.get("request_id"),
+            "idempotency_key": packet.get("idempotency_key"),
+            "success": success,
+            "balance": balance,
+        }
+
+
+class SyntheticWiegand:
+    def __init__(self, callback, bits: int = 26):
+        """
+        Taps cards by calling the Wiegand callback from its own thread, like pigpio's callback thread does.
+        """
+
+        self.callback = callback
+        self.bits = bits
+
+    def tap(self, card_id: int):
+        threading.Thread(target=self.callback, args=(self.bits, card_id), daemon=True).start()
+
+
+def run_benchmark(args) -> dict:
+    portal = StubPortal(args.port, args.latency, args.jitter, args.failure_rate, args.drop_rate)
+    portal.start()
+
+    # keep the simulated debits and flight recorder dumps out of the real ones
+    sim_dir = tempfile.mkdtemp()
+    config.DEBIT_JOURNAL_PATH = os.path.join(sim_dir, "debit_journal.jsonl")
+    flight_recorder.dump_dir = os.path.join(sim_dir, "flight_recorder")
+    config.PRODUCT_CATALOG_PATH = os.path.join(sim_dir, "product_catalog.json")
+    config.SALES_LEDGER_DIR = os.path.join(sim_dir, "sales_ledger")
+    config.REPEAT_TAP_WINDOW = args.repeat_tap_window
+    if args.trace:
+        event_trace.start(args.trace)
+    if args.scheduling_profile:
+        config.SCHEDULING_PROFILE = config.SCHEDULING_PROFILE or config.PI_SCHEDULING_PROFILE
+    else:
+        # the profile's pinned to a Pi's cores, so it's only applied when asked for
+        config.SCHEDULING_PROFILE = None
+
+    mm = mm_library.MM(config.API_SECRET, "127.0.0.1", None, None)
+    vmcs = []
+    for machine_number in range(args.machines):
+        # a single machine runs untagged, just like it does on a real Pi
+        machine = Machine(f"machine{machine_number}" if args.machines > 1 else None)
+        mdb_queue_options, ws_queue_options = mm_mdb.command_queue_options(machine)
+        mdb_commands_queue = DeadlineQueue(**mdb_queue_options)
+        ws_commands_queue = DeadlineQueue(**ws_queue_options)
+        mm.register_device(machine.device_id, ws_commands_queue, machine.catalog, machine.sales_ledger)
+        vend_metrics.register_queue(mdb_commands_queue.name, mdb_commands_queue)
+        vend_metrics.register_queue(ws_commands_queue.name, ws_commands_queue)
+        mdb = FakeCashlessPeripheral(mdb_commands_queue)
+        for thread in (
+            mm_mdb.CommandQueueThread(mdb_commands_queue, mm, mdb, machine),
+            mm_mdb.WsCommandQueueThread(ws_commands_queue, mm, mdb, machine),
+        ):
+            thread.daemon = True
+            thread.start()
+
+        wiegand = SyntheticWiegand(mm_mdb.make_wiegand_callback(mm, machine))
+        vmcs.append(SimulatedVmc(machine, mdb, mdb_commands_queue, wiegand.tap, config.MDB_MAX_RESPONSE_TIME, args.vend_failure_rate))
+
+    scheduling.tune_gc()
+    jitter_monitor = scheduling.JitterMonitor(config.JITTER_MONITOR_INTERVAL or 0.01)
+    jitter_monitor.start()
+
+    connected = threading.Event()
+
+    def ws_on_open(ws):
+        mm.ws = ws
+        mm.send_authentication()
+        mm.heartbeat.connected()
+        connected.set()
+
+    def ws_on_close(ws, status_code, msg):
+        mm.ws_on_close()
+
+    websocket_client = websocket.WebSocketApp(
+        f"ws://127.0.0.1:{args.port}/",
+        on_open=ws_on_open,
+        on_message=lambda ws, message: mm.ws_on_message(ws, message),
+        on_close=ws_on_close,
+    )
+    threading.Thread(target=websocket_client.run_forever, name="websocket", daemon=True).start()
+    connected.wait()
+
+    cards = [random.randint(10000, 99999999) for _ in range(args.cards)]
+
+    def run_vmc(vmc: SimulatedVmc, vends: int):
+        vmc.setup()
+        for vend_number in range(vends):
+            if args.rate:
+                time.sleep(max(started_at + vend_number / args.rate - time.monotonic(), 0))
+            vmc.vend(random.choice(cards), random.randint(1, 40), random.choice([150, 200, 250, 300, 350]))
+
+    # each machine runs its share of the vends at the same time, sharing the one portal connection
+    started_at = time.monotonic()
+    vmc_threads = [
+        threading.Thread(target=run_vmc, args=(vmc, args.vends // len(vmcs) + (index < args.vends % len(vmcs))))
+        for index, vmc in enumerate(vmcs)
+    ]
+    for thread in vmc_threads:
+        thread.start()
+    for thread in vmc_threads:
+        thread.join()
+    elapsed = time.monotonic() - started_at
+
+    # the ping thread isn't running, so upload the sales ledgers by hand
+    mm.upload_sales()
+    time.sleep(0.5)
+
+    session_latency = Histogram()
+    vend_latency = Histogram()
+    for vmc in vmcs:
+        for merged, histogram in ((session_latency, vmc.session_latency), (vend_latency, vmc.vend_latency)):
+            merged.counts = [total + count for total, count in zip(merged.counts, histogram.counts)]
+            merged.count += histogram.count
+            merged.sum += histogram.sum
+
+    websocket_client.close()
+    jitter_monitor.stop()
+    if event_trace.recorder is not None:
+        event_trace.recorder.close()
+
+    return {
+        "machines": len(vmcs),
+        "vends": args.vends,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_vends_per_second": round(args.vends / elapsed, 2),
+        "approved": sum(vmc.approved for vmc in vmcs),
+        "denied": sum(vmc.denied for vmc in vmcs),
+        "no_session": sum(vmc.no_session for vmc in vmcs),
+        "missed_deadlines": sum(vmc.missed_deadlines for vmc in vmcs),
+        "sales_uploaded": portal.sales_uploaded,
+        "tap_to_session": session_latency.snapshot(),
+        "vend_request_to_decision": vend_latency.snapshot(),
+        "scheduling_jitter": vend_metrics.histograms["scheduling_jitter"].snapshot(),
+        "gc_pause": vend_metrics.histograms["gc_pause"].snapshot(),
+        "queue_shed": vend_metrics.queue_shed(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark mm-mdb against a simulated VMC and a stub portal.")
+    parser.add_argument("--vends", type=int, default=200, help="number of vends to run")
+    parser.add_argument("--cards", type=int, default=50, help="number of distinct cards to tap")
+    parser.add_argument("--machines", type=int, default=1, help="number of vending machines sharing the portal connection")
+    parser.add_argument("--rate", type=float, default=0, help="target vends per second (0 runs flat out)")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean portal reply latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="standard deviation of the portal latency")
+    parser.add_argument("--failure-rate", type=float, default=0, help="chance the portal refuses a request")
+    parser.add_argument("--drop-rate", type=float, default=0, help="chance the portal never answers a request")
+    parser.add_argument("--vend-failure-rate", type=float, default=0, help="chance the VMC reports a failed vend")
+    parser.add_argument("--repeat-tap-window", type=float, default=0, help="seconds repeat taps of a card are ignored for (the simulated members tap back to back, so it's off by default)")
+    parser.add_argument("--trace", help="record an event trace of the run to this file, for replay_trace.py")
+    parser.add_argument("--scheduling-profile", action="store_true", help="apply SCHEDULING_PROFILE (or PI_SCHEDULING_PROFILE) to the simulator's threads")
+    parser.add_argument("--port", type=int, default=8765, help="port for the stub portal")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    for name in ("mm", "mm-mdb", "mm:debit_journal", "mm:metrics", "mm:product_catalog", "mm:simulator", "websocket"):
+        logging.getLogger(name).setLevel(args.log_level)
+
+    print(json.dumps(run_benchmark(args), indent=2))
+
+
+if __name__ == "__main__":
+    main()
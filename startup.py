@@ -0,0 +1,77 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+
+logger = logging.getLogger("mm:startup")
+logger.setLevel(config.MM_LOG_LEVEL)
+
+
+def process_started_at() -> float:
+    """
+    Returns the monotonic time this process started, so the startup timeline includes the interpreter starting and
+    the imports. On Linux the monotonic clock counts from boot, just like the process start time in /proc.
+    """
+
+    try:
+        with open("/proc/self/stat") as file:
+            # the command name can contain spaces, so count fields from after it
+            fields = file.read().rsplit(")", 1)[1].split()
+        return int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.monotonic()
+
+
+class StartupTimeline:
+    def __init__(self, started_at: float = None):
+        """
+        Logs how long each phase of starting up took and when it finished, and then "ready to vend" once every
+        required phase is done, with how long that took since the process started and since boot. Phases can finish
+        in any order and from any thread, a phase that happens again (like reconnecting) is only logged the first time.
+        """
+
+        self.started_at = started_at if started_at is not None else process_started_at()
+        self.phases = {}  # phase -> seconds since starting when it finished
+        self.ready_after = None
+        self._required = None  # phases still to finish before we're ready, None until they're known
+        self._lock = threading.Lock()
+
+    def require(self, *phases: str):
+        with self._lock:
+            self._required = (self._required or set()) | {phase for phase in phases if phase not in self.phases}
+        self._check_ready()
+
+    def _check_ready(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._required or self._required is None or self.ready_after is not None:
+                return
+            self.ready_after = now - self.started_at
+
+        logger.info(f"Startup: ready to vend {self.ready_after:.3f}s after starting ({now:.1f}s after boot).")
+
+    def mark(self, phase: str, duration: float = None):
+        now = time.monotonic()
+        with self._lock:
+            if phase in self.phases:
+                return
+            self.phases[phase] = now - self.started_at
+            if self._required is not None:
+                self._required.discard(phase)
+
+        took = f" took {duration:.3f}s," if duration is not None else ""
+        logger.info(f"Startup: {phase}{took} done {now - self.started_at:.3f}s after starting.")
+        self._check_ready()
+
+    @contextmanager
+    def timed(self, phase: str):
+        started_at = time.monotonic()
+        yield
+        self.mark(phase, time.monotonic() - started_at)
+
+    def call(self, phase: str, function, *args):
+        with self.timed(phase):
+            return function(*args)
@@ -0,0 +1,205 @@
+import logging
+import threading
+import time
+from collections import deque
+
+import config
+from flight_recorder import flight_recorder
+from metrics import vend_metrics, resource_usage
+
+logger = logging.getLogger("mm:supervisor")
+logger.setLevel(config.MM_LOG_LEVEL)
+
+ACTION_ALERT = "alert"
+ACTION_RESTART = "restart"
+ACTION_EXIT = "exit"
+
+
+class ResourceBudget:
+    def __init__(self, max_threads: int = 0, max_rss_bytes: int = 0, max_queue_depth: int = 0, grace: float = 0,
+                 action: str = ACTION_RESTART):
+        """
+        Tracks the process's thread count, resident memory and command queue depths against their budgets (0 is
+        unlimited). Going over the budget logs an alert and dumps the flight recorder. Staying over it for grace
+        seconds takes the action: "restart" restarts every worker cleanly, "exit" exits so the service manager can
+        restart the process and "alert" does nothing more. Restarting can't shrink resident memory, Python rarely
+        gives memory back, so "restart" exits for that, and for anything a restart didn't bring back within budget.
+        """
+
+        self.max_threads = max_threads
+        self.max_rss_bytes = max_rss_bytes
+        self.max_queue_depth = max_queue_depth
+        self.grace = grace
+        self.action = action
+        self.over_since = None
+        self.restarted = False  # the last action was a restart, and we haven't been back within budget since
+        self.exit_requested = False
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            config.SUPERVISOR_MAX_THREADS,
+            config.SUPERVISOR_MAX_RSS_MB * 1024 * 1024,
+            config.SUPERVISOR_MAX_QUEUE_DEPTH,
+            config.SUPERVISOR_OVER_BUDGET_GRACE,
+            config.SUPERVISOR_OVER_BUDGET_ACTION,
+        )
+
+    def over_budget(self) -> tuple:
+        """
+        Returns what's over budget, and whether resident memory is one of them.
+        """
+
+        usage = resource_usage()
+        reasons = []
+        if self.max_threads and usage["threads"] > self.max_threads:
+            reasons.append(f"{usage['threads']} threads")
+        memory_over = bool(self.max_rss_bytes and usage["rss_bytes"] > self.max_rss_bytes)
+        if memory_over:
+            reasons.append(f"{usage['rss_bytes'] // (1024 * 1024)}MB resident")
+        if self.max_queue_depth:
+            for name, depth in vend_metrics.queue_depths().items():
+                if depth > self.max_queue_depth:
+                    reasons.append(f"{depth} events waiting on {name}")
+        return reasons, memory_over
+
+    def check(self) -> bool:
+        """
+        Called periodically, returns True when the workers should be stopped so they can be restarted, or the
+        process exited if exit_requested is set.
+        """
+
+        reasons, memory_over = self.over_budget()
+        if not reasons:
+            if self.over_since is not None:
+                logger.info("Back within the resource budget.")
+            self.over_since = None
+            self.restarted = False
+            return False
+
+        now = time.monotonic()
+        if self.over_since is None:
+            self.over_since = now
+            logger.error(f"Over the resource budget: {', '.join(reasons)}.")
+            flight_recorder.dump("over_budget")
+
+        if self.action == ACTION_ALERT or now - self.over_since < self.grace:
+            return False
+
+        self.over_since = None
+        self.exit_requested = self.action == ACTION_EXIT or memory_over or self.restarted
+        self.restarted = not self.exit_requested
+        logger.error(f"Still over the resource budget after {self.grace} seconds ({', '.join(reasons)}), {'exiting' if self.exit_requested else 'restarting'}.")
+        return True
+
+
+class Worker:
+    def __init__(self, name: str, factory, restart: bool):
+        self.name = name
+        self.factory = factory
+        self.restart = restart
+        self.thread = None
+        self.crashes = deque()  # monotonic times it crashed within the restart window
+
+
+class Supervisor(threading.Thread):
+    def __init__(self, budget: ResourceBudget = None, check_period: float = 5, max_restarts: int = 5,
+                 restart_window: float = 300, join_timeout: float = 5):
+        """
+        Owns the worker threads. It starts them from a factory, restarts one that crashes (exits without being
+        stopped) and stops and joins them all when we shut down. A worker that crashes more than max_restarts times
+        in restart_window seconds, or that mustn't be restarted on its own, sets restart_requested so everything is
+        restarted instead, and so does staying over the resource budget. Workers need stop() and stopped().
+        """
+
+        super().__init__(name="supervisor", daemon=True)
+        self._stop_event = threading.Event()
+        self.budget = budget
+        self.check_period = check_period
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.join_timeout = join_timeout
+        self.restart_requested = threading.Event()
+        self._workers = {}  # name -> Worker, in the order they were started
+        self._lock = threading.Lock()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def run(self):
+        while not self._stop_event.wait(self.check_period):
+            self.check_workers()
+            if self.budget is not None and self.budget.check():
+                self.restart_requested.set()
+
+    def start_worker(self, name: str, factory, restart: bool = True):
+        """
+        Starts factory() as the worker called name. A running worker with the same name is stopped and joined first,
+        so there's only ever one of each, like the ping thread for the current connection.
+        """
+
+        self.stop_worker(name)
+        worker = Worker(name, factory, restart)
+        with self._lock:
+            self._workers[name] = worker
+            self._launch(worker)
+
+    def _launch(self, worker: Worker):
+        worker.thread = worker.factory()
+        worker.thread.name = worker.name
+        worker.thread.daemon = True
+        worker.thread.start()
+
+    def stop_worker(self, name: str):
+        with self._lock:
+            worker = self._workers.pop(name, None)
+        if worker is not None:
+            self._stop_and_join([worker])
+
+    def stop_all(self):
+        self.stop()
+        with self._lock:
+            workers = list(reversed(self._workers.values()))
+            self._workers.clear()
+        self._stop_and_join(workers)
+
+    def _stop_and_join(self, workers: list):
+        for worker in workers:
+            worker.thread.stop()
+
+        deadline = time.monotonic() + self.join_timeout
+        for worker in workers:
+            if worker.thread is threading.current_thread():
+                # a worker stopping itself exits once it returns to its loop
+                continue
+            worker.thread.join(max(deadline - time.monotonic(), 0))
+            if worker.thread.is_alive():
+                logger.warning(f"{worker.name} didn't stop within {self.join_timeout} seconds.")
+
+    def check_workers(self):
+        with self._lock:
+            for worker in list(self._workers.values()):
+                if worker.thread.is_alive() or worker.thread.stopped():
+                    continue
+
+                now = time.monotonic()
+                worker.crashes.append(now)
+                while now - worker.crashes[0] > self.restart_window:
+                    worker.crashes.popleft()
+                flight_recorder.dump("worker_crashed")
+
+                if not worker.restart:
+                    logger.error(f"{worker.name} crashed, restarting everything.")
+                    self.restart_requested.set()
+                    return
+
+                if len(worker.crashes) > self.max_restarts:
+                    logger.error(f"{worker.name} crashed {len(worker.crashes)} times in {self.restart_window} seconds, restarting everything.")
+                    self.restart_requested.set()
+                    return
+
+                logger.error(f"{worker.name} crashed, restarting it.")
+                self._launch(worker)
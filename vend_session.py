@@ -0,0 +1,100 @@
+import threading
+import time
+
+
+class VendSession:
+    def __init__(self, card_id: str, exposure_cap: int = 0):
+        """
+        A member's cashless session, from their card tap until the VMC completes the session. Keeps a running balance
+        so vends the balance covers can be approved straight away and settled with the portal afterwards. Amounts are
+        in cents.
+
+        exposure_cap limits how much can be approved locally without the portal confirming it, 0 disables local
+        approvals so every vend waits on its debit.
+        """
+
+        self.card_id = card_id
+        self.exposure_cap = exposure_cap
+        self.tapped_at = time.monotonic()
+        self.active = False  # True once the cashless session has been started on the VMC
+        self.start_balance = None
+        self.balance = None  # the portal balance minus everything approved during this session
+        self.unsettled = 0  # approved locally but not confirmed by the portal yet
+        self.pending_vend = None  # (amount, item_number) approved locally and waiting on VEND_SUCCESS or VEND_FAILURE
+        self.vends = 0
+        self._lock = threading.Lock()
+
+    def start(self, balance: int):
+        with self._lock:
+            self.active = True
+            self.start_balance = balance
+            self.balance = balance
+
+    def reconcile(self, portal_balance: int):
+        """
+        Updates the running balance from a fresh portal balance, which doesn't include anything still unsettled.
+        """
+
+        with self._lock:
+            self.balance = portal_balance - self.unsettled
+
+    def refresh_failed(self):
+        """
+        Called when the portal couldn't confirm the cached balance the session started with. It may be out of date,
+        so every vend waits on its debit from now on.
+        """
+
+        with self._lock:
+            self.exposure_cap = 0
+
+    def can_approve_locally(self, amount: int) -> bool:
+        with self._lock:
+            return (
+                self.active
+                and self.balance is not None
+                and self.pending_vend is None
+                and amount <= self.balance
+                and self.unsettled + amount <= self.exposure_cap
+            )
+
+    def reserve(self, amount: int, item_number):
+        with self._lock:
+            self.balance -= amount
+            self.unsettled += amount
+            self.pending_vend = (amount, item_number)
+
+    def rollback(self):
+        """
+        Returns the reserved amount to the running balance after the VMC reports the vend failed.
+        """
+
+        with self._lock:
+            if self.pending_vend is None:
+                return None
+
+            amount, item_number = self.pending_vend
+            self.balance += amount
+            self.unsettled -= amount
+            self.pending_vend = None
+            return amount
+
+    def commit(self):
+        """
+        Marks the reserved vend as dispensed and returns (amount, item_number) so it can be debited from the portal.
+        """
+
+        with self._lock:
+            pending_vend = self.pending_vend
+            self.pending_vend = None
+            if pending_vend is not None:
+                self.vends += 1
+            return pending_vend
+
+    def settle(self, amount: int, success: bool, portal_balance: int = None):
+        with self._lock:
+            self.unsettled -= amount
+            if not success:
+                # the portal refused a vend that's already been dispensed, stop approving anything else locally
+                self.exposure_cap = 0
+            if portal_balance is not None:
+                self.balance = portal_balance - self.unsettled
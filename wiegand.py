@@ -1,27 +1,132 @@
+import os
+import select
+import struct
+import threading
+
 import pigpio
 
+EVEN = 0
+ODD = 1
+
+# what the callback is passed as the card value
+VALUES_LEGACY = "legacy"  # the 24 bits before the last parity bit of any frame, the card ids pywiegandpi gave us
+VALUES_FORMAT = "format"  # the data bits of the frame's format, e.g. the full 32 bit uid from a 34 bit reader
+LEGACY_VALUE_MASK = (1 << 24) - 1
+
+
+def _parity_mask(bits: int, positions) -> int:
+    # positions are numbered from 1 at the first (most significant) bit received, like the format datasheets
+    mask = 0
+    for position in positions:
+        mask |= 1 << (bits - position)
+    return mask
+
+
+class WiegandFormat:
+    def __init__(self, bits: int, parity_checks: list, first_data_bit: int, last_data_bit: int):
+        """
+        A Wiegand frame format. parity_checks is a list of (EVEN or ODD, positions) where positions includes the
+        parity bit itself, and the card value is the bits from first_data_bit to last_data_bit inclusive.
+        """
+
+        self.bits = bits
+        self.parity_checks = [(parity, _parity_mask(bits, positions)) for parity, positions in parity_checks]
+        self.data_shift = bits - last_data_bit
+        self.data_mask = (1 << (last_data_bit - first_data_bit + 1)) - 1
+
+    def parity_ok(self, value: int) -> bool:
+        return all(bin(value & mask).count("1") % 2 == parity for parity, mask in self.parity_checks)
+
+    def card_value(self, value: int) -> int:
+        return (value >> self.data_shift) & self.data_mask
+
+
+FORMATS = {
+    # H10301, 8 bit facility code and 16 bit card number
+    26: WiegandFormat(26, [(EVEN, range(1, 14)), (ODD, range(14, 27))], 2, 25),
+    # H10306, 16 bit facility code and 16 bit card number (or a 32 bit card uid)
+    34: WiegandFormat(34, [(EVEN, range(1, 18)), (ODD, range(18, 35))], 2, 33),
+    # HID Corporate 1000, 12 bit company id and 20 bit card number
+    35: WiegandFormat(35, [
+        (ODD, range(1, 36)),
+        (EVEN, [2] + [position for position in range(3, 35) if position % 3 != 2]),
+        (ODD, [position for position in range(2, 34) if position % 3 != 1] + [35]),
+    ], 3, 34),
+    # H10304, 16 bit facility code and 19 bit card number, the parity bits overlap on bit 19
+    37: WiegandFormat(37, [(EVEN, range(1, 20)), (ODD, range(19, 38))], 2, 36),
+}
+
+
+def decode_frame(bits: int, value: int, formats=None, values: str = VALUES_LEGACY):
+    """
+    Returns the card value from a frame if its length matches one of the formats and the parity checks pass,
+    otherwise None. values is VALUES_LEGACY or VALUES_FORMAT.
+    """
 
-class Decoder:
-    def __init__(self, pi, gpio_0, gpio_1, callback, bit_timeout=5, wiegand_32bit_mode=False, raw_mode=False):
+    if formats is not None and bits not in formats:
+        return None
+
+    wiegand_format = FORMATS.get(bits)
+    if wiegand_format is None or not wiegand_format.parity_ok(value):
+        return None
+
+    if values == VALUES_LEGACY:
+        return (value >> 1) & LEGACY_VALUE_MASK
+    return wiegand_format.card_value(value)
+
+
+class _FrameDecoder:
+    def __init__(self, pi, gpio_0, gpio_1, callback, bit_timeout=5, raw_mode=False, formats=None, min_bit_interval=200,
+                 values=VALUES_LEGACY):
         """
         The callback is passed the code length in bits and the card uid/value.
+
+        The format is detected from the frame length and frames that fail their parity checks are dropped, formats
+        limits which lengths are accepted (all of FORMATS by default). Frames with any bits closer together than
+        min_bit_interval microseconds are dropped too, as no reader sends them that quickly, it's noise on the line.
+        values picks the card value, VALUES_LEGACY keeps the ids cards are already registered with.
         """
 
         self.pi = pi
         self.gpio_0 = gpio_0
         self.gpio_1 = gpio_1
         self.raw_mode = raw_mode
-        self.wiegand_32bit_mode = wiegand_32bit_mode
+        self.formats = formats
+        self.min_bit_interval = min_bit_interval
+        self.values = values
 
         self.callback = callback
         self.bit_timeout = bit_timeout
-        self.receiving_bits = False
+        self.rejected_frames = 0
 
         self.pi.set_mode(gpio_0, pigpio.INPUT)
         self.pi.set_mode(gpio_1, pigpio.INPUT)
         self.pi.set_pull_up_down(gpio_0, pigpio.PUD_UP)
         self.pi.set_pull_up_down(gpio_1, pigpio.PUD_UP)
 
+    def _frame_received(self, bits: int, num: int, timing_ok: bool):
+        if self.raw_mode:
+            self.callback(bits, num)
+            return
+
+        card_uid = decode_frame(bits, num, self.formats, self.values) if timing_ok else None
+        if card_uid is None:
+            self.rejected_frames += 1
+            return
+
+        self.callback(bits, card_uid)
+
+
+class Decoder(_FrameDecoder):
+    def __init__(self, pi, gpio_0, gpio_1, callback, bit_timeout=5, raw_mode=False, formats=None, min_bit_interval=200,
+                 values=VALUES_LEGACY):
+        """
+        Decodes frames from a pigpio callback on each data line, so every bit is handled in Python as it arrives.
+        """
+
+        super().__init__(pi, gpio_0, gpio_1, callback, bit_timeout, raw_mode, formats, min_bit_interval, values)
+        self.receiving_bits = False
+
         self.cb_0 = self.pi.callback(gpio_0, pigpio.FALLING_EDGE, self._cb)
         self.cb_1 = self.pi.callback(gpio_1, pigpio.FALLING_EDGE, self._cb)
 
@@ -34,6 +139,7 @@ class Decoder:
             if not self.receiving_bits:
                 self.bits = 1
                 self.num = 0
+                self.timing_ok = True
 
                 self.receiving_bits = True
                 self.receiving_bits_timeout = 0
@@ -43,6 +149,11 @@ class Decoder:
                 self.bits += 1
                 self.num = self.num << 1
 
+                if pigpio.tickDiff(self.last_tick, tick) < self.min_bit_interval:
+                    self.timing_ok = False
+
+            self.last_tick = tick
+
             if gpio == self.gpio_0:
                 self.receiving_bits_timeout = self.receiving_bits_timeout & 2  # clear gpio 0 timeout
             else:
@@ -60,16 +171,7 @@ class Decoder:
                     self.pi.set_watchdog(self.gpio_0, 0)
                     self.pi.set_watchdog(self.gpio_1, 0)
                     self.receiving_bits = False
-
-                    if self.raw_mode:
-                        self.callback(self.bits, self.num)
-                    else:
-                        # get only the bits we're interested in
-                        card_mask_26bit = 0b0_00000000_11111111_11111111_11111111_0
-                        card_mask_34bit = 0b0_11111111_11111111_11111111_11111111_0
-                        card_mask = card_mask_34bit if self.wiegand_32bit_mode else card_mask_26bit
-                        card_uid = self.num & card_mask >> 1  # strip off the remaining parity bit
-                        self.callback(self.bits, card_uid)
+                    self._frame_received(self.bits, self.num, self.timing_ok)
 
     def cancel(self):
         """
@@ -78,3 +180,103 @@ class Decoder:
 
         self.cb_0.cancel()
         self.cb_1.cancel()
+
+
+NOTIFICATION = struct.Struct("HHII")  # seqno, flags, tick, levels of gpios 0-31
+NOTIFICATION_READ_SIZE = NOTIFICATION.size * 256
+
+
+class NotifyDecoder(_FrameDecoder):
+    def __init__(self, pi, gpio_0, gpio_1, callback, bit_timeout=5, raw_mode=False, formats=None, min_bit_interval=200,
+                 values=VALUES_LEGACY):
+        """
+        Decodes frames from pigpio's notification pipe instead of a callback per edge. pigpiod writes the level
+        changes to /dev/pigpioN in batches and a single thread reads them in bulk, so a tap costs a few wakeups rather
+        than a Python callback for every bit. The end of a frame is spotted by the pipe going quiet for bit_timeout
+        milliseconds, so no watchdogs are needed. It needs to run on the same Pi as pigpiod, opening the pipe raises
+        OSError otherwise.
+        """
+
+        super().__init__(pi, gpio_0, gpio_1, callback, bit_timeout, raw_mode, formats, min_bit_interval, values)
+        self.gpio_0_mask = 1 << gpio_0
+        self.gpio_1_mask = 1 << gpio_1
+
+        self.handle = self.pi.notify_open()
+        try:
+            self.fd = os.open(f"/dev/pigpio{self.handle}", os.O_RDONLY)
+        except OSError:
+            self.pi.notify_close(self.handle)
+            raise
+
+        self.levels = self.pi.read_bank_1()
+        self.frame = []  # (bit, tick) of each bit received in the current frame
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"wiegand_{gpio_0}_{gpio_1}", daemon=True)
+
+        self.pi.notify_begin(self.handle, self.gpio_0_mask | self.gpio_1_mask)
+        self._thread.start()
+
+    def _run(self):
+        pending = b""
+        try:
+            while not self._stop_event.is_set():
+                timeout = self.bit_timeout / 1000 if self.frame else None
+                readable, _, _ = select.select([self.fd], [], [], timeout)
+                if not readable:
+                    self._end_frame()
+                    continue
+
+                data = os.read(self.fd, NOTIFICATION_READ_SIZE)
+                if not data:
+                    break  # the notification was closed
+
+                pending += data
+                complete = len(pending) - len(pending) % NOTIFICATION.size
+                self._process(pending[:complete])
+                pending = pending[complete:]
+        finally:
+            os.close(self.fd)
+
+    def _process(self, data: bytes):
+        for _, flags, tick, levels in NOTIFICATION.iter_unpack(data):
+            if flags:
+                continue  # watchdog, keep alive and event reports, not level changes
+
+            falling = (self.levels ^ levels) & self.levels
+            self.levels = levels
+            if not falling & (self.gpio_0_mask | self.gpio_1_mask):
+                continue
+
+            if self.frame and pigpio.tickDiff(self.frame[-1][1], tick) > self.bit_timeout * 1000:
+                self._end_frame()
+
+            # both lines falling together isn't a valid bit, the zero interval makes the frame fail the timing check
+            if falling & self.gpio_0_mask:
+                self.frame.append((0, tick))
+            if falling & self.gpio_1_mask:
+                self.frame.append((1, tick))
+
+    def _end_frame(self):
+        frame = self.frame
+        self.frame = []
+        if not frame:
+            return
+
+        num = 0
+        timing_ok = True
+        last_tick = None
+        for bit, tick in frame:
+            num = (num << 1) | bit
+            if last_tick is not None and pigpio.tickDiff(last_tick, tick) < self.min_bit_interval:
+                timing_ok = False
+            last_tick = tick
+
+        self._frame_received(len(frame), num, timing_ok)
+
+    def cancel(self):
+        """
+        Cancel the Wiegand decoder.
+        """
+
+        self._stop_event.set()
+        self.pi.notify_close(self.handle)
@@ -0,0 +1,143 @@
+import logging
+import threading
+from collections import deque
+
+import config
+import scheduling
+
+logger = logging.getLogger("mm:ws_writer")
+logger.setLevel(config.MM_LOG_LEVEL)
+
+PRIORITY_CRITICAL = 0  # authentication and debits, never dropped
+PRIORITY_BALANCE = 1
+PRIORITY_HEARTBEAT = 2
+PRIORITY_TELEMETRY = 3
+
+
+class WebSocketWriter(threading.Thread):
+    def __init__(self, send_function, max_queue_size: int = 100):
+        """
+        The only thread that writes to the websocket, so a slow send on a congested link never blocks the thread
+        servicing the MDB bus or the card reader. Messages are sent highest priority first. A message with a coalesce
+        key replaces any queued message with the same key, so repeated heartbeats and superseded balance requests are
+        only sent once. When the queue is full the oldest lowest priority message is dropped. A message that's never
+        sent calls its on_failed(superseded) callback from outside the lock, with superseded True when a newer message
+        with the same coalesce key replaced it.
+        """
+
+        super().__init__(name="ws_writer", daemon=True)
+        self._stop_event = threading.Event()
+        self.send_function = send_function
+        self.max_queue_size = max_queue_size
+        self.dropped = 0
+
+        self._queues = [deque() for _ in range(PRIORITY_TELEMETRY + 1)]
+        self._coalesce_keys = {}  # coalesce key -> queued [coalesce_key, message, on_failed] entry
+        self._size = 0
+        self._condition = threading.Condition()
+
+    def stop(self):
+        self._stop_event.set()
+        with self._condition:
+            self._condition.notify()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def send(self, message: str, priority: int = PRIORITY_CRITICAL, coalesce_key: str = None, on_failed=None):
+        unsent = []  # (on_failed, superseded) for the messages this one displaced
+        with self._condition:
+            if coalesce_key is not None and coalesce_key in self._coalesce_keys:
+                entry = self._coalesce_keys[coalesce_key]
+                unsent.append((entry[2], True))
+                entry[1] = message
+                entry[2] = on_failed
+
+            else:
+                dropped_entry = self._drop_lowest(priority) if self._size >= self.max_queue_size else None
+                if dropped_entry is not None:
+                    unsent.append((dropped_entry[2], False))
+
+                if self._size >= self.max_queue_size and priority != PRIORITY_CRITICAL:
+                    self.dropped += 1
+                    logger.warning(f"Websocket send queue is full, dropped: {message}")
+                    unsent.append((on_failed, False))
+
+                else:
+                    if self._size >= self.max_queue_size:
+                        logger.warning("Websocket send queue is full of critical messages, queueing anyway.")
+                    entry = [coalesce_key, message, on_failed]
+                    self._queues[priority].append(entry)
+                    if coalesce_key is not None:
+                        self._coalesce_keys[coalesce_key] = entry
+                    self._size += 1
+                    self._condition.notify()
+
+        for callback, superseded in unsent:
+            self._report_unsent(callback, superseded)
+
+    def _drop_lowest(self, priority: int):
+        # only ever drop messages that are as or less important than the new one, and never critical ones
+        for queue_priority in range(PRIORITY_TELEMETRY, max(priority, PRIORITY_BALANCE) - 1, -1):
+            queue = self._queues[queue_priority]
+            if queue:
+                entry = queue.popleft()
+                self._coalesce_keys.pop(entry[0], None)
+                self._size -= 1
+                self.dropped += 1
+                logger.warning(f"Websocket send queue is full, dropped: {entry[1]}")
+                return entry
+        return None
+
+    @staticmethod
+    def _report_unsent(on_failed, superseded: bool):
+        if on_failed is None:
+            return
+        try:
+            on_failed(superseded)
+        except Exception as e:
+            logger.error(f"Error handling an unsent websocket message: {e}")
+
+    def _next_message(self):
+        with self._condition:
+            while not self._size and not self._stop_event.is_set():
+                self._condition.wait()
+
+            for queue in self._queues:
+                if queue:
+                    entry = queue.popleft()
+                    self._coalesce_keys.pop(entry[0], None)
+                    self._size -= 1
+                    return entry
+        return None
+
+    def clear(self):
+        """
+        Drops everything queued, used when the connection closes as the messages were meant for that connection.
+        """
+
+        with self._condition:
+            entries = [entry for queue in self._queues for entry in queue]
+            for queue in self._queues:
+                queue.clear()
+            self._coalesce_keys.clear()
+            self._size = 0
+
+        for entry in entries:
+            self._report_unsent(entry[2], False)
+
+    def run(self):
+        scheduling.apply_role("network")
+        while not self._stop_event.is_set():
+            entry = self._next_message()
+            if entry is None:
+                continue
+
+            try:
+                self.send_function(entry[1])
+            except Exception as e:
+                logger.warning(f"Failed to send websocket message: {e}")
+                self._report_unsent(entry[2], False)